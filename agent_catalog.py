@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+from typing import Dict, List, Optional
+
+from usage_log import travar_arquivo
+
+# Definição de constantes
+AGENTS_FILE = 'agents.json'
+
+# Catálogos abertos neste processo
+_CATALOGOS = {}
+_CATALOGOS_LOCK = threading.Lock()
+
+# Catálogo de agentes em memória: o arquivo é lido uma vez e só é lido de novo quando muda
+# (mtime, tamanho ou inode); a busca por nome é um acesso a dicionário. Com nomes repetidos vale
+# o primeiro, como na busca linear anterior. As gravações substituem o arquivo por inteiro
+# (arquivo temporário + os.replace), então um leitor nunca vê um JSON pela metade.
+class AgentCatalog:
+    def __init__(self, path: str = AGENTS_FILE):
+        self.path = path
+        self.agentes: Dict[str, dict] = {}
+        self.assinatura = None
+        self.erro: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _assinatura_atual(self):
+        try:
+            estado = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (estado.st_mtime_ns, estado.st_size, estado.st_ino)
+
+    @staticmethod
+    def _indexar(agentes: list) -> Dict[str, dict]:
+        indice: Dict[str, dict] = {}
+        for agente in agentes:
+            if isinstance(agente, dict) and "agente" in agente:
+                indice.setdefault(agente["agente"], agente)
+        return indice
+
+    def _ler_arquivo(self) -> list:
+        with open(self.path, 'rb') as file:
+            agentes = json.loads(file.read())
+        if not isinstance(agentes, list):
+            raise ValueError("o catálogo deve ser uma lista de agentes")
+        return agentes
+
+    # Recarrega o catálogo se o arquivo mudou. Um arquivo inválido mantém o último catálogo bom
+    # e registra o erro, sem tentar ler o mesmo arquivo de novo a cada chamada.
+    def refresh(self):
+        with self._lock:
+            assinatura = self._assinatura_atual()
+            if assinatura == self.assinatura:
+                return
+            self.assinatura = assinatura
+            if assinatura is None:
+                self.agentes, self.erro = {}, None
+                return
+            try:
+                self.agentes = self._indexar(self._ler_arquivo())
+                self.erro = None
+            except (ValueError, OSError) as e:
+                self.erro = str(e)
+
+    def exists(self) -> bool:
+        self.refresh()
+        return self.assinatura is not None
+
+    def names(self) -> List[str]:
+        self.refresh()
+        return list(self.agentes)
+
+    def get(self, nome: str) -> Optional[dict]:
+        self.refresh()
+        return self.agentes.get(nome)
+
+    # Acrescenta agentes ao arquivo. A trava (entre processos) cobre ler o arquivo atual, gravar o
+    # temporário e publicá-lo; um arquivo atual inválido não é sobrescrito.
+    def add(self, novos: List[dict]):
+        if not novos:
+            return
+        with self._lock:
+            with open(self.path + '.lock', 'a+b') as trava:
+                with travar_arquivo(trava):
+                    agentes = self._ler_arquivo() if os.path.exists(self.path) else []
+                    agentes.extend(novos)
+                    temporario = self.path + '.tmp'
+                    with open(temporario, 'w') as file:
+                        json.dump(agentes, file, indent=4)
+                        file.flush()
+                        os.fsync(file.fileno())
+                    os.replace(temporario, self.path)
+            self.agentes = self._indexar(agentes)
+            self.assinatura = self._assinatura_atual()
+            self.erro = None
+
+# Função para obter o catálogo compartilhado do processo
+def get_agent_catalog(path: str = AGENTS_FILE) -> AgentCatalog:
+    with _CATALOGOS_LOCK:
+        catalogo = _CATALOGOS.get(path)
+        if catalogo is None:
+            catalogo = AgentCatalog(path)
+            _CATALOGOS[path] = catalogo
+        return catalogo
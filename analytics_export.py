@@ -0,0 +1,376 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from blob_store import BLOB_REF_PREFIX, eh_referencia
+from usage_log import travar_arquivo
+from usage_rollups import COLUNAS_HISTOGRAMA
+
+# Definição de constantes
+ANALYTICS_DIR = os.getenv('ANALYTICS_DIR', 'analytics')
+ANALYTICS_EXPORT_INTERVAL = float(os.getenv('ANALYTICS_EXPORT_INTERVAL', '3600'))
+# 'parquet' (comprimido, para guardar meses) ou 'arrow' (Arrow IPC, leitura sem decodificação)
+ANALYTICS_FORMAT = os.getenv('ANALYTICS_FORMAT', 'parquet')
+EXTENSOES = {'parquet': 'parquet', 'arrow': 'arrow'}
+# Estado da exportação incremental (posição no log de uso e último id do histórico exportados)
+ESTADO_EXPORTACAO = '_state.json'
+# Arquivo usado só como trava entre processos (o '.' o deixa fora da leitura do dataset)
+ARQUIVO_TRAVA = '.lock'
+
+CAMPOS_TEXTO_USO = ('user_input', 'user_prompt', 'api_response', 'agent_description')
+CAMPOS_TEXTO_HISTORICO = ('user_input', 'user_prompt', 'expert_response')
+# Colunas de cada tabela exportada (tipo do pyarrow por nome); os textos viram <campo>_chars e <campo>_blob
+COLUNAS_USO = [
+    ('timestamp', 'float64'), ('session_id', 'string'), ('action', 'string'), ('model', 'string'),
+    ('api_key', 'string'), ('agent_used', 'string'), ('interaction_number', 'int64'), ('tokens_used', 'int64'),
+    ('time_taken', 'float64'),
+]
+COLUNAS_HISTORICO = [('id', 'int64'), ('timestamp', 'float64'), ('session_id', 'string'), ('is_reference', 'bool')]
+
+_EXPORTACAO_LOCK = threading.Lock()
+_ULTIMA_EXPORTACAO = {}
+
+# Função para verificar se o pyarrow está instalado (vem junto com o Streamlit)
+def pyarrow_disponivel() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("A exportação para análise requer o pyarrow: pip install pyarrow") from e
+    return pa, pq
+
+# Esquema fixo de uma tabela: todas as partes têm os mesmos tipos, mesmo quando uma coluna vem toda vazia
+def esquema(tabela: str):
+    pa, _ = _pyarrow()
+    colunas, campos = {'usage': (COLUNAS_USO, CAMPOS_TEXTO_USO), 'history': (COLUNAS_HISTORICO, CAMPOS_TEXTO_HISTORICO)}[tabela]
+    texto = [(f"{campo}{sufixo}", tipo) for campo in campos for sufixo, tipo in (('_chars', 'int64'), ('_blob', 'string'))]
+    return pa.schema([(nome, pa.type_for_alias(tipo)) for nome, tipo in colunas + texto])
+
+# Função para obter o dia (UTC) de um timestamp, usado como partição
+def dia_particao(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+# Estado inicial: posição no log de uso (inode, deslocamento em bytes e a última linha exportada,
+# como [tamanho, sha1]) e último id do histórico (AUTOINCREMENT, portanto crescente)
+def estado_inicial() -> dict:
+    return {'usage': {'inode': None, 'offset': 0, 'last_line': None, 'timestamp': 0.0}, 'history_id': 0}
+
+def ler_estado(pasta: str) -> dict:
+    try:
+        with open(os.path.join(pasta, ESTADO_EXPORTACAO), 'r') as file:
+            estado = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return estado_inicial()
+    # Estado do formato anterior, só com o timestamp: a posição é refeita a partir dele
+    if 'usage' not in estado:
+        inicial = estado_inicial()
+        inicial['usage']['timestamp'] = estado.get('usage_timestamp', 0.0)
+        inicial['history_id'] = estado.get('history_id', 0)
+        estado = inicial
+    return estado
+
+def gravar_estado(pasta: str, estado: dict):
+    os.makedirs(pasta, exist_ok=True)
+    caminho = os.path.join(pasta, ESTADO_EXPORTACAO)
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w') as file:
+        json.dump(estado, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporario, caminho)
+
+# Trava da pasta de exportação: entre threads (lock) e entre processos (flock num arquivo), para
+# dois workers não exportarem as mesmas linhas nem consolidarem uma partição ao mesmo tempo
+@contextmanager
+def travar_exportacao(pasta: str):
+    os.makedirs(pasta, exist_ok=True)
+    with _EXPORTACAO_LOCK:
+        with open(os.path.join(pasta, ARQUIVO_TRAVA), 'a+b') as trava:
+            with travar_arquivo(trava):
+                yield
+
+# Função para trocar os textos de um registro por colunas de metadados: o tamanho (caracteres do
+# texto inline ou bytes do blob) e o hash do blob, quando o texto está no repositório
+def colunas_texto(registro: dict, campos, tamanhos_blobs: Dict[str, int]) -> dict:
+    colunas = {}
+    for campo in campos:
+        valor = registro.get(campo)
+        if eh_referencia(valor):
+            colunas[f"{campo}_chars"] = tamanhos_blobs.get(valor)
+            colunas[f"{campo}_blob"] = valor[len(BLOB_REF_PREFIX):]
+        else:
+            colunas[f"{campo}_chars"] = len(valor) if isinstance(valor, str) else 0
+            colunas[f"{campo}_blob"] = None
+    return colunas
+
+def _tamanhos_blobs(registros: List[dict], campos, blobs) -> Dict[str, int]:
+    referencias = [registro[campo] for registro in registros for campo in campos if eh_referencia(registro.get(campo))]
+    return blobs.sizes(referencias) if blobs is not None and referencias else {}
+
+# Linhas de uso para a exportação: métricas tipadas e, no lugar dos textos, tamanho e hash
+def linhas_uso(entradas: List[dict], blobs=None) -> List[dict]:
+    tamanhos = _tamanhos_blobs(entradas, CAMPOS_TEXTO_USO, blobs)
+    linhas = []
+    for entrada in entradas:
+        linha = {
+            'timestamp': float(entrada['timestamp']),
+            'session_id': str(entrada.get('session_id') or ''),
+            'action': str(entrada.get('action') or ''),
+            'model': str(entrada.get('model') or ''),
+            'api_key': str(entrada.get('api_key') or ''),
+            'agent_used': str(entrada.get('agent_used') or ''),
+            'interaction_number': int(entrada.get('interaction_number') or 0),
+            'tokens_used': int(entrada.get('tokens_used') or 0),
+            'time_taken': float(entrada.get('time_taken') or 0.0),
+        }
+        linha.update(colunas_texto(entrada, CAMPOS_TEXTO_USO, tamanhos))
+        linhas.append(linha)
+    return linhas
+
+def linhas_historico(registros: List[dict], blobs=None) -> List[dict]:
+    tamanhos = _tamanhos_blobs(registros, CAMPOS_TEXTO_HISTORICO, blobs)
+    linhas = []
+    for registro in registros:
+        linha = {
+            'id': int(registro['id']),
+            'timestamp': float(registro['timestamp']),
+            'session_id': str(registro.get('session_id') or ''),
+            'is_reference': registro.get('content_hash') is not None,
+        }
+        linha.update(colunas_texto(registro, CAMPOS_TEXTO_HISTORICO, tamanhos))
+        linhas.append(linha)
+    return linhas
+
+# Grava uma tabela num arquivo (temporário + os.replace: um leitor nunca vê um arquivo pela metade)
+def gravar_tabela(tabela, caminho: str, formato: str = ANALYTICS_FORMAT):
+    pa, pq = _pyarrow()
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    # O nome começando com '.' deixa o temporário fora da leitura do dataset
+    temporario = os.path.join(os.path.dirname(caminho), '.' + os.path.basename(caminho) + '.tmp')
+    if formato == 'arrow':
+        with pa.OSFile(temporario, 'wb') as sink:
+            with pa.ipc.new_file(sink, tabela.schema) as writer:
+                writer.write_table(tabela)
+    else:
+        pq.write_table(tabela, temporario, compression='zstd')
+    os.replace(temporario, caminho)
+
+# Grava as linhas particionadas por dia (<pasta>/<tabela>/date=AAAA-MM-DD/part-<nome>.<ext>). O nome
+# identifica o ponto de partida da exportação: refazer uma exportação interrompida regrava as mesmas
+# partes em vez de duplicar as linhas.
+def gravar_particoes(linhas: List[dict], pasta: str, tabela: str, nome: str, formato: str = ANALYTICS_FORMAT) -> List[str]:
+    pa, _ = _pyarrow()
+    por_dia: Dict[str, List[dict]] = {}
+    for linha in linhas:
+        por_dia.setdefault(dia_particao(linha['timestamp']), []).append(linha)
+    arquivos = []
+    for dia, grupo in sorted(por_dia.items()):
+        caminho = os.path.join(pasta, tabela, f"date={dia}", f"part-{nome}.{EXTENSOES[formato]}")
+        gravar_tabela(pa.Table.from_pylist(grupo, schema=esquema(tabela)), caminho, formato)
+        arquivos.append(caminho)
+    return arquivos
+
+# Junta as partes de cada dia já encerrado num único arquivo (day.<ext>), para a leitura de meses
+# abrir um arquivo por dia em vez de um por exportação. Partes que chegarem depois são somadas a ele.
+# Os nomes das partes já incluídas ficam nos metadados do arquivo do dia: se a consolidação for
+# interrompida antes de apagar as partes, elas não são somadas de novo.
+def consolidar_particoes(pasta: str, tabela: str, formato: str = ANALYTICS_FORMAT, agora: Optional[float] = None) -> int:
+    pa, pq = _pyarrow()
+    hoje = dia_particao(agora if agora is not None else time.time())
+    raiz = os.path.join(pasta, tabela)
+    if not os.path.isdir(raiz):
+        return 0
+    extensao = EXTENSOES[formato]
+    consolidados = 0
+    for particao in sorted(os.listdir(raiz)):
+        if not particao.startswith('date=') or particao[len('date='):] >= hoje:
+            continue
+        diretorio = os.path.join(raiz, particao)
+        partes = sorted(nome for nome in os.listdir(diretorio) if nome.startswith('part-') and nome.endswith('.' + extensao))
+        destino = os.path.join(diretorio, f"day.{extensao}")
+        if not partes or (len(partes) == 1 and not os.path.exists(destino)):
+            continue
+
+        def ler(caminho):
+            if formato == 'arrow':
+                return pa.ipc.open_file(pa.memory_map(caminho)).read_all()
+            return pq.read_table(caminho, partitioning=None)
+
+        tabelas, incluidas = [], set()
+        if os.path.exists(destino):
+            tabela_dia = ler(destino)
+            incluidas = set(json.loads((tabela_dia.schema.metadata or {}).get(b'parts', b'[]')))
+            tabelas.append(tabela_dia.replace_schema_metadata(None))
+        novas = [nome for nome in partes if nome not in incluidas]
+        if novas:
+            tabelas += [ler(os.path.join(diretorio, nome)) for nome in novas]
+            tabela_dia = pa.concat_tables(tabelas).replace_schema_metadata({'parts': json.dumps(sorted(incluidas | set(novas)))})
+            gravar_tabela(tabela_dia, destino, formato)
+        for nome in partes:
+            os.remove(os.path.join(diretorio, nome))
+        consolidados += 1
+    return consolidados
+
+def _assinatura_linha(linha: bytes) -> list:
+    return [len(linha), hashlib.sha1(linha).hexdigest()]
+
+# Verifica se a linha que termina no deslocamento é a última exportada (o arquivo não foi reescrito)
+def _termina_em(file, deslocamento: int, ultima: Optional[list]) -> bool:
+    if ultima is None:
+        return deslocamento == 0
+    if deslocamento < ultima[0]:
+        return False
+    file.seek(deslocamento - ultima[0])
+    return _assinatura_linha(file.read(ultima[0])) == ultima
+
+# Procura a última linha exportada num log reescrito (a compactação mantém as linhas idênticas e na
+# mesma ordem) e retorna o deslocamento logo depois dela
+def _localizar(file, ultima: Optional[list]) -> Optional[int]:
+    if ultima is None:
+        return None
+    file.seek(0)
+    posicao, encontrada = 0, None
+    for linha in file:
+        posicao += len(linha)
+        if len(linha) == ultima[0] and _assinatura_linha(linha) == ultima:
+            encontrada = posicao
+    return encontrada
+
+def _ler_a_partir(file, posicao: dict) -> Tuple[List[dict], dict, int]:
+    inode = os.fstat(file.fileno()).st_ino
+    inicio, corte = posicao['offset'], None
+    if posicao['inode'] != inode or not _termina_em(file, inicio, posicao['last_line']):
+        # Log reescrito (compactação ou reset): continua depois da última linha exportada. Se ela
+        # saiu do log, as linhas mantidas são filtradas pelo timestamp da última exportação.
+        inicio = _localizar(file, posicao['last_line'])
+        if inicio is None:
+            inicio, corte = 0, posicao['timestamp']
+    file.seek(inicio)
+    entradas, fim, ultima = [], inicio, posicao['last_line']
+    for linha in file:
+        # Uma linha sem quebra no fim ainda está sendo gravada
+        if not linha.endswith(b'\n'):
+            break
+        fim += len(linha)
+        ultima = _assinatura_linha(linha)
+        try:
+            entrada = json.loads(linha)
+        except ValueError:
+            continue
+        if 'log_reset' in entrada or (corte is not None and entrada.get('timestamp', 0.0) <= corte):
+            continue
+        entradas.append(entrada)
+    nova = {
+        'inode': inode, 'offset': fim, 'last_line': ultima,
+        'timestamp': max([posicao['timestamp']] + [entrada.get('timestamp', 0.0) for entrada in entradas]),
+    }
+    return entradas, nova, inicio
+
+# Entradas do log de uso gravadas depois da posição exportada (as marcas de reset não são exportadas).
+# A leitura usa a mesma trava do log que a compactação: nunca vê um arquivo sendo reescrito.
+# Retorna as entradas, a nova posição e o deslocamento de onde a leitura partiu.
+def ler_log_uso(path: str, posicao: dict) -> Tuple[List[dict], dict, int]:
+    while True:
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return [], posicao, posicao['offset']
+        with file:
+            with travar_arquivo(file):
+                try:
+                    atual = os.stat(path).st_ino == os.fstat(file.fileno()).st_ino
+                except FileNotFoundError:
+                    atual = False
+                if atual:
+                    return _ler_a_partir(file, posicao)
+
+# Função para exportar para a pasta de análise o que foi gravado desde a última exportação: o log
+# de uso e o histórico particionados por dia, e um retrato atualizado dos agregados por hora.
+# Deve rodar antes da compactação do log, que remove as entradas brutas antigas.
+def exportar(usage_log_path: str, historico=None, rollups=None, blobs=None, pasta: str = ANALYTICS_DIR,
+             formato: str = ANALYTICS_FORMAT, agora: Optional[float] = None) -> dict:
+    pa, _ = _pyarrow()
+    agora = agora if agora is not None else time.time()
+    with travar_exportacao(pasta):
+        estado = ler_estado(pasta)
+        resultado = {'usage_rows': 0, 'history_rows': 0, 'rollup_rows': 0}
+
+        entradas, posicao, inicio = ler_log_uso(usage_log_path, estado['usage'])
+        if entradas:
+            # Parte nomeada pelo arquivo, deslocamento e primeira linha lidos (inodes podem ser reaproveitados)
+            nome = f"u{posicao['inode']}-{inicio}-{hashlib.sha1(json.dumps(entradas[0]).encode('utf-8')).hexdigest()[:8]}"
+            gravar_particoes(linhas_uso(entradas, blobs), pasta, 'usage', nome, formato)
+            resultado['usage_rows'] = len(entradas)
+        estado['usage'] = posicao
+
+        if historico is not None:
+            registros = list(historico.iter_rows(estado['history_id']))
+            if registros:
+                gravar_particoes(linhas_historico(registros, blobs), pasta, 'history', f"h{registros[0]['id']:012d}", formato)
+                estado['history_id'] = registros[-1]['id']
+                resultado['history_rows'] = len(registros)
+
+        # O estado só avança depois que as partes foram gravadas: uma exportação interrompida é
+        # refeita do mesmo ponto e regrava as mesmas partes
+        gravar_estado(pasta, estado)
+
+        if rollups is not None:
+            agregados = rollups.consultar('hour')
+            for agregado in agregados:
+                for coluna, valor in zip(COLUNAS_HISTOGRAMA, agregado.pop('latency_histogram')):
+                    agregado[coluna] = valor
+            if agregados:
+                gravar_tabela(pa.Table.from_pylist(agregados), os.path.join(pasta, 'rollups', f"hour.{EXTENSOES[formato]}"), formato)
+            resultado['rollup_rows'] = len(agregados)
+
+        resultado['consolidated'] = consolidar_particoes(pasta, 'usage', formato, agora) + consolidar_particoes(pasta, 'history', formato, agora)
+        return resultado
+
+# Função para exportar no máximo uma vez por intervalo (chamada pelo gravador em segundo plano)
+def exportar_se_necessario(usage_log_path: str, historico=None, rollups=None, blobs=None, pasta: str = ANALYTICS_DIR,
+                           intervalo: float = ANALYTICS_EXPORT_INTERVAL, agora: Optional[float] = None) -> Optional[dict]:
+    agora = agora if agora is not None else time.time()
+    with _EXPORTACAO_LOCK:
+        if agora - _ULTIMA_EXPORTACAO.get(pasta, 0.0) < intervalo:
+            return None
+        _ULTIMA_EXPORTACAO[pasta] = agora
+    return exportar(usage_log_path, historico, rollups, blobs, pasta, agora=agora)
+
+# Função para listar os blobs citados pelas tabelas exportadas (colunas <campo>_blob), como
+# referências do repositório: a coleta de blobs não pode apagar textos que a exportação ainda cita
+def blob_refs_exportados(pasta: str = ANALYTICS_DIR, formato: str = ANALYTICS_FORMAT) -> set:
+    if not pyarrow_disponivel() or not os.path.isdir(pasta):
+        return set()
+    referencias = set()
+    with travar_exportacao(pasta):
+        for tabela, campos in (('usage', CAMPOS_TEXTO_USO), ('history', CAMPOS_TEXTO_HISTORICO)):
+            if not os.path.isdir(os.path.join(pasta, tabela)):
+                continue
+            colunas = [f"{campo}_blob" for campo in campos]
+            dados = carregar_exportacao(tabela, pasta, formato).to_table(columns=colunas)
+            for coluna in colunas:
+                referencias.update(BLOB_REF_PREFIX + valor for valor in dados.column(coluna).unique().to_pylist() if valor)
+    return referencias
+
+# Função para abrir uma tabela exportada como dataset do pyarrow (partições por dia como coluna 'date'),
+# para a análise ler só as colunas e os dias necessários
+def carregar_exportacao(tabela: str, pasta: str = ANALYTICS_DIR, formato: str = ANALYTICS_FORMAT):
+    _pyarrow()
+    import pyarrow.dataset as ds
+    caminho = os.path.join(pasta, tabela)
+    if tabela == 'rollups':
+        caminho = os.path.join(caminho, f"hour.{EXTENSOES[formato]}")
+        return ds.dataset(caminho, format='ipc' if formato == 'arrow' else 'parquet')
+    return ds.dataset(caminho, format='ipc' if formato == 'arrow' else 'parquet', partitioning='hive',
+                      exclude_invalid_files=True)
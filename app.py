@@ -1,18 +1,23 @@
 
 import streamlit as st
 import os
-import json
+import hashlib
+import uuid
 import PyPDF2
-import pandas as pd
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
 from langchain.chains import ConversationalRetrievalChain
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain.memory import ConversationBufferMemory
 from dotenv import load_dotenv
-from typing import Tuple
+from typing import Any, Iterator, List, Tuple
 from groq import Groq
+from embeddings import get_embedding_engine, get_ollama_embedding_client
+from retrieval import VECTOR_INDEX_MODE, HybridRetriever, get_reranker
+from vector_store import caminho_armazenamento
+from chunking import chunk_por_secoes
+from dedup import Deduplicador, deduplicar_passagens, formatar_relatorio
+from ingestion import criar_column_store, iterar_unidades_csv, iterar_unidades_json, responder_consulta_numerica
 
 # Configuração do layout da página Streamlit para ser "wide"
 st.set_page_config(layout="wide")
@@ -24,6 +29,12 @@ if not groq_api_key:
     st.error("GROQ_API_KEY não foi encontrado nas variáveis de ambiente. Por favor, configure-o no arquivo .env.")
     groq_api_key = st.text_input("Digite sua chave de API Groq:", type="password")
 
+# Backend de embeddings: "local" (sentence-transformers no processo) ou "ollama" (servidor HTTP)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'local')
+USE_RERANKER = os.getenv('USE_RERANKER', '0') == '1'
+REFERENCES_TOP_K = 6
+INDEX_BATCH_SIZE = 1000    # unidades enviadas ao índice por vez durante a ingestão
+
 # Dicionário de modelos e seus tokens máximos
 MODEL_MAX_TOKENS = {
     'mixtral-8x7b-32768': 32768,
@@ -40,49 +51,35 @@ def get_max_tokens(model_name: str) -> int:
 def refresh_page():
     st.rerun()
 
+# Função para montar a unidade indexada (o id é a fonte numerada, como nos metadados)
+def make_unit(i: int, name: str, text: str, metadata: dict) -> dict:
+    source = f"{i}-{name}"
+    return {'id': source, 'text': text, 'metadata': dict(metadata, source=source)}
+
 # Função para processar arquivos PDF
-def process_pdf_files(files):
-    texts = []
-    metadatas = []
+def process_pdf_files(files) -> Iterator[dict]:
     for file in files:
         pdf_reader = PyPDF2.PdfReader(file)
-        pdf_text = ""
-        for page in pdf_reader.pages:
-            pdf_text += page.extract_text()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=50)
-        file_texts = text_splitter.split_text(pdf_text)
-        texts.extend(file_texts)
-        file_metadatas = [{"source": f"{i}-{file.name}"} for i in range(len(file_texts))]
-        metadatas.extend(file_metadatas)
-    return texts, metadatas
-
-# Função para processar arquivos CSV
-def process_csv_files(files):
-    texts = []
-    metadatas = []
+        pages = [{'page': i + 1, 'text': page.extract_text() or ""} for i, page in enumerate(pdf_reader.pages)]
+        # Chunks por seção (Parte / Capítulo / n.n) com título e páginas nos metadados
+        for i, chunk in enumerate(chunk_por_secoes(pages, file.name)):
+            yield make_unit(i, file.name, chunk['text'], chunk['metadata'])
+
+# Função para processar arquivos CSV (leitura em blocos; números vão para o armazenamento colunar)
+def process_csv_files(files) -> Iterator[dict]:
+    column_stores = {}
+    st.session_state.column_stores = column_stores
+    sessao = st.session_state.setdefault('column_store_session', uuid.uuid4().hex)
     for file in files:
-        df = pd.read_csv(file)
-        csv_text = df.to_string()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=50)
-        file_texts = text_splitter.split_text(csv_text)
-        texts.extend(file_texts)
-        file_metadatas = [{"source": f"{i}-{file.name}"} for i in range(len(file_texts))]
-        metadatas.extend(file_metadatas)
-    return texts, metadatas
-
-# Função para processar arquivos JSON
-def process_json_files(files):
-    texts = []
-    metadatas = []
+        column_stores[file.name] = criar_column_store(file.name, sessao, hashlib.sha1(file.getvalue()).hexdigest())
+        for i, unit in enumerate(iterar_unidades_csv(file, file.name, column_store=column_stores[file.name])):
+            yield make_unit(i, file.name, unit['text'], unit['metadata'])
+
+# Função para processar arquivos JSON (leitura incremental, um registro por unidade)
+def process_json_files(files) -> Iterator[dict]:
     for file in files:
-        data = json.load(file)
-        json_text = json.dumps(data, indent=4)
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=50)
-        file_texts = text_splitter.split_text(json_text)
-        texts.extend(file_texts)
-        file_metadatas = [{"source": f"{i}-{file.name}"} for i in range(len(file_texts))]
-        metadatas.extend(file_metadatas)
-    return texts, metadatas
+        for i, unit in enumerate(iterar_unidades_json(file, file.name)):
+            yield make_unit(i, file.name, unit['text'], unit['metadata'])
 
 # Inicializar e configurar o modelo de chat
 def initialize_chat_model(model_name: str):
@@ -122,34 +119,74 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
         return ""
     return response
 
+# Adaptador do recuperador híbrido para a interface de retrievers do LangChain
+class HybridLangchainRetriever(BaseRetriever):
+    retriever: Any
+    k: int = REFERENCES_TOP_K
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return [Document(page_content=r['text'], metadata=r['metadata']) for r in self.retriever.search(query, self.k)]
+
+# Função para construir o recuperador híbrido (BM25 + vetorial) sobre as unidades dos arquivos.
+# As unidades chegam de um gerador e vão para o índice em lotes, sem acumular o conjunto inteiro.
+def build_retriever(units: Iterator[dict], embeddings, index_params=None) -> HybridRetriever:
+    reranker = get_reranker() if USE_RERANKER else None
+    retriever = HybridRetriever(embedder=embeddings, reranker=reranker, index_params=index_params)
+    # Edições repetidas e artigos sobrepostos viram um único chunk com várias citações
+    deduplicador = Deduplicador()
+    batch = []
+    for unit in units:
+        if deduplicador.adicionar(unit) is None:
+            batch.append(unit)
+        if len(batch) >= INDEX_BATCH_SIZE:
+            retriever.add_chunks(batch)
+            batch = []
+    retriever.add_chunks(batch)
+    st.session_state.dedup_report = dict(deduplicador.relatorio)
+    return retriever
+
+# Função para montar os parâmetros do índice vetorial: no modo 'mmap', cada sessão e cada conjunto
+# de arquivos (hash do conteúdo) têm a sua pasta de armazenamento
+def index_params_for(files) -> dict:
+    if VECTOR_INDEX_MODE != 'mmap':
+        return {}
+    conteudo = hashlib.sha1()
+    for file in files:
+        conteudo.update(hashlib.sha1(file.getvalue()).digest())
+    sessao = st.session_state.setdefault('column_store_session', uuid.uuid4().hex)
+    return {'path': caminho_armazenamento(sessao, conteudo.hexdigest()[:16])}
+
 # Função para tratar mensagens do usuário
-def handle_message(message: str, model_name: str, temperature: float, groq_api_key: str):
-    response = fetch_assistant_response(message, message, model_name, temperature, groq_api_key)
+def handle_message(message: str, model_name: str, temperature: float, groq_api_key: str, retriever: HybridRetriever = None):
+    user_prompt = message
+    if retriever is not None:
+        passages = deduplicar_passagens(retriever.search(message, REFERENCES_TOP_K))
+        references_context = "\n\n".join(
+            f"[{'; '.join(str(source.get('source')) for source in p['metadata']['sources'])}]\n{p['text']}"
+            for p in passages
+        )
+        user_prompt = f"{message}\n\nReferências:\n{references_context}"
+    # Perguntas numéricas sobre CSVs são respondidas por filtro no armazenamento colunar
+    for name, store in st.session_state.get('column_stores', {}).items():
+        try:
+            answer = responder_consulta_numerica(message, store)
+        except (ValueError, KeyError, OSError):
+            # Sem resultado calculado, a pergunta segue só com as referências para o modelo
+            answer = None
+        if answer:
+            user_prompt += f"\n\nResultado calculado em {name}: {answer}"
+    response = fetch_assistant_response(message, user_prompt, model_name, temperature, groq_api_key)
     return response
 
-# Processamento de arquivos
-def process_files(files):
-    texts, metadatas = [], []
+# Processamento de arquivos: gera as unidades de todos os arquivos, uma por vez
+def process_files(files) -> Iterator[dict]:
     pdf_files = [file for file in files if file.type == "application/pdf"]
     csv_files = [file for file in files if file.type == "text/csv"]
     json_files = [file for file in files if file.type == "application/json"]
 
-    if pdf_files:
-        pdf_texts, pdf_metadatas = process_pdf_files(pdf_files)
-        texts.extend(pdf_texts)
-        metadatas.extend(pdf_metadatas)
-
-    if csv_files:
-        csv_texts, csv_metadatas = process_csv_files(csv_files)
-        texts.extend(csv_texts)
-        metadatas.extend(csv_metadatas)
-
-    if json_files:
-        json_texts, json_metadatas = process_json_files(json_files)
-        texts.extend(json_texts)
-        metadatas.extend(json_metadatas)
-
-    return texts, metadatas
+    yield from process_pdf_files(pdf_files)
+    yield from process_csv_files(csv_files)
+    yield from process_json_files(json_files)
 
 # Inicialização do aplicativo
 def main():
@@ -159,11 +196,16 @@ def main():
     files = st.file_uploader("Envie arquivos", accept_multiple_files=True, type=["pdf", "csv", "json"])
 
     if files:
-        with st.spinner("Processando arquivos..."):
-            texts, metadatas = process_files(files)
-
-        embeddings = OllamaEmbeddings(model="nomic-embed-text")
-        docsearch = Chroma.from_texts(texts, embeddings, metadatas=metadatas)
+        files_key = tuple((file.name, file.size) for file in files)
+        if st.session_state.get('files_key') != files_key:
+            if EMBEDDING_BACKEND == "local":
+                embeddings = get_embedding_engine()
+            else:
+                embeddings = get_ollama_embedding_client(model_name="nomic-embed-text")
+            with st.spinner("Processando arquivos..."):
+                st.session_state.retriever = build_retriever(process_files(files), embeddings, index_params_for(files))
+            st.session_state.files_key = files_key
+        retriever = st.session_state.retriever
 
         message_history = ChatMessageHistory()
         memory = ConversationBufferMemory(
@@ -176,12 +218,14 @@ def main():
         chain = ConversationalRetrievalChain.from_llm(
             llm=initialize_chat_model("llama3-70b-8192"),
             chain_type="stuff",
-            retriever=docsearch.as_retriever(),
+            retriever=HybridLangchainRetriever(retriever=retriever),
             memory=memory,
             return_source_documents=True,
         )
 
         st.success("Processamento de arquivos concluído. Você já pode fazer perguntas!")
+        if st.session_state.get('dedup_report'):
+            st.info(f"Deduplicação: {formatar_relatorio(st.session_state.dedup_report)}")
 
         if 'chat_history' not in st.session_state:
             st.session_state.chat_history = []
@@ -189,7 +233,7 @@ def main():
         user_input = st.text_input("Digite sua pergunta:")
 
         if st.button("Enviar"):
-            response = handle_message(user_input, "llama3-70b-8192", 0.2, groq_api_key)
+            response = handle_message(user_input, "llama3-70b-8192", 0.2, groq_api_key, retriever)
             st.session_state.chat_history.append({"role": "user", "content": user_input})
             st.session_state.chat_history.append({"role": "assistant", "content": response})
 
@@ -11,6 +11,8 @@ import seaborn as sns
 from groq import Groq
 from gtts import gTTS  # Importação adicionada para vocalização
 import tempfile        # Importação adicionada para manuseio de arquivos temporários
+from chat_store import DEFAULT_SESSION, REFERENCE_RESPONSE, get_chat_store, hash_entrada
+from blob_store import BLOB_STORE_DB, get_blob_store
 # Configurações da página do Streamlit
 st.set_page_config(
     page_title="Consultor de PDFs + IA",
@@ -20,7 +22,8 @@ st.set_page_config(
 
 # Definição de constantes
 FILEPATH = "agents.json"
-CHAT_HISTORY_FILE = 'chat_history.json'
+CHAT_HISTORY_FILE = 'chat_history.db'
+LEGACY_CHAT_HISTORY_FILE = 'chat_history.json'
 API_USAGE_FILE = 'api_usage.json'
 
 MODEL_MAX_TOKENS = {
@@ -146,41 +149,22 @@ def log_api_usage(action: str, interaction_number: int, tokens_used: int, time_t
     else:
         with open(API_USAGE_FILE, 'w') as file:
             json.dump([entry], file, indent=4)
+# Função para abrir o histórico do chat. O banco é o mesmo do run.py: os textos grandes ficam no
+# mesmo repositório de blobs e são lidos por ele; este app usa só a sessão padrão
+def obter_historico(chat_history_file=CHAT_HISTORY_FILE):
+    return get_chat_store(chat_history_file, LEGACY_CHAT_HISTORY_FILE, blobs=get_blob_store(BLOB_STORE_DB))
+
 # Função para salvar o histórico do chat
 def save_chat_history(user_input, user_prompt, expert_response, chat_history_file=CHAT_HISTORY_FILE):
-    chat_entry = {
-        'user_input': user_input,
-        'user_prompt': user_prompt,
-        'expert_response': expert_response
-    }
-    if os.path.exists(chat_history_file):
-        with open(chat_history_file, 'r+') as file:
-            try:
-                chat_history = json.load(file)
-            except json.JSONDecodeError:
-                chat_history = []
-            chat_history.append(chat_entry)
-            file.seek(0)
-            json.dump(chat_history, file, indent=4)
-    else:
-        with open(chat_history_file, 'w') as file:
-            json.dump([chat_entry], file, indent=4)
+    obter_historico(chat_history_file).save(user_input, user_prompt, expert_response, DEFAULT_SESSION)
 
-# Função para carregar o histórico do chat
-def load_chat_history(chat_history_file=CHAT_HISTORY_FILE):
-    if os.path.exists(chat_history_file):
-        with open(chat_history_file, 'r') as file:
-            try:
-                chat_history = json.load(file)
-            except json.JSONDecodeError:
-                chat_history = []
-        return chat_history
-    return []
+# Função para carregar as últimas interações do histórico do chat
+def load_chat_history(limit, chat_history_file=CHAT_HISTORY_FILE):
+    return obter_historico(chat_history_file).last(limit, DEFAULT_SESSION)
 
-# Função para limpar o histórico do chat
+# Função para limpar o histórico do chat (só a sessão deste app, não as sessões do run.py)
 def clear_chat_history(chat_history_file=CHAT_HISTORY_FILE):
-    if os.path.exists(chat_history_file):
-        os.remove(chat_history_file)
+    obter_historico(chat_history_file).clear(DEFAULT_SESSION)
 
 # Função para carregar o uso da API
 def load_api_usage():
@@ -495,7 +479,7 @@ with col2:
     container_saida = st.container()
 
     # Carregar o histórico do chat limitado ao número de interações selecionadas
-    chat_history = load_chat_history()[-memory_selection:]
+    chat_history = load_chat_history(memory_selection)
 
     if fetch_clicked:
         if references_file:
@@ -622,33 +606,30 @@ def carregar_referencias():
     else:
         return pd.DataFrame()
 
+# Registra cada página de referência uma única vez no histórico, numa só transação
 def referencias_para_historico(df_referencias, chat_history_file=CHAT_HISTORY_FILE):
-    if not df_referencias.empty:
-        for _, row in df_referencias.iterrows():
-            titulo = row.get('titulo', row['Text'][:50] + '...')
-            autor = row.get('autor', 'Autor Desconhecido')
-            ano = row.get('ano', 'Ano Desconhecido')
-            paginas = row.get('Page', 'Página Desconhecida')
-
-            chat_entry = {
-                'user_input': f"Título: {titulo}",
-                'user_prompt': f"Autor: {autor}\nAno: {ano}\nPágina: {paginas}\nTexto: {row['Text']}",
-                'expert_response': 'Informação adicionada ao histórico de chat como referência.'
-            }
-
-            if os.path.exists(chat_history_file):
-                with open(chat_history_file, 'r+') as file:
-                    try:
-                        chat_history = json.load(file)
-                    except json.JSONDecodeError:
-                        chat_history = []
-                    chat_history.append(chat_entry)
-                    file.seek(0)
-                    json.dump(chat_history, file, indent=4)
-            else:
-                with open(chat_history_file, 'w') as file:
-                    json.dump([chat_entry], file, indent=4)
-
-# Atualizar o histórico com referências
-df_referencias = carregar_referencias()
-referencias_para_historico(df_referencias)
+    if df_referencias.empty:
+        return 0
+    entradas = []
+    for _, row in df_referencias.iterrows():
+        titulo = row.get('titulo', row['Text'][:50] + '...')
+        autor = row.get('autor', 'Autor Desconhecido')
+        ano = row.get('ano', 'Ano Desconhecido')
+        paginas = row.get('Page', 'Página Desconhecida')
+
+        entrada = {
+            'user_input': f"Título: {titulo}",
+            'user_prompt': f"Autor: {autor}\nAno: {ano}\nPágina: {paginas}\nTexto: {row['Text']}",
+            'expert_response': REFERENCE_RESPONSE
+        }
+        entrada['content_hash'] = hash_entrada(entrada['user_input'], entrada['user_prompt'], entrada['expert_response'])
+        entradas.append(entrada)
+    return obter_historico(chat_history_file).save_many(entradas, DEFAULT_SESSION)
+
+# Atualizar o histórico com referências (só quando o references.csv muda)
+if os.path.exists('references.csv'):
+    estado_referencias = os.stat('references.csv')
+    assinatura_referencias = (estado_referencias.st_mtime_ns, estado_referencias.st_size)
+    if st.session_state.get('references_synced') != assinatura_referencias:
+        referencias_para_historico(carregar_referencias())
+        st.session_state.references_synced = assinatura_referencias
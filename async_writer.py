@@ -0,0 +1,292 @@
+import os
+import json
+import atexit
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Definição de constantes
+WRITER_QUEUE_SIZE = 10000
+WRITER_BATCH_SIZE = 64
+WRITER_FLUSH_INTERVAL = 0.2    # segundos máximos entre a chegada de um registro e a gravação do lote
+LATENCY_WINDOW = 256           # gravações consideradas nas métricas de latência
+WRITER_MAX_RETRIES = 3         # novas tentativas de um lote que falhou, com espera crescente
+WRITER_RETRY_BACKOFF = 0.5     # segundos antes da primeira nova tentativa (dobra a cada falha)
+WRITER_CLOSE_TIMEOUT = 10.0    # segundos máximos de espera no encerramento
+# Lotes que falharam em todas as tentativas são gravados aqui (um JSON Lines por destino) e
+# reenviados uma vez por processo, quando o destino é registrado
+WRITER_SPILL_DIR = os.getenv('WRITER_SPILL_DIR', 'gravacoes_pendentes')
+WRITER_MAX_SPILLS = 3          # reenvios de um registro antes de ir para o arquivo de descartados (<destino>.dead.jsonl)
+
+logger = logging.getLogger(__name__)
+
+_FIM = object()
+
+# Gravadores em execução neste processo
+_GRAVADORES = {}
+_GRAVADORES_LOCK = threading.Lock()
+
+# Gravador em segundo plano. O script só enfileira registros (submit); uma thread agrupa os
+# registros por destino e chama a função de gravação do destino com o lote inteiro, quando o
+# lote enche ou quando o registro mais antigo espera flush_interval segundos.
+class AsyncWriter:
+    def __init__(self, max_queue: int = WRITER_QUEUE_SIZE, batch_size: int = WRITER_BATCH_SIZE,
+                 flush_interval: float = WRITER_FLUSH_INTERVAL, spill_dir: str = WRITER_SPILL_DIR,
+                 max_retries: int = WRITER_MAX_RETRIES, retry_backoff: float = WRITER_RETRY_BACKOFF):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.fila: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.destinos: Dict[str, Callable[[List], object]] = {}
+        self.em_espera: Dict[int, tuple] = {}
+        self.gravados = 0
+        self.lotes = 0
+        self.erros = 0
+        self.bloqueios = 0
+        self.derramados = 0
+        self.descartados = 0
+        self.ultimo_erro: Optional[str] = None
+        self.latencias = collections.deque(maxlen=LATENCY_WINDOW)
+        self.reenvios: Dict[int, int] = {}
+        self._reenviados = set()
+        self._sequencia = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._executar, name='async-writer', daemon=True)
+        self._thread.start()
+
+    # Registra (ou substitui) a função que grava um lote de registros de um destino. Na primeira vez
+    # em que o destino é registrado no processo, reenvia os registros que uma execução anterior não
+    # conseguiu gravar
+    def register(self, destino: str, gravar_lote: Callable[[List], object]):
+        self.destinos[destino] = gravar_lote
+        with self._lock:
+            if destino in self._reenviados:
+                return
+            self._reenviados.add(destino)
+        self._reenviar_derramados(destino)
+
+    def _arquivo_derramado(self, destino: str) -> str:
+        return os.path.join(self.spill_dir, f"{destino}.jsonl")
+
+    def _arquivo_descartados(self, destino: str) -> str:
+        return os.path.join(self.spill_dir, f"{destino}.dead.jsonl")
+
+    @staticmethod
+    def _anexar_linhas(caminho: str, linhas: List[dict]):
+        with open(caminho, 'a', encoding='utf-8') as file:
+            file.write("".join(json.dumps(linha, ensure_ascii=False, default=str) + "\n" for linha in linhas))
+            file.flush()
+            os.fsync(file.fileno())
+
+    # Grava registros que não puderam ser gravados no destino, para não perdê-los. Cada registro
+    # leva o número de vezes em que já foi guardado; passado WRITER_MAX_SPILLS, a falha é tratada
+    # como permanente e o registro vai para o arquivo de descartados, fora dos reenvios
+    def _derramar(self, destino: str, itens: List[tuple]):
+        pendentes, descartados = [], []
+        for registro, reenvios in itens:
+            linha = {'reenvios': reenvios + 1, 'registro': registro}
+            (descartados if reenvios + 1 > WRITER_MAX_SPILLS else pendentes).append(linha)
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            if pendentes:
+                self._anexar_linhas(self._arquivo_derramado(destino), pendentes)
+                self.derramados += len(pendentes)
+            if descartados:
+                self._anexar_linhas(self._arquivo_descartados(destino), descartados)
+                self.descartados += len(descartados)
+                logger.error("%d registros de %s descartados após %d reenvios; ver %s",
+                             len(descartados), destino, WRITER_MAX_SPILLS, self._arquivo_descartados(destino))
+        except OSError:
+            logger.exception("Falha ao guardar %d registros de %s em %s", len(itens), destino, self.spill_dir)
+
+    def _reenviar_derramados(self, destino: str):
+        caminho = self._arquivo_derramado(destino)
+        # O arquivo é renomeado antes da leitura: se os registros falharem de novo, voltam para um
+        # arquivo novo. Outro processo pode ter pegado o arquivo antes (FileNotFoundError)
+        reenvio = f"{caminho}.{os.getpid()}.retry"
+        try:
+            os.replace(caminho, reenvio)
+        except FileNotFoundError:
+            return
+        itens = []
+        with open(reenvio, 'r', encoding='utf-8') as file:
+            for linha in file:
+                if not linha.strip():
+                    continue
+                try:
+                    dados = json.loads(linha)
+                except ValueError:
+                    logger.warning("Linha inválida ignorada em %s", caminho)
+                    continue
+                if isinstance(dados, dict) and set(dados) == {'reenvios', 'registro'}:
+                    itens.append((dados['registro'], dados['reenvios']))
+                else:
+                    itens.append((dados, 1))
+        for registro, reenvios in itens:
+            self._enfileirar(destino, registro, reenvios)
+        os.remove(reenvio)
+
+    def submit(self, destino: str, registro):
+        self._enfileirar(destino, registro, 0)
+
+    def _enfileirar(self, destino: str, registro, reenvios: int):
+        if destino not in self.destinos:
+            raise KeyError(f"Destino de gravação não registrado: {destino}")
+        sequencia = next(self._sequencia)
+        with self._lock:
+            self.em_espera[sequencia] = (destino, registro)
+            if reenvios:
+                self.reenvios[sequencia] = reenvios
+        try:
+            self.fila.put_nowait((sequencia, destino, registro))
+        except queue.Full:
+            # Fila cheia: o disco não acompanha a taxa de gravação; espera (contra-pressão) em vez de perder dados
+            self.bloqueios += 1
+            self.fila.put((sequencia, destino, registro))
+
+    # Registros de um destino ainda não gravados, na ordem de chegada (para leituras logo após a gravação)
+    def pendentes(self, destino: str) -> List:
+        with self._lock:
+            return [registro for _, (nome, registro) in sorted(self.em_espera.items()) if nome == destino]
+
+    def _gravar(self, lote: List[tuple]):
+        grupos: Dict[str, List[tuple]] = {}
+        for item in lote:
+            grupos.setdefault(item[1], []).append(item)
+        for destino, itens in grupos.items():
+            inicio = time.perf_counter()
+            registros = [registro for _, _, registro in itens]
+            # Um lote que falha é tentado de novo algumas vezes (falhas passageiras, como o banco
+            # travado por outro processo); se continuar falhando, vai para o arquivo de pendentes
+            for tentativa in range(self.max_retries + 1):
+                try:
+                    self.destinos[destino](registros)
+                    self.gravados += len(itens)
+                    break
+                except Exception as e:
+                    self.erros += 1
+                    self.ultimo_erro = f"{destino}: {e}"
+                    logger.exception("Falha ao gravar %d registros em %s (tentativa %d)", len(itens), destino, tentativa + 1)
+                    if tentativa < self.max_retries:
+                        time.sleep(self.retry_backoff * 2 ** tentativa)
+            else:
+                with self._lock:
+                    contagens = [self.reenvios.get(sequencia, 0) for sequencia, _, _ in itens]
+                self._derramar(destino, list(zip(registros, contagens)))
+            self.latencias.append(time.perf_counter() - inicio)
+            self.lotes += 1
+            with self._lock:
+                for sequencia, _, _ in itens:
+                    self.em_espera.pop(sequencia, None)
+                    self.reenvios.pop(sequencia, None)
+
+    def _executar(self):
+        encerrar = False
+        while not encerrar:
+            item = self.fila.get()
+            if item is _FIM:
+                self.fila.task_done()
+                break
+            lote = [item]
+            prazo = time.monotonic() + self.flush_interval
+            while len(lote) < self.batch_size:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    item = self.fila.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if item is _FIM:
+                    self.fila.task_done()
+                    encerrar = True
+                    break
+                lote.append(item)
+            self._gravar(lote)
+            for _ in lote:
+                self.fila.task_done()
+        # Encerramento: grava o que ainda estiver na fila
+        resto = []
+        while True:
+            try:
+                item = self.fila.get_nowait()
+            except queue.Empty:
+                break
+            self.fila.task_done()
+            if item is not _FIM:
+                resto.append(item)
+        for inicio in range(0, len(resto), self.batch_size):
+            self._gravar(resto[inicio:inicio + self.batch_size])
+
+    # Bloqueia até a fila esvaziar (usado no encerramento e em scripts, nunca no caminho da requisição)
+    def flush(self):
+        self.fila.join()
+
+    # Tira da fila o que não foi gravado e guarda no arquivo de pendentes
+    def _derramar_fila(self):
+        grupos: Dict[str, List] = {}
+        while True:
+            try:
+                item = self.fila.get_nowait()
+            except queue.Empty:
+                break
+            self.fila.task_done()
+            if item is not _FIM:
+                with self._lock:
+                    reenvios = self.reenvios.pop(item[0], 0)
+                grupos.setdefault(item[1], []).append((item[2], reenvios))
+        for destino, registros in grupos.items():
+            self._derramar(destino, registros)
+
+    # Encerramento com prazo: se a fila não esvaziar (destino travado), os registros restantes vão
+    # para o arquivo de pendentes em vez de prender o processo
+    def close(self, timeout: float = WRITER_CLOSE_TIMEOUT):
+        if not self._thread.is_alive():
+            return
+        try:
+            self.fila.put(_FIM, timeout=timeout)
+        except queue.Full:
+            self._derramar_fila()
+            try:
+                self.fila.put_nowait(_FIM)
+            except queue.Full:
+                pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Gravador não terminou em %.1f s; registros na fila guardados em %s", timeout, self.spill_dir)
+            self._derramar_fila()
+
+    def metrics(self) -> dict:
+        latencias = np.array(self.latencias) * 1000 if self.latencias else np.zeros(1)
+        return {
+            'queue_depth': self.fila.qsize(),
+            'max_queue': self.fila.maxsize,
+            'written': self.gravados,
+            'batches': self.lotes,
+            'errors': self.erros,
+            'last_error': self.ultimo_erro,
+            'blocked_submits': self.bloqueios,
+            'spilled': self.derramados,
+            'dead_lettered': self.descartados,
+            'flush_ms_last': float(latencias[-1]),
+            'flush_ms_p50': float(np.percentile(latencias, 50)),
+            'flush_ms_p95': float(np.percentile(latencias, 95)),
+        }
+
+# Função para obter o gravador compartilhado do processo (esvaziado ao encerrar o processo)
+def get_async_writer(nome: str = 'default') -> AsyncWriter:
+    with _GRAVADORES_LOCK:
+        gravador = _GRAVADORES.get(nome)
+        if gravador is None:
+            gravador = AsyncWriter()
+            atexit.register(gravador.close)
+            _GRAVADORES[nome] = gravador
+        return gravador
@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics_export import carregar_exportacao, exportar
+from usage_log import UsageLog
+
+# Entradas de uso espalhadas por vários dias, com prompt e resposta inline
+def gerar_entradas(quantidade: int, dias: int, tamanho_texto: int) -> list:
+    inicio = time.time() - dias * 86400
+    return [
+        {'action': ('fetch', 'refine', 'evaluate')[i % 3], 'interaction_number': i, 'tokens_used': 1000 + i % 500,
+         'time_taken': 1.5 + i % 7, 'user_input': 'pergunta ' * 20, 'user_prompt': 'p' * tamanho_texto,
+         'api_response': 'x' * tamanho_texto, 'agent_used': 'Especialista', 'agent_description': '',
+         'model': 'llama3-70b-8192', 'session_id': f"s{i % 50}", 'timestamp': inicio + i * dias * 86400 / quantidade}
+        for i in range(quantidade)
+    ]
+
+def medir(funcao, repeticoes: int) -> dict:
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return {'p50_ms': float(np.percentile(tempos, 50) * 1000), 'p95_ms': float(np.percentile(tempos, 95) * 1000)}
+
+# Tokens e latência média por dia e ação: a partir do log JSONL inteiro e a partir da exportação colunar
+def run(quantidade: int, dias: int, tamanho_texto: int, repeticoes: int) -> dict:
+    pasta = tempfile.mkdtemp(prefix='analytics_')
+    caminho_log = os.path.join(pasta, 'api_usage.jsonl')
+    log = UsageLog(caminho_log)
+    log.append_many(gerar_entradas(quantidade, dias, tamanho_texto))
+    log.close()
+    destino = os.path.join(pasta, 'analytics')
+    inicio = time.perf_counter()
+    exportar(caminho_log, pasta=destino, agora=time.time() + 86400)
+    tempo_exportacao = time.perf_counter() - inicio
+
+    def pelo_log():
+        with open(caminho_log, 'rb') as file:
+            df = pd.DataFrame([json.loads(linha) for linha in file])
+        df['date'] = pd.to_datetime(df['timestamp'], unit='s').dt.strftime('%Y-%m-%d')
+        return df.groupby(['date', 'action']).agg(tokens=('tokens_used', 'sum'), latencia=('time_taken', 'mean'))
+
+    def pela_exportacao():
+        df = carregar_exportacao('usage', destino).to_table(columns=['date', 'action', 'tokens_used', 'time_taken']).to_pandas()
+        return df.groupby(['date', 'action']).agg(tokens=('tokens_used', 'sum'), latencia=('time_taken', 'mean'))
+
+    tamanho_exportacao = sum(os.path.getsize(os.path.join(raiz, nome)) for raiz, _, nomes in os.walk(destino) for nome in nomes)
+    return {
+        'entries': quantidade, 'days': dias,
+        'jsonl_bytes': os.path.getsize(caminho_log), 'export_bytes': tamanho_exportacao,
+        'export_s': tempo_exportacao,
+        'jsonl_scan': medir(pelo_log, repeticoes),
+        'columnar_scan': medir(pela_exportacao, repeticoes),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Consulta analítica pelo log JSONL versus pela exportação colunar.')
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--text-chars', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.entries, args.days, args.text_chars, args.repeats), indent=4))
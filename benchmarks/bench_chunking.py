@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunking import chunk_por_secoes, identificar_secoes
+
+# Versão original de identificar_secoes (re.match sem compilar e concatenação com +=), usada como linha de base
+def identificar_secoes_original(texto, secao_inicial):
+    secoes = {}
+    secao_atual = secao_inicial
+    secoes[secao_atual] = ""
+
+    paragrafos = texto.split('\n')
+    for paragrafo in paragrafos:
+        match = re.match(r'Parte \d+\.', paragrafo) or re.match(r'Capítulo \d+: .*', paragrafo) or re.match(r'\d+\.\d+ .*', paragrafo)
+        if match:
+            secao_atual = match.group()
+            secoes[secao_atual] = ""
+        else:
+            secoes[secao_atual] += paragrafo + "\n"
+
+    return secoes
+
+PALAVRAS = (
+    "a célula eucariótica apresenta membrana plasmática organelas núcleo citoplasma mitocôndria "
+    "fotossíntese cloroplasto energia metabolismo enzima proteína síntese transporte ativo difusão "
+    "osmose equilíbrio reação química ácido base solução concentração molaridade lei artigo norma"
+).split()
+
+# Gera um livro sintético com Partes, Capítulos e subseções n.n, página a página
+def gerar_livro(paginas: int, linhas_por_pagina: int = 40, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    texto_paginas = []
+    parte, capitulo, secao = 0, 0, 0
+    for pagina in range(1, paginas + 1):
+        linhas = []
+        if pagina % 200 == 1:
+            parte += 1
+            linhas.append(f"Parte {parte}. Tópicos avançados")
+        if pagina % 20 == 1:
+            capitulo += 1
+            secao = 0
+            linhas.append(f"Capítulo {capitulo}: Assunto {capitulo}")
+        for _ in range(linhas_por_pagina):
+            if rng.random() < 0.02:
+                secao += 1
+                linhas.append(f"{capitulo}.{secao} Subseção {secao}")
+            linhas.append(" ".join(rng.choice(PALAVRAS) for _ in range(14)) + ".")
+        texto_paginas.append({'page': pagina, 'text': "\n".join(linhas)})
+    return texto_paginas
+
+def medir(funcao, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcao(*args, **kwargs)
+    return time.perf_counter() - inicio, resultado
+
+def run(paginas: int, max_tokens: int) -> dict:
+    texto_paginas = gerar_livro(paginas)
+    texto = "\n".join(entrada['text'] for entrada in texto_paginas)
+    resultados = {'pages': paginas, 'characters': len(texto)}
+
+    tempo, secoes = medir(identificar_secoes_original, texto, "Introdução")
+    resultados['identificar_secoes_original'] = {'seconds': tempo, 'sections': len(secoes)}
+    tempo, secoes_novas = medir(identificar_secoes, texto, "Introdução")
+    resultados['identificar_secoes'] = {'seconds': tempo, 'sections': len(secoes_novas)}
+    assert secoes == secoes_novas
+
+    tempo, chunks = medir(chunk_por_secoes, texto_paginas, "livro.pdf", max_tokens=max_tokens)
+    resultados['chunk_por_secoes'] = {'seconds': tempo, 'chunks': len(chunks)}
+
+    try:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+    except ImportError:
+        try:
+            from langchain_text_splitters import RecursiveCharacterTextSplitter
+        except ImportError:
+            RecursiveCharacterTextSplitter = None
+    if RecursiveCharacterTextSplitter is not None:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=50)
+        tempo, pedacos = medir(splitter.split_text, texto)
+        # Pedaços que misturam o fim de uma seção com o início de outra
+        cruzando = sum(1 for pedaco in pedacos if any(re.match(r'Capítulo \d+: |\d+\.\d+ ', linha) for linha in pedaco.split('\n')[1:]))
+        resultados['recursive_character_splitter'] = {'seconds': tempo, 'chunks': len(pedacos), 'chunks_crossing_sections': cruzando}
+    else:
+        resultados['recursive_character_splitter'] = 'langchain não instalado'
+    return resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark do chunker por seções contra o divisor de 1200 caracteres.')
+    parser.add_argument('--pages', type=int, default=3000)
+    parser.add_argument('--max-tokens', type=int, default=300)
+    args = parser.parse_args()
+    print(json.dumps(run(args.pages, args.max_tokens), indent=4, ensure_ascii=False))
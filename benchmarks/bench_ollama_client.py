@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embeddings import OllamaEmbeddingClient
+
+# Servidor stub compatível com a API de embeddings do Ollama.
+# Cada requisição custa uma latência fixa (ida e volta) mais um custo por texto (modelo).
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    round_trip_seconds = 0.02
+    per_text_seconds = 0.0005
+    dimension = 768
+    fail_every = 0
+    request_count = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _vector(self, text: str) -> list:
+        seed = sum(text.encode('utf-8')) % 997
+        return [((seed * (i + 1)) % 101) / 101.0 for i in range(self.dimension)]
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with StubOllamaHandler.lock:
+            StubOllamaHandler.request_count += 1
+            count = StubOllamaHandler.request_count
+        if self.fail_every and count % self.fail_every == 0:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path == '/api/embed':
+            texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+            payload = {'model': body['model'], 'embeddings': [self._vector(text) for text in texts]}
+        elif self.path == '/api/embeddings':
+            texts = [body['prompt']]
+            payload = {'embedding': self._vector(body['prompt'])}
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        time.sleep(self.round_trip_seconds + self.per_text_seconds * len(texts))
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(chunks: int, batch_size: int, concurrency: int, fail_every: int) -> dict:
+    StubOllamaHandler.fail_every = fail_every
+    server = start_stub_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    texts = [f"Trecho {i} do corpus de referência com algum conteúdo para embutir." for i in range(chunks)]
+    results = {}
+    try:
+        for name, size, workers in (('serial', 1, 1), ('batched', batch_size, 1), ('pipelined', batch_size, concurrency)):
+            client = OllamaEmbeddingClient(base_url=base_url, cache=None, batch_size=size, concurrency=workers)
+            start_time = time.time()
+            vectors = client.encode(texts)
+            elapsed = time.time() - start_time
+            client.close()
+            assert vectors.shape[0] == chunks
+            results[name] = dict(client.metrics(), wall_seconds=elapsed)
+    finally:
+        server.shutdown()
+    # Limite inferior imposto pelo servidor: tempo de modelo de todos os textos
+    results['server_bound_seconds'] = StubOllamaHandler.per_text_seconds * chunks
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark do cliente de embeddings Ollama contra um servidor stub.')
+    parser.add_argument('--chunks', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--fail-every', type=int, default=0, help='Faz o stub falhar a cada N requisições.')
+    args = parser.parse_args()
+    print(json.dumps(run(args.chunks, args.batch_size, args.concurrency, args.fail_every), indent=4))
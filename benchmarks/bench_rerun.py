@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from counters import Counters, escopo_sessao
+from usage_log import UsageLog, UsageLogReader
+
+# Entrada de uso com o tamanho típico de uma chamada (prompt e resposta inline)
+def entrada_uso(i: int, tamanho_texto: int) -> dict:
+    return {
+        'action': ('fetch', 'refine', 'evaluate')[i % 3], 'interaction_number': i, 'tokens_used': 1000 + i % 500,
+        'time_taken': 1.5, 'user_input': 'pergunta ' * 20, 'user_prompt': '', 'api_response': 'x' * tamanho_texto,
+        'agent_used': 'Especialista', 'agent_description': '', 'session_id': 'default', 'timestamp': time.time(),
+    }
+
+def medir(funcao, repeticoes: int) -> dict:
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return {'p50_ms': float(np.percentile(tempos, 50) * 1000), 'p95_ms': float(np.percentile(tempos, 95) * 1000)}
+
+# Custo, por execução do script, de obter o número da próxima interação
+def run(tamanhos: list, tamanho_texto: int, repeticoes: int) -> dict:
+    resultados = {}
+    for quantidade in tamanhos:
+        pasta = tempfile.mkdtemp(prefix='rerun_')
+        entradas = [entrada_uso(i, tamanho_texto) for i in range(quantidade)]
+        legado = os.path.join(pasta, 'api_usage.json')
+        with open(legado, 'w') as file:
+            json.dump(entradas, file, indent=4)
+        log = UsageLog(os.path.join(pasta, 'api_usage.jsonl'))
+        log.append_many(entradas)
+        log.close()
+        contadores = Counters(os.path.join(pasta, 'counters.db'))
+        contadores.initialize(escopo_sessao('default'), quantidade)
+
+        def antes():
+            with open(legado, 'r') as file:
+                return len(json.load(file)) + 1
+
+        leitor = UsageLogReader(log.path)
+        leitor.read('default')
+        resultados[quantidade] = {
+            'json_array_len': medir(antes, repeticoes),
+            # Leitor novo (processo recém-iniciado): interpreta o log inteiro uma vez
+            'jsonl_reader_cold': medir(lambda: len(UsageLogReader(log.path).read('default')) + 1, repeticoes),
+            'jsonl_reader_warm': medir(lambda: len(leitor.read('default')) + 1, repeticoes),
+            'counter': medir(lambda: contadores.get(escopo_sessao('default')) + 1, repeticoes),
+        }
+    return resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latência por execução do script para obter o número da interação.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--text-chars', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(run(args.sizes, args.text_chars, args.repeats), indent=4))
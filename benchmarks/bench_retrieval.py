@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import HybridRetriever, VectorIndex, get_reranker
+
+SILABAS = "ba be bi bo bu ca co cu da de di do fa fe fi ga go gu la le li lo lu ma me mi mo mu na ne ni no pa pe pi po ra re ri ro sa se si so ta te ti to va ve vi xa xi za zu".split()
+OCEANOS = ["Atlântico", "Pacífico", "Índico"]
+ASSUNTOS = ["licitações e contratos administrativos", "proteção de dados pessoais", "resíduos sólidos urbanos",
+            "acessibilidade em prédios públicos", "segurança de barragens", "transporte escolar rural",
+            "uso de agrotóxicos", "concessão de bolsas de pesquisa", "saneamento básico", "incentivo à cultura"]
+ALIMENTOS = ["sementes", "insetos", "pequenos peixes", "frutos maduros", "folhas jovens", "néctar", "crustáceos"]
+TIPOS = ["ave", "rã", "borboleta", "serpente", "orquídea", "bromélia", "lagartixa"]
+REGIOES = ["Caatinga", "Mata Atlântica", "Cerrado", "Pantanal", "Amazônia", "Pampa"]
+ORGANELAS = ["citoplasma", "núcleo", "mitocôndria", "cloroplasto", "retículo endoplasmático", "complexo de Golgi"]
+SUBSTRATOS = ["glicose", "piruvato", "lactato", "citrato", "malato", "ureia", "frutose", "glicerol", "etanol"]
+CULTURAS = ["arroz", "feijão", "milho", "cana-de-açúcar", "banana", "café"]
+RUIDO = ("O relatório anual descreve as atividades do período e apresenta indicadores gerais de desempenho. "
+         "As informações foram consolidadas a partir de fontes secundárias e revisadas pela equipe técnica. ")
+
+def nome(rng: random.Random, silabas: int = 3) -> str:
+    return "".join(rng.choice(SILABAS) for _ in range(silabas)).capitalize()
+
+# Gera um corpus em português com pares pergunta -> passagem rotulados. Cada entidade tem três
+# passagens (uma por fato), então o nome sozinho não basta: metade das perguntas repete os termos
+# da passagem (favorece a busca esparsa) e metade é paráfrase (favorece a busca densa).
+def gerar_corpus(entidades: int = 300, seed: int = 11) -> dict:
+    rng = random.Random(seed)
+    passagens, perguntas, usados = [], [], set()
+    for i in range(entidades):
+        while True:
+            chave = nome(rng)
+            if chave not in usados:
+                usados.add(chave)
+                break
+        tipo = i % 4
+        if tipo == 0:
+            fatos = [
+                (f"O rio {chave} nasce na serra de {nome(rng)} e percorre cerca de {rng.randint(80, 3000)} quilômetros "
+                 f"até desaguar no oceano {rng.choice(OCEANOS)}.",
+                 f"Quantos quilômetros percorre o rio {chave} até o oceano?",
+                 f"Qual é a extensão do {chave} desde a nascente até a foz?"),
+                (f"A bacia do rio {chave} abastece {rng.randint(3, 90)} municípios e sofre com o assoreamento das margens.",
+                 f"Quantos municípios a bacia do rio {chave} abastece?",
+                 f"Quantas cidades dependem da água do {chave}?"),
+                (f"As águas do rio {chave} são usadas na irrigação de lavouras de {rng.choice(CULTURAS)} no período seco.",
+                 f"Que lavouras são irrigadas com as águas do rio {chave}?",
+                 f"Qual plantação agrícola é molhada com água do {chave} durante a estiagem?"),
+            ]
+        elif tipo == 1:
+            numero, ano = rng.randint(1000, 15000), rng.randint(1988, 2023)
+            fatos = [
+                (f"A Lei {chave} (Lei nº {numero}/{ano}) dispõe sobre {rng.choice(ASSUNTOS)}.",
+                 f"Sobre o que dispõe a Lei {chave}?",
+                 f"Qual é o tema tratado pela norma {chave}?"),
+                (f"A Lei {chave} estabelece multa de {rng.randint(1, 20)}% para o descumprimento das obrigações "
+                 f"previstas no artigo {rng.randint(2, 40)}.",
+                 f"Qual multa a Lei {chave} estabelece para o descumprimento das obrigações?",
+                 f"Que penalidade financeira a norma {chave} prevê para quem não cumprir seus deveres?"),
+                (f"A fiscalização da Lei {chave} cabe aos conselhos municipais, que publicam relatórios a cada "
+                 f"{rng.randint(2, 12)} meses.",
+                 f"A quem cabe a fiscalização da Lei {chave}?",
+                 f"Quais órgãos verificam se a norma {chave} está sendo cumprida?"),
+            ]
+        elif tipo == 2:
+            fatos = [
+                (f"A espécie {chave} é uma {rng.choice(TIPOS)} endêmica da {rng.choice(REGIOES)}.",
+                 f"Em que região a espécie {chave} é endêmica?",
+                 f"Em qual bioma o {chave} vive exclusivamente?"),
+                (f"A espécie {chave} alimenta-se principalmente de {rng.choice(ALIMENTOS)} ao amanhecer.",
+                 f"De que se alimenta principalmente a espécie {chave}?",
+                 f"Qual é a dieta habitual do {chave}?"),
+                (f"Os adultos da espécie {chave} podem atingir {rng.randint(2, 120)} centímetros de comprimento.",
+                 f"Quantos centímetros os adultos da espécie {chave} podem atingir?",
+                 f"Qual o tamanho máximo do {chave}?"),
+            ]
+        else:
+            origem, destino = rng.sample(SUBSTRATOS, 2)
+            enzima = f"{chave.lower()}ase"
+            fatos = [
+                (f"A enzima {enzima} catalisa a conversão de {origem} em {destino}.",
+                 f"Qual conversão a enzima {enzima} catalisa?",
+                 f"Que reação química é acelerada pela {enzima}?"),
+                (f"A enzima {enzima} atua no {rng.choice(ORGANELAS)} das células hepáticas.",
+                 f"Em que organela atua a enzima {enzima}?",
+                 f"Em qual compartimento celular a {enzima} funciona?"),
+                (f"A enzima {enzima} é inibida por altas concentrações de {rng.choice(SUBSTRATOS)}.",
+                 f"O que inibe a enzima {enzima}?",
+                 f"Qual substância bloqueia a atividade da {enzima}?"),
+            ]
+        for n, (texto, lexical, parafrase) in enumerate(fatos):
+            chunk_id = f"fixture#{i}-{n}"
+            passagens.append({'id': chunk_id, 'text': texto + " " + RUIDO, 'metadata': {'source': 'fixture', 'page': i + 1}})
+            perguntas.append({'question': lexical, 'relevant': [chunk_id], 'kind': 'lexical'})
+            perguntas.append({'question': parafrase, 'relevant': [chunk_id], 'kind': 'paraphrase'})
+    return {'passages': passagens, 'questions': perguntas}
+
+# Embeddings das passagens calculados uma única vez e compartilhados pelas configurações;
+# as consultas continuam passando pelo modelo, como no aplicativo
+class EmbedderPrecalculado:
+    def __init__(self, engine, textos: list):
+        self.engine = engine
+        self.vetores = dict(zip(textos, engine.encode(textos)))
+
+    def encode(self, textos: list) -> np.ndarray:
+        faltantes = [texto for texto in textos if texto not in self.vetores]
+        # Consultas não entram no dicionário: cada configuração paga o custo de codificá-las
+        novos = dict(zip(faltantes, self.engine.encode(faltantes))) if faltantes else {}
+        return np.vstack([self.vetores[texto] if texto in self.vetores else novos[texto] for texto in textos])
+
+# Configuração apenas densa: índice vetorial sem BM25 nem fusão
+class BuscaDensa:
+    def __init__(self, embedder, dtype: str = 'float32'):
+        self.embedder = embedder
+        self.dtype = dtype
+        self.index = None
+
+    def add_chunks(self, chunks: list):
+        vetores = self.embedder.encode([chunk['text'] for chunk in chunks])
+        self.index = VectorIndex(vetores.shape[1], self.dtype)
+        self.index.add([chunk['id'] for chunk in chunks], vetores)
+
+    def search(self, consulta: str, k: int) -> list:
+        return [{'id': chunk_id} for chunk_id, _ in self.index.search(self.embedder.encode([consulta])[0], k)]
+
+def configuracoes(embedder, usar_reranker: bool) -> dict:
+    configs = {'sparse': lambda: HybridRetriever()}
+    if embedder is not None:
+        configs['dense'] = lambda: BuscaDensa(embedder)
+        configs['dense_float16'] = lambda: BuscaDensa(embedder, 'float16')
+        configs['hybrid'] = lambda: HybridRetriever(embedder=embedder)
+        configs['hybrid_ivfpq'] = lambda: HybridRetriever(
+            embedder=embedder, index_mode='ivfpq', index_params={'nlist': 16, 'm': 8, 'nbits': 6, 'nprobe': 4})
+        if usar_reranker:
+            # Orçamentos folgados: aqui interessa a qualidade do reranking, não o corte por prazo
+            configs['hybrid_reranked'] = lambda: HybridRetriever(
+                embedder=embedder, reranker=get_reranker(), budgets={'sparse': 10, 'dense': 10, 'rerank': 60})
+    return configs
+
+def construir(fabrica, passagens: list):
+    inicio = time.perf_counter()
+    recuperador = fabrica()
+    recuperador.add_chunks([dict(passagem) for passagem in passagens])
+    return recuperador, time.perf_counter() - inicio
+
+def medir_memoria(fabrica, passagens: list) -> float:
+    tracemalloc.start()
+    recuperador = fabrica()
+    recuperador.add_chunks([dict(passagem) for passagem in passagens])
+    memoria = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del recuperador
+    return memoria / 2 ** 20
+
+def avaliar(recuperador, perguntas: list, ks: list) -> dict:
+    acertos = {k: 0 for k in ks}
+    por_tipo = {}
+    reciprocos, latencias = [], []
+    profundidade = max(ks)
+    for item in perguntas:
+        inicio = time.perf_counter()
+        ids = [resultado['id'] for resultado in recuperador.search(item['question'], profundidade)]
+        latencias.append(time.perf_counter() - inicio)
+        relevantes = set(item['relevant'])
+        posicao = next((i for i, chunk_id in enumerate(ids) if chunk_id in relevantes), None)
+        reciprocos.append(0.0 if posicao is None else 1.0 / (posicao + 1))
+        for k in ks:
+            acertos[k] += posicao is not None and posicao < k
+        tipo = por_tipo.setdefault(item.get('kind', 'all'), [0, 0])
+        tipo[0] += posicao is not None and posicao < min(ks)
+        tipo[1] += 1
+    latencias = np.asarray(latencias) * 1000
+    resultado = {f"recall@{k}": acertos[k] / len(perguntas) for k in ks}
+    resultado.update({
+        f"mrr@{profundidade}": float(np.mean(reciprocos)),
+        'p50_ms': float(np.percentile(latencias, 50)),
+        'p95_ms': float(np.percentile(latencias, 95)),
+        f"recall@{min(ks)}_by_kind": {tipo: acertos_tipo / total for tipo, (acertos_tipo, total) in por_tipo.items()},
+    })
+    return resultado
+
+def run(corpus: dict, ks: list, usar_reranker: bool, somente: list) -> dict:
+    passagens, perguntas = corpus['passages'], corpus['questions']
+    resultados = {'passages': len(passagens), 'questions': len(perguntas), 'configs': {}}
+    embedder = None
+    try:
+        from embeddings import get_embedding_engine
+
+        inicio = time.perf_counter()
+        embedder = EmbedderPrecalculado(get_embedding_engine(cache_path=None), [p['text'] for p in passagens])
+        resultados['embedding_seconds'] = time.perf_counter() - inicio
+    except Exception as e:
+        resultados['embedding_error'] = str(e)
+
+    for nome_config, fabrica in configuracoes(embedder, usar_reranker).items():
+        if somente and nome_config not in somente:
+            continue
+        try:
+            recuperador, construcao = construir(fabrica, passagens)
+            metricas = avaliar(recuperador, perguntas, ks)
+            metricas['build_seconds'] = construcao
+            metricas['memory_mb'] = medir_memoria(fabrica, passagens)
+            dense = getattr(recuperador, 'dense', None) or getattr(recuperador, 'index', None)
+            if dense is not None and hasattr(dense, 'memory_bytes'):
+                metricas['vector_index_mb'] = dense.memory_bytes() / 2 ** 20
+            resultados['configs'][nome_config] = metricas
+        except Exception as e:
+            resultados['configs'][nome_config] = {'skipped': str(e)}
+    return resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Qualidade e latência de cada configuração de recuperação num corpus rotulado.')
+    parser.add_argument('--corpus', help='JSON com {"passages": [{id, text, metadata}], "questions": [{question, relevant}]}; '
+                                         'se omitido, um corpus sintético em português é gerado')
+    parser.add_argument('--entities', type=int, default=300, help='entidades do corpus gerado (três passagens e seis perguntas cada)')
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--reranker', action='store_true', help='inclui a configuração com cross-encoder')
+    parser.add_argument('--only', nargs='*', default=[], help='executa só as configurações indicadas')
+    parser.add_argument('--output', help='grava o resultado JSON neste arquivo')
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, 'r', encoding='utf-8') as file:
+            corpus = json.load(file)
+    else:
+        corpus = gerar_corpus(args.entities)
+    resultados = run(corpus, sorted(args.k), args.reranker, args.only)
+    resultados['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    saida = json.dumps(resultados, indent=4, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(saida)
+    print(saida)
@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_store import ChatHistoryStore
+from session_storage import SessionStorage
+from usage_log import UsageLog, UsageLogReader
+
+# Um usuário simulado repete o ciclo de uma execução do script: lê o histórico e o uso da sessão,
+# grava uma interação, uma linha de uso e, de vez em quando, o arquivo de referências
+def usuario(indice: int, base: str, store: ChatHistoryStore, log: UsageLog, leitor: UsageLogReader,
+            interacoes: int, tamanho_referencias: int, medidas: list, erros: list):
+    sessao = f"usuario{indice}"
+    armazenamento = SessionStorage(sessao, base)
+    referencias = os.urandom(tamanho_referencias)
+    for i in range(interacoes):
+        inicio = time.perf_counter()
+        try:
+            store.last(10, sessao)
+            leitor.read(sessao)
+            store.save(f"pergunta {i}", "", "resposta " * 50, sessao)
+            log.append({'action': 'fetch', 'interaction_number': i, 'tokens_used': 100, 'session_id': sessao})
+            if i % 10 == 0:
+                armazenamento.gravar('references.csv', referencias)
+        except Exception as e:
+            erros.append(repr(e))
+        medidas.append(time.perf_counter() - inicio)
+
+def run(usuarios: int, interacoes: int, tamanho_referencias: int, max_rows: int) -> dict:
+    base = tempfile.mkdtemp(prefix='sessoes_')
+    store = ChatHistoryStore(os.path.join(base, 'chat_history.db'), max_rows)
+    log = UsageLog(os.path.join(base, 'api_usage.jsonl'))
+    leitor = UsageLogReader(log.path)
+    resultados = {}
+    for quantidade in sorted({1, usuarios}):
+        medidas, erros = [], []
+        threads = [
+            threading.Thread(target=usuario, args=(i, base, store, log, leitor, interacoes, tamanho_referencias, medidas, erros))
+            for i in range(quantidade)
+        ]
+        inicio = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total = time.perf_counter() - inicio
+        resultados[f"{quantidade}_users"] = {
+            'interactions_per_second': len(medidas) / total,
+            'p50_ms': float(np.percentile(medidas, 50) * 1000),
+            'p95_ms': float(np.percentile(medidas, 95) * 1000),
+            'errors': len(erros),
+        }
+    log.close()
+    resultados['history_rows'] = store.count()
+    resultados['rows_per_session_cap'] = max_rows
+    return resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vazão do histórico, do log de uso e dos arquivos por sessão com usuários concorrentes.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--interactions', type=int, default=200)
+    parser.add_argument('--references-bytes', type=int, default=256 * 1024)
+    parser.add_argument('--max-rows', type=int, default=100)
+    args = parser.parse_args()
+    print(json.dumps(run(args.users, args.interactions, args.references_bytes, args.max_rows), indent=4))
@@ -0,0 +1,70 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_store import SharedVectorStore
+
+# Memória privada do processo (RSS menos páginas compartilhadas), lida de /proc no Linux
+def memoria_privada_mb() -> float:
+    with open('/proc/self/statm') as file:
+        _, residente, compartilhada = (int(valor) for valor in file.read().split()[:3])
+    return (residente - compartilhada) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+def worker(path: str, modo: str, consultas: int, fila):
+    antes = memoria_privada_mb()
+    if modo == 'mmap':
+        store = SharedVectorStore(path)
+        buscar = store.search
+    else:
+        # Linha de base: cada worker carrega a sua própria cópia da matriz
+        store = SharedVectorStore(path)
+        matriz = np.vstack([np.asarray(store.segmentos[nome].matrix, dtype=np.float32) for nome in store.ordem])
+        buscar = lambda vetor, k: np.argsort(-(matriz @ vetor))[:k]
+    rng = np.random.default_rng(os.getpid())
+    inicio = time.perf_counter()
+    for _ in range(consultas):
+        buscar(rng.standard_normal(store.dimension).astype(np.float32), 10)
+    fila.put({'private_mb': memoria_privada_mb() - antes, 'seconds': time.perf_counter() - inicio})
+
+def run(vetores: int, dimensao: int, segmentos: int, workers: int, consultas: int) -> dict:
+    path = tempfile.mkdtemp(prefix='embedding_store_')
+    store = SharedVectorStore(path)
+    rng = np.random.default_rng(0)
+    por_segmento = vetores // segmentos
+    inicio = time.perf_counter()
+    for segmento in range(segmentos):
+        ids = [f"chunk#{segmento * por_segmento + i}" for i in range(por_segmento)]
+        store.add(ids, rng.standard_normal((por_segmento, dimensao)).astype(np.float32))
+    resultados = {'vectors': vetores, 'dimension': dimensao, 'segments': segmentos, 'workers': workers,
+                  'append_seconds': time.perf_counter() - inicio, 'store_mb': store.memory_bytes() / 2 ** 20}
+    for modo in ('copy', 'mmap'):
+        fila = multiprocessing.Queue()
+        processos = [multiprocessing.Process(target=worker, args=(path, modo, consultas, fila)) for _ in range(workers)]
+        for processo in processos:
+            processo.start()
+        medidas = [fila.get() for _ in processos]
+        for processo in processos:
+            processo.join()
+        resultados[modo] = {
+            'private_mb_per_worker': float(np.mean([m['private_mb'] for m in medidas])),
+            'queries_per_second': consultas / float(np.mean([m['seconds'] for m in medidas])),
+        }
+    return resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memória privada por worker: armazenamento mapeado em memória vs cópia por processo.')
+    parser.add_argument('--vectors', type=int, default=200000)
+    parser.add_argument('--dimension', type=int, default=384)
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(run(args.vectors, args.dimension, args.segments, args.workers, args.queries), indent=4))
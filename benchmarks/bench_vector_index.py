@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import IVFPQIndex, VectorIndex
+
+# Gera os centros dos grupos (imitam os assuntos de vários documentos)
+def gerar_centros(quantidade: int, dimensao: int, seed: int = 3) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((quantidade, dimensao)).astype(np.float32)
+
+# Gera vetores normalizados agrupados em torno dos centros (imita embeddings de chunks). Corpus e
+# consultas usam os mesmos centros, com ruídos diferentes: as consultas caem nos grupos do corpus
+def gerar_vetores(quantidade: int, centros: np.ndarray, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    ruido = 0.35 * rng.standard_normal((quantidade, centros.shape[1])).astype(np.float32)
+    vetores = centros[rng.integers(0, len(centros), quantidade)] + ruido
+    return vetores / np.linalg.norm(vetores, axis=1, keepdims=True)
+
+def consultar(indice, consultas: np.ndarray, k: int):
+    inicio = time.perf_counter()
+    resultados = [[chunk_id for chunk_id, _ in indice.search(consulta, k)] for consulta in consultas]
+    return resultados, time.perf_counter() - inicio
+
+def recall(resultados: list, referencia: list) -> float:
+    return float(np.mean([len(set(r) & set(g)) / len(g) for r, g in zip(resultados, referencia)]))
+
+def run(quantidade: int, dimensao: int, consultas: int, k: int, nlist: int, m: int, nprobes: list) -> dict:
+    centros = gerar_centros(max(nlist // 2, 8), dimensao)
+    vetores = gerar_vetores(quantidade, centros, seed=3)
+    perguntas = gerar_vetores(consultas, centros, seed=4)
+    ids = [f"chunk#{i}" for i in range(quantidade)]
+    resultados = {'vectors': quantidade, 'dimension': dimensao, 'queries': consultas, 'k': k}
+
+    inicio = time.perf_counter()
+    exato = VectorIndex(dimensao)
+    exato.add(ids, vetores)
+    construcao = time.perf_counter() - inicio
+    referencia, tempo = consultar(exato, perguntas, k)
+    resultados['flat'] = {'build_seconds': construcao, 'recall_at_k': 1.0, 'qps': consultas / tempo,
+                          'memory_mb': exato.memory_bytes() / 2 ** 20}
+
+    inicio = time.perf_counter()
+    indice = IVFPQIndex(dimensao, nlist=nlist, m=m)
+    # Inclusões em lotes, como na ingestão incremental
+    for inicio_lote in range(0, quantidade, 10000):
+        indice.add(ids[inicio_lote:inicio_lote + 10000], vetores[inicio_lote:inicio_lote + 10000])
+    if not indice.trained:
+        indice.train(vetores)
+    construcao = time.perf_counter() - inicio
+    resultados['ivfpq'] = {'build_seconds': construcao, 'nlist': nlist, 'm': m,
+                           'memory_mb': indice.memory_bytes() / 2 ** 20, 'nprobe': {}}
+    for nprobe in nprobes:
+        indice.set_nprobe(nprobe)
+        encontrados, tempo = consultar(indice, perguntas, k)
+        resultados['ivfpq']['nprobe'][nprobe] = {'recall_at_k': recall(encontrados, referencia), 'qps': consultas / tempo}
+    return resultados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark do índice IVF-PQ contra o índice vetorial exato.')
+    parser.add_argument('--vectors', type=int, default=200000)
+    parser.add_argument('--dimension', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--m', type=int, default=48)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+    print(json.dumps(run(args.vectors, args.dimension, args.queries, args.k, args.nlist, args.m, args.nprobe), indent=4))
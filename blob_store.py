@@ -0,0 +1,190 @@
+import collections
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+# Definição de constantes
+BLOB_STORE_DB = 'blob_store.db'
+# Textos menores que isso ficam no próprio registro (a referência não compensaria)
+BLOB_MIN_CHARS = 256
+BLOB_COMPRESSION_LEVEL = 6
+BLOB_CACHE_SIZE = 1024
+# Blobs gravados há menos tempo que isso não são coletados: o registro que os referencia pode
+# ainda não ter sido gravado (a referência é criada antes do registro)
+BLOB_GC_GRACE_SECONDS = 3600
+# Prefixo das referências gravadas no lugar do texto (o caractere nulo não aparece em texto digitado)
+BLOB_REF_PREFIX = "\x00blob:"
+
+# Repositórios abertos neste processo
+_REPOSITORIOS = {}
+_REPOSITORIOS_LOCK = threading.Lock()
+
+def eh_referencia(valor) -> bool:
+    return isinstance(valor, str) and valor.startswith(BLOB_REF_PREFIX)
+
+# Repositório de textos endereçado pelo conteúdo (sha256), comprimido com zlib, em SQLite (modo WAL).
+# Um texto repetido (a mesma resposta no log de uso, no histórico e no prompt de refinamento)
+# é gravado uma única vez; os registros guardam só a referência.
+class BlobStore:
+    def __init__(self, path: str = BLOB_STORE_DB, cache_size: int = BLOB_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER NOT NULL, data BLOB NOT NULL, created REAL)"
+        )
+        self._atualizar_esquema()
+        self._conn.commit()
+
+    # Bancos anteriores à coleta não têm a data de gravação (os blobs antigos ficam sem data)
+    def _atualizar_esquema(self):
+        colunas = {linha[1] for linha in self._conn.execute("PRAGMA table_info(blobs)")}
+        if 'created' not in colunas:
+            self._conn.execute("ALTER TABLE blobs ADD COLUMN created REAL")
+
+    def _lembrar(self, chave: str, texto: str):
+        self._cache[chave] = texto
+        self._cache.move_to_end(chave)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # Grava os textos (os já existentes são ignorados) e retorna as referências na mesma ordem
+    def put_many(self, textos: List[str]) -> List[str]:
+        chaves, linhas = [], {}
+        for texto in textos:
+            dados = texto.encode('utf-8')
+            chave = hashlib.sha256(dados).hexdigest()
+            chaves.append(chave)
+            if chave not in linhas:
+                linhas[chave] = (chave, len(dados), zlib.compress(dados, BLOB_COMPRESSION_LEVEL))
+        agora = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO blobs (hash, size, data, created) VALUES (?, ?, ?, ?)",
+                [linha + (agora,) for linha in linhas.values()],
+            )
+            # Um texto já existente gravado de novo volta a ter o prazo de carência
+            self._conn.executemany("UPDATE blobs SET created = ? WHERE hash = ?", [(agora, chave) for chave in linhas])
+            self._conn.commit()
+            for chave, texto in zip(chaves, textos):
+                self._lembrar(chave, texto)
+        return [BLOB_REF_PREFIX + chave for chave in chaves]
+
+    def put(self, texto: str) -> str:
+        return self.put_many([texto])[0]
+
+    def get_many(self, referencias: Iterable[str]) -> Dict[str, str]:
+        encontrados, faltantes = {}, []
+        with self._lock:
+            for referencia in set(referencias):
+                chave = referencia[len(BLOB_REF_PREFIX):]
+                if chave in self._cache:
+                    self._cache.move_to_end(chave)
+                    encontrados[referencia] = self._cache[chave]
+                else:
+                    faltantes.append(chave)
+            # O SQLite limita a quantidade de parâmetros por consulta
+            for inicio in range(0, len(faltantes), 500):
+                lote = faltantes[inicio:inicio + 500]
+                placeholders = ",".join("?" * len(lote))
+                for chave, dados in self._conn.execute(f"SELECT hash, data FROM blobs WHERE hash IN ({placeholders})", lote):
+                    texto = zlib.decompress(dados).decode('utf-8')
+                    self._lembrar(chave, texto)
+                    encontrados[BLOB_REF_PREFIX + chave] = texto
+        return encontrados
+
+    def get(self, referencia: str) -> Optional[str]:
+        return self.get_many([referencia]).get(referencia)
+
+    # Tamanho original (bytes) de cada texto referenciado, sem descomprimir
+    def sizes(self, referencias: Iterable[str]) -> Dict[str, int]:
+        chaves = list({referencia[len(BLOB_REF_PREFIX):] for referencia in referencias})
+        tamanhos = {}
+        with self._lock:
+            for inicio in range(0, len(chaves), 500):
+                lote = chaves[inicio:inicio + 500]
+                placeholders = ",".join("?" * len(lote))
+                for chave, tamanho in self._conn.execute(f"SELECT hash, size FROM blobs WHERE hash IN ({placeholders})", lote):
+                    tamanhos[BLOB_REF_PREFIX + chave] = tamanho
+        return tamanhos
+
+    # Coleta (mark-and-sweep) os blobs que nenhum registro referencia mais: vivos são as referências
+    # encontradas nos registros mantidos; os blobs gravados dentro da carência são preservados.
+    # Retorna quantos blobs foram apagados.
+    def collect(self, vivos: Iterable[str], carencia: float = BLOB_GC_GRACE_SECONDS, agora: Optional[float] = None) -> int:
+        agora = agora if agora is not None else time.time()
+        chaves = {referencia[len(BLOB_REF_PREFIX):] for referencia in vivos if eh_referencia(referencia)}
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS blobs_vivos (hash TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM blobs_vivos")
+            self._conn.executemany("INSERT OR IGNORE INTO blobs_vivos VALUES (?)", [(chave,) for chave in chaves])
+            apagados = [linha[0] for linha in self._conn.execute(
+                "SELECT hash FROM blobs WHERE COALESCE(created, 0) < ? AND hash NOT IN (SELECT hash FROM blobs_vivos)",
+                (agora - carencia,),
+            )]
+            self._conn.executemany("DELETE FROM blobs WHERE hash = ?", [(chave,) for chave in apagados])
+            self._conn.execute("DELETE FROM blobs_vivos")
+            self._conn.commit()
+            for chave in apagados:
+                self._cache.pop(chave, None)
+        return len(apagados)
+
+    def stats(self) -> dict:
+        with self._lock:
+            quantidade, original, comprimido = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(data)), 0) FROM blobs"
+            ).fetchone()
+        return {'blobs': quantidade, 'original_bytes': original, 'stored_bytes': comprimido}
+
+# Função para trocar os campos de texto grandes de cada registro por referências ao repositório
+def guardar_campos(registros: List[dict], campos: Iterable[str], store: BlobStore, minimo: int = BLOB_MIN_CHARS) -> List[dict]:
+    campos = tuple(campos)
+    posicoes, textos = [], []
+    resultado = [dict(registro) for registro in registros]
+    for i, registro in enumerate(resultado):
+        for campo in campos:
+            valor = registro.get(campo)
+            if isinstance(valor, str) and len(valor) >= minimo and not eh_referencia(valor):
+                posicoes.append((i, campo))
+                textos.append(valor)
+    if textos:
+        for (i, campo), referencia in zip(posicoes, store.put_many(textos)):
+            resultado[i][campo] = referencia
+    return resultado
+
+# Função para listar as referências a blobs guardadas nos campos de texto de registros
+def referencias_campos(registros: Iterable[dict]) -> set:
+    return {valor for registro in registros for valor in registro.values() if eh_referencia(valor)}
+
+# Função para restaurar os textos referenciados nos registros (uma consulta para o lote inteiro)
+def expandir_campos(registros: List[dict], campos: Iterable[str], store: BlobStore) -> List[dict]:
+    campos = tuple(campos)
+    referencias = [registro[campo] for registro in registros for campo in campos if eh_referencia(registro.get(campo))]
+    if not referencias:
+        return registros
+    textos = store.get_many(referencias)
+    resultado = []
+    for registro in registros:
+        if any(eh_referencia(registro.get(campo)) for campo in campos):
+            registro = dict(registro)
+            for campo in campos:
+                if eh_referencia(registro.get(campo)):
+                    registro[campo] = textos.get(registro[campo], "")
+        resultado.append(registro)
+    return resultado
+
+# Função para obter o repositório compartilhado do processo
+def get_blob_store(path: str = BLOB_STORE_DB) -> BlobStore:
+    with _REPOSITORIOS_LOCK:
+        store = _REPOSITORIOS.get(path)
+        if store is None:
+            store = BlobStore(path)
+            _REPOSITORIOS[path] = store
+        return store
@@ -0,0 +1,341 @@
+import os
+import json
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from blob_store import BLOB_REF_PREFIX, expandir_campos, guardar_campos
+
+# Definição de constantes
+CHAT_HISTORY_DB = 'chat_history.db'
+DEFAULT_SESSION = 'default'
+# Resposta gravada nas entradas que registram páginas de referência no histórico
+REFERENCE_RESPONSE = 'Informação adicionada ao histórico de chat como referência.'
+CAMPOS_TEXTO = ('user_input', 'user_prompt', 'expert_response')
+# Busca textual: acentos e maiúsculas são ignorados ("fotossintese" encontra "Fotossíntese")
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_SNIPPET_TOKENS = 16
+# Marcadores internos dos trechos (o texto das respostas já pode conter '**'), trocados por negrito
+MARCA_INICIO, MARCA_FIM = "\x02", "\x03"
+FTS_BACKFILL_BATCH = 500
+PADRAO_TERMO = re.compile(r'\w+', re.UNICODE)
+
+# Históricos abertos neste processo
+_HISTORICOS = {}
+_HISTORICOS_LOCK = threading.Lock()
+
+# Função para calcular o hash do conteúdo de uma entrada do histórico
+def hash_entrada(user_input: str, user_prompt: str, expert_response: str) -> str:
+    conteudo = "\x1f".join(str(parte) for parte in (user_input, user_prompt, expert_response))
+    return hashlib.sha1(conteudo.encode('utf-8')).hexdigest()
+
+# Função para escapar um termo como string FTS5 (aspas duplicadas dentro de aspas)
+def termo_fts(termo: str) -> str:
+    return '"' + termo.replace('"', '""') + '"'
+
+# Função para transformar o texto digitado numa consulta FTS5 (termos entre aspas, o último como
+# prefixo), restrita às colunas de texto: o texto do usuário nunca vira sintaxe de consulta
+def consulta_fts(texto: str, operador: str = 'AND') -> str:
+    termos = [termo_fts(termo) for termo in PADRAO_TERMO.findall(texto)]
+    if not termos:
+        return ""
+    termos[-1] += "*"
+    return "{" + " ".join(CAMPOS_TEXTO) + "} : (" + f" {operador} ".join(termos) + ")"
+
+# Histórico do chat em SQLite (modo WAL). Cada interação é uma linha inserida; as últimas N
+# interações saem de uma consulta pelo índice de timestamp, sem ler o histórico inteiro.
+# Os textos também entram num índice FTS5 (na mesma transação) para a busca no histórico; com
+# um repositório de blobs, a tabela principal guarda só as referências dos textos grandes.
+class ChatHistoryStore:
+    def __init__(self, path: str = CHAT_HISTORY_DB, max_rows_por_sessao: int = 0, blobs=None):
+        self.path = path
+        # Cota de interações guardadas por sessão (0 = sem limite); as mais antigas são descartadas
+        self.max_rows_por_sessao = max_rows_por_sessao
+        self.blobs = blobs
+        self.fts = False
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, timestamp REAL NOT NULL, "
+            "user_input TEXT, user_prompt TEXT, expert_response TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_session_ts ON chat_history (session_id, timestamp)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_ts ON chat_history (timestamp)")
+        self._atualizar_esquema()
+        # Entradas com hash (referências) são gravadas uma única vez por sessão
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_hash ON chat_history (session_id, content_hash)"
+        )
+        self._conn.commit()
+        self._criar_indice_textual()
+
+    # O índice FTS5 é opcional: builds do SQLite sem FTS5 continuam funcionando, sem a busca
+    def _criar_indice_textual(self):
+        try:
+            existia = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_history_fts'"
+            ).fetchone() is not None
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5("
+                f"session_id, user_input, user_prompt, expert_response, tokenize = '{FTS_TOKENIZER}')"
+            )
+            self._conn.commit()
+        except sqlite3.OperationalError:
+            return
+        self.fts = True
+        if not existia:
+            self._indexar_existentes()
+
+    # Indexa as interações gravadas antes do índice existir, em lotes
+    def _indexar_existentes(self):
+        ultimo = 0
+        while True:
+            linhas = self._conn.execute(
+                "SELECT id, session_id, user_input, user_prompt, expert_response FROM chat_history WHERE id > ? ORDER BY id LIMIT ?",
+                (ultimo, FTS_BACKFILL_BATCH),
+            ).fetchall()
+            if not linhas:
+                break
+            registros = [dict(zip(('id', 'session_id') + CAMPOS_TEXTO, linha)) for linha in linhas]
+            if self.blobs is not None:
+                registros = expandir_campos(registros, CAMPOS_TEXTO, self.blobs)
+            self._conn.executemany(
+                "INSERT INTO chat_history_fts (rowid, session_id, user_input, user_prompt, expert_response) VALUES (?, ?, ?, ?, ?)",
+                [(r['id'], r['session_id']) + tuple(r[campo] for campo in CAMPOS_TEXTO) for r in registros],
+            )
+            self._conn.commit()
+            ultimo = linhas[-1][0]
+
+    # Bancos criados antes da coluna content_hash: acrescenta a coluna e remove as referências
+    # repetidas que o histórico antigo acumulava a cada execução do script
+    def _atualizar_esquema(self):
+        colunas = {linha[1] for linha in self._conn.execute("PRAGMA table_info(chat_history)")}
+        if 'content_hash' in colunas:
+            return
+        self._conn.execute("ALTER TABLE chat_history ADD COLUMN content_hash TEXT")
+        linhas = self._conn.execute(
+            "SELECT id, session_id, user_input, user_prompt, expert_response FROM chat_history "
+            "WHERE expert_response = ? ORDER BY id", (REFERENCE_RESPONSE,)
+        ).fetchall()
+        vistos, duplicadas, hashes = set(), [], []
+        for id_linha, session_id, user_input, user_prompt, expert_response in linhas:
+            chave = (session_id, hash_entrada(user_input, user_prompt, expert_response))
+            if chave in vistos:
+                duplicadas.append((id_linha,))
+            else:
+                vistos.add(chave)
+                hashes.append((chave[1], id_linha))
+        self._conn.executemany("DELETE FROM chat_history WHERE id = ?", duplicadas)
+        self._conn.executemany("UPDATE chat_history SET content_hash = ? WHERE id = ?", hashes)
+
+    def save(self, user_input: str, user_prompt: str, expert_response: str,
+             session_id: str = DEFAULT_SESSION, timestamp: Optional[float] = None) -> int:
+        entrada = {'user_input': user_input, 'user_prompt': user_prompt, 'expert_response': expert_response}
+        return self._inserir([entrada], session_id, timestamp)[0]
+
+    # Insere as entradas (e os textos no índice FTS5) sem confirmar a transação; retorna os ids
+    # das inseridas (as ignoradas por content_hash repetido não entram)
+    def _inserir(self, entradas: List[dict], session_id: str, timestamp: Optional[float]) -> List[int]:
+        agora = timestamp if timestamp is not None else time.time()
+        guardadas = guardar_campos(entradas, CAMPOS_TEXTO, self.blobs) if self.blobs is not None else entradas
+        ids, sessoes = [], set()
+        with self._lock:
+            for entrada, guardada in zip(entradas, guardadas):
+                sessao = entrada.get('session_id', session_id)
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO chat_history (session_id, timestamp, user_input, user_prompt, expert_response, content_hash) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (sessao, entrada.get('timestamp', agora)) + tuple(guardada.get(campo) for campo in CAMPOS_TEXTO) + (entrada.get('content_hash'),),
+                )
+                if cursor.rowcount != 1:
+                    continue
+                ids.append(cursor.lastrowid)
+                sessoes.add(sessao)
+                if self.fts:
+                    self._conn.execute(
+                        "INSERT INTO chat_history_fts (rowid, session_id, user_input, user_prompt, expert_response) VALUES (?, ?, ?, ?, ?)",
+                        (cursor.lastrowid, sessao) + tuple(entrada.get(campo) for campo in CAMPOS_TEXTO),
+                    )
+            for sessao in sessoes:
+                self._aplicar_cota(sessao)
+            self._conn.commit()
+        return ids
+
+    # Remove as interações da sessão além da cota, na mesma transação da gravação. Linhas de
+    # referência (com content_hash) ficam fora da cota: apagá-las faria a próxima sincronização
+    # inseri-las de novo
+    def _aplicar_cota(self, session_id: str):
+        if not self.max_rows_por_sessao:
+            return
+        excedentes = (
+            "SELECT id FROM chat_history WHERE session_id = ? AND content_hash IS NULL "
+            "ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?"
+        )
+        if self.fts:
+            self._conn.execute(f"DELETE FROM chat_history_fts WHERE rowid IN ({excedentes})", (session_id, self.max_rows_por_sessao))
+        self._conn.execute(
+            f"DELETE FROM chat_history WHERE session_id = ? AND id IN ({excedentes})",
+            (session_id, session_id, self.max_rows_por_sessao),
+        )
+
+    # Grava várias entradas numa única transação. Entradas com 'content_hash' já presentes na
+    # sessão são ignoradas, o que torna a gravação idempotente; retorna quantas foram inseridas.
+    # Cada entrada pode trazer a própria 'session_id' (lotes do gravador em segundo plano).
+    def save_many(self, entradas: List[dict], session_id: str = DEFAULT_SESSION, timestamp: Optional[float] = None) -> int:
+        if not entradas:
+            return 0
+        return len(self._inserir(entradas, session_id, timestamp))
+
+    # Retorna as últimas n interações em ordem cronológica (de uma sessão ou de todas)
+    def last(self, n: int, session_id: Optional[str] = None) -> List[dict]:
+        consulta = "SELECT user_input, user_prompt, expert_response, timestamp FROM chat_history"
+        parametros: list = []
+        if session_id is not None:
+            consulta += " WHERE session_id = ?"
+            parametros.append(session_id)
+        consulta += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        parametros.append(n)
+        with self._lock:
+            linhas = self._conn.execute(consulta, parametros).fetchall()
+        historico = [
+            {'user_input': user_input, 'user_prompt': user_prompt, 'expert_response': expert_response, 'timestamp': timestamp}
+            for user_input, user_prompt, expert_response, timestamp in reversed(linhas)
+        ]
+        return expandir_campos(historico, CAMPOS_TEXTO, self.blobs) if self.blobs is not None else historico
+
+    # Busca textual ranqueada (bm25) no histórico; retorna as interações com um trecho destacado.
+    # Sem resultado com todos os termos, tenta com qualquer um deles.
+    def search(self, texto: str, session_id: Optional[str] = None, limit: int = 20) -> List[dict]:
+        if not self.fts:
+            return []
+        for operador in ('AND', 'OR'):
+            consulta = consulta_fts(texto, operador)
+            if not consulta:
+                return []
+            # A sessão é filtrada na tabela principal, por igualdade, e não pelo MATCH (em que
+            # 'maria' também encontraria 'maria_silva')
+            filtro_sessao, parametros = "", [consulta]
+            if session_id is not None:
+                filtro_sessao = " AND h.session_id = ?"
+                parametros.append(session_id)
+            trechos = ", ".join(
+                f"snippet(chat_history_fts, {coluna}, '{MARCA_INICIO}', '{MARCA_FIM}', '…', {FTS_SNIPPET_TOKENS})" for coluna in (3, 1, 2)
+            )
+            with self._lock:
+                linhas = self._conn.execute(
+                    f"SELECT chat_history_fts.rowid, h.timestamp, h.user_input, {trechos}, "
+                    "bm25(chat_history_fts, 0.0, 2.0, 1.0, 1.0) AS score "
+                    "FROM chat_history_fts JOIN chat_history h ON h.id = chat_history_fts.rowid "
+                    f"WHERE chat_history_fts MATCH ?{filtro_sessao} ORDER BY score LIMIT ?",
+                    parametros + [limit],
+                ).fetchall()
+            if linhas or len(PADRAO_TERMO.findall(texto)) < 2:
+                break
+        resultados = []
+        for id_linha, timestamp, user_input, *snippets, score in linhas:
+            # Trecho da resposta, se ela contém algum termo; senão o da entrada ou do prompt
+            trecho = next((item for item in snippets if item and MARCA_INICIO in item), snippets[0] or "")
+            trecho = trecho.replace("**", "").replace(MARCA_INICIO, "**").replace(MARCA_FIM, "**")
+            resultados.append({'id': id_linha, 'timestamp': timestamp, 'user_input': user_input, 'snippet': trecho, 'score': -score})
+        if self.blobs is not None:
+            resultados = expandir_campos(resultados, ('user_input',), self.blobs)
+        return resultados
+
+    # Referências a blobs ainda usadas pelo histórico (para a coleta do repositório de blobs)
+    def blob_refs(self) -> set:
+        # Comparação por faixa: as funções de texto do SQLite param no caractere nulo do prefixo
+        inicio = BLOB_REF_PREFIX
+        fim = BLOB_REF_PREFIX[:-1] + chr(ord(BLOB_REF_PREFIX[-1]) + 1)
+        with self._lock:
+            linhas = self._conn.execute(
+                " UNION ".join(f"SELECT {campo} FROM chat_history WHERE {campo} >= ? AND {campo} < ?" for campo in CAMPOS_TEXTO),
+                [inicio, fim] * len(CAMPOS_TEXTO),
+            ).fetchall()
+        return {linha[0] for linha in linhas}
+
+    # Linhas gravadas depois de um id, como estão no banco (textos grandes como referências), em lotes
+    def iter_rows(self, depois_de: int = 0, lote: int = 5000):
+        ultimo = depois_de
+        while True:
+            with self._lock:
+                linhas = self._conn.execute(
+                    "SELECT id, session_id, timestamp, user_input, user_prompt, expert_response, content_hash "
+                    "FROM chat_history WHERE id > ? ORDER BY id LIMIT ?",
+                    (ultimo, lote),
+                ).fetchall()
+            if not linhas:
+                return
+            for linha in linhas:
+                yield dict(zip(('id', 'session_id', 'timestamp') + CAMPOS_TEXTO + ('content_hash',), linha))
+            ultimo = linhas[-1][0]
+
+    def clear(self, session_id: Optional[str] = None):
+        with self._lock:
+            if session_id is None:
+                if self.fts:
+                    self._conn.execute("DELETE FROM chat_history_fts")
+                self._conn.execute("DELETE FROM chat_history")
+            else:
+                if self.fts:
+                    self._conn.execute(
+                        "DELETE FROM chat_history_fts WHERE rowid IN (SELECT id FROM chat_history WHERE session_id = ?)", (session_id,)
+                    )
+                self._conn.execute("DELETE FROM chat_history WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def count(self, session_id: Optional[str] = None) -> int:
+        with self._lock:
+            if session_id is None:
+                return self._conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM chat_history WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Função para importar uma única vez o antigo chat_history.json (array JSON) para o banco
+def migrar_historico_legado(caminho_legado: str, store: ChatHistoryStore) -> int:
+    if not os.path.exists(caminho_legado):
+        return 0
+    try:
+        with open(caminho_legado, 'r') as file:
+            entradas = json.load(file)
+    except (json.JSONDecodeError, OSError):
+        entradas = []
+    # O arquivo antigo não tem horário: preserva a ordem com timestamps crescentes anteriores a agora.
+    # As referências, repetidas a cada execução no formato antigo, entram uma única vez.
+    inicio = time.time() - len(entradas)
+    linhas = []
+    for i, entrada in enumerate(entradas):
+        if not isinstance(entrada, dict):
+            continue
+        linha = {
+            'timestamp': inicio + i,
+            'user_input': entrada.get('user_input'),
+            'user_prompt': entrada.get('user_prompt'),
+            'expert_response': entrada.get('expert_response'),
+        }
+        if linha['expert_response'] == REFERENCE_RESPONSE:
+            linha['content_hash'] = hash_entrada(linha['user_input'], linha['user_prompt'], linha['expert_response'])
+        linhas.append(linha)
+    inseridas = store.save_many(linhas)
+    os.replace(caminho_legado, caminho_legado + '.migrated')
+    return inseridas
+
+# Função para obter o histórico compartilhado do processo
+def get_chat_store(path: str = CHAT_HISTORY_DB, legado: Optional[str] = None, max_rows_por_sessao: int = 0,
+                   blobs=None) -> ChatHistoryStore:
+    with _HISTORICOS_LOCK:
+        store = _HISTORICOS.get(path)
+        if store is None:
+            store = ChatHistoryStore(path, max_rows_por_sessao, blobs)
+            if legado:
+                migrar_historico_legado(legado, store)
+            _HISTORICOS[path] = store
+        return store
@@ -0,0 +1,154 @@
+import re
+from typing import Callable, Dict, List, Optional
+
+# Definição de constantes
+CHUNK_MAX_TOKENS = 300
+CHUNK_OVERLAP_TOKENS = 40
+SECAO_INICIAL = "Introdução"
+
+# Padrões de títulos reconhecidos, na mesma ordem de prioridade de identificar_secoes
+PADRAO_PARTE = re.compile(r'Parte \d+\.')
+PADRAO_CAPITULO = re.compile(r'Capítulo \d+: .*')
+PADRAO_SUBSECAO = re.compile(r'\d+\.\d+ .*')
+PADRAO_TITULO = re.compile(r'Parte \d+\.|Capítulo \d+: .*|\d+\.\d+ .*')
+PADRAO_TOKEN = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+# Função para estimar tokens (palavras e pontuação) sem depender de um tokenizer
+def contar_tokens_aproximado(texto: str) -> int:
+    return len(PADRAO_TOKEN.findall(texto))
+
+# Função para classificar uma linha como título de Parte, Capítulo ou subseção n.n
+def classificar_titulo(linha: str) -> Optional[tuple]:
+    match = PADRAO_TITULO.match(linha)
+    if not match:
+        return None
+    titulo = match.group()
+    if PADRAO_PARTE.match(titulo):
+        return 'parte', titulo
+    if PADRAO_CAPITULO.match(titulo):
+        return 'capitulo', titulo
+    return 'secao', titulo
+
+# Função para dividir o texto em seções (tempo linear: as linhas são acumuladas em listas)
+def identificar_secoes(texto, secao_inicial):
+    partes = {secao_inicial: []}
+    secao_atual = secao_inicial
+
+    for paragrafo in texto.split('\n'):
+        match = PADRAO_TITULO.match(paragrafo)
+        if match:
+            secao_atual = match.group()
+            partes[secao_atual] = []
+        else:
+            partes[secao_atual].append(paragrafo)
+
+    return {secao: "\n".join(linhas) + "\n" if linhas else "" for secao, linhas in partes.items()}
+
+# Acumula as linhas da seção corrente e emite chunks ao atingir o limite de tokens
+class _ChunkBuilder:
+    def __init__(self, fonte: str, max_tokens: int, overlap_tokens: int, contar_tokens: Callable[[str], int]):
+        self.fonte = fonte
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.contar_tokens = contar_tokens
+        self.chunks: List[dict] = []
+        self.linhas: List[tuple] = []
+        self.tokens = 0
+        self.contexto: Dict[str, Optional[str]] = {'parte': None, 'capitulo': None, 'secao': None}
+
+    def _emitir(self, manter_sobreposicao: bool):
+        if not self.linhas:
+            return
+        self.chunks.append({
+            'id': f"{self.fonte}#c{len(self.chunks)}",
+            'text': "\n".join(linha for linha, _, _ in self.linhas),
+            'metadata': {
+                'source': self.fonte,
+                'page': self.linhas[0][1],
+                'page_start': self.linhas[0][1],
+                'page_end': self.linhas[-1][1],
+                'parte': self.contexto['parte'],
+                'capitulo': self.contexto['capitulo'],
+                'secao': self.contexto['secao'] or self.contexto['capitulo'] or self.contexto['parte'],
+                'tokens': self.tokens,
+            },
+        })
+        sobreposicao, tokens = [], 0
+        if manter_sobreposicao and self.overlap_tokens:
+            # Reaproveita as últimas linhas (até overlap_tokens) no início do próximo chunk
+            for linha in reversed(self.linhas):
+                if tokens + linha[2] > self.overlap_tokens:
+                    break
+                sobreposicao.append(linha)
+                tokens += linha[2]
+            sobreposicao.reverse()
+        self.linhas, self.tokens = sobreposicao, tokens
+
+    def abrir_secao(self, tipo: str, titulo: str):
+        self._emitir(manter_sobreposicao=False)
+        self.contexto[tipo] = titulo
+        # Um novo capítulo zera a subseção; uma nova parte zera capítulo e subseção
+        if tipo == 'parte':
+            self.contexto['capitulo'] = None
+            self.contexto['secao'] = None
+        elif tipo == 'capitulo':
+            self.contexto['secao'] = None
+
+    # Divide uma linha maior que o orçamento em pedaços que cabem nele, sem recursão: por palavras
+    # enquanto houver mais de uma; uma palavra só (pontilhados de sumário, URLs, base64) é cortada
+    # por caracteres
+    def _dividir(self, linha: str) -> List[tuple]:
+        pedacos, pendentes = [], [linha]
+        while pendentes:
+            pedaco = pendentes.pop()
+            tokens = self.contar_tokens(pedaco)
+            if tokens <= self.max_tokens or len(pedaco) <= 1:
+                pedacos.append((pedaco, tokens))
+                continue
+            palavras = pedaco.split()
+            if len(palavras) > 1:
+                passo = max(1, min(len(palavras) - 1, len(palavras) * self.max_tokens // (2 * tokens)))
+                partes = [" ".join(palavras[inicio:inicio + passo]) for inicio in range(0, len(palavras), passo)]
+            else:
+                passo = max(1, min(len(pedaco) - 1, len(pedaco) * self.max_tokens // (2 * tokens)))
+                partes = [pedaco[inicio:inicio + passo] for inicio in range(0, len(pedaco), passo)]
+            # A pilha é processada do fim: as partes entram invertidas para manter a ordem do texto
+            pendentes.extend(reversed(partes))
+        return pedacos
+
+    def adicionar(self, linha: str, pagina: int):
+        tokens = self.contar_tokens(linha)
+        if tokens > self.max_tokens:
+            for pedaco, tokens_pedaco in self._dividir(linha):
+                self._acrescentar(pedaco, pagina, tokens_pedaco)
+            return
+        self._acrescentar(linha, pagina, tokens)
+
+    def _acrescentar(self, linha: str, pagina: int, tokens: int):
+        if self.linhas and self.tokens + tokens > self.max_tokens:
+            self._emitir(manter_sobreposicao=True)
+        self.linhas.append((linha, pagina, tokens))
+        self.tokens += tokens
+
+    def finalizar(self) -> List[dict]:
+        self._emitir(manter_sobreposicao=False)
+        return self.chunks
+
+# Função para dividir as páginas de um documento em chunks que respeitam Parte / Capítulo / n.n.
+# texto_paginas segue o formato de extrair_texto_pdf: [{'page': 1, 'text': '...'}, ...]
+def chunk_por_secoes(texto_paginas: List[dict], fonte: str, max_tokens: int = CHUNK_MAX_TOKENS,
+                     overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                     contar_tokens: Callable[[str], int] = contar_tokens_aproximado,
+                     secao_inicial: str = SECAO_INICIAL) -> List[dict]:
+    builder = _ChunkBuilder(fonte, max_tokens, overlap_tokens, contar_tokens)
+    builder.contexto['secao'] = secao_inicial
+    for entrada in texto_paginas:
+        for linha in (entrada.get('text') or "").split('\n'):
+            if not linha.strip():
+                continue
+            titulo = classificar_titulo(linha)
+            if titulo:
+                builder.abrir_secao(*titulo)
+            else:
+                builder.adicionar(linha, entrada['page'])
+    return builder.finalizar()
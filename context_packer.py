@@ -0,0 +1,136 @@
+import os
+import re
+from typing import Callable, List, Optional, Tuple
+
+# Definição de constantes
+# Fração da janela do modelo reservada para a resposta
+RESPONSE_RESERVE = 0.25
+# Teto opcional de tokens para o bloco de referências (0 = só o limite da janela)
+REFERENCES_MAX_TOKENS = int(os.getenv('REFERENCES_MAX_TOKENS', '0'))
+# Sobreposição máxima (em palavras) procurada ao juntar chunks vizinhos
+MAX_OVERLAP_WORDS = 200
+
+# Ideogramas CJK contam um token cada; palavras e números contam um token a cada 3 caracteres
+# (no mínimo 1), o que fica acima do que os tokenizers BPE produzem para o português
+PADRAO_CJK = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+PADRAO_PALAVRA = re.compile(r'[^\W\d_]+|\d+', re.UNICODE)
+PADRAO_SIMBOLO = re.compile(r'[^\w\s]', re.UNICODE)
+
+# Função para estimar (por excesso) os tokens de um prompt em português e chinês
+def contar_tokens_prompt(texto: str) -> int:
+    cjk = len(PADRAO_CJK.findall(texto))
+    sem_cjk = PADRAO_CJK.sub(' ', texto)
+    palavras = sum((len(palavra) + 2) // 3 for palavra in PADRAO_PALAVRA.findall(sem_cjk))
+    simbolos = len(PADRAO_SIMBOLO.findall(sem_cjk))
+    return cjk + palavras + simbolos
+
+# Função para calcular o orçamento de tokens das referências a partir do prompt sem elas
+def orcamento_referencias(prompt_sem_referencias: str, janela: int, reserva: float = RESPONSE_RESERVE,
+                          teto: int = REFERENCES_MAX_TOKENS, contar_tokens: Callable[[str], int] = contar_tokens_prompt) -> int:
+    disponivel = int(janela * (1 - reserva)) - contar_tokens(prompt_sem_referencias)
+    if teto:
+        disponivel = min(disponivel, teto)
+    return max(disponivel, 0)
+
+def _paginas(metadata: dict) -> tuple:
+    inicio = metadata.get('page_start', metadata.get('page'))
+    fim = metadata.get('page_end', inicio)
+    return inicio, fim
+
+# Função para juntar dois textos removendo a sobreposição (fim de um = começo do outro)
+def juntar_textos(anterior: str, proximo: str, max_palavras: int = MAX_OVERLAP_WORDS) -> str:
+    palavras_a = anterior.split()
+    palavras_b = proximo.split()
+    for tamanho in range(min(len(palavras_a), len(palavras_b), max_palavras), 0, -1):
+        if palavras_a[-tamanho:] == palavras_b[:tamanho]:
+            return anterior + " " + " ".join(palavras_b[tamanho:]) if tamanho < len(palavras_b) else anterior
+    if proximo in anterior:
+        return anterior
+    return anterior + "\n" + proximo
+
+# Função para juntar passagens do mesmo documento cujas páginas se sobrepõem.
+# Cada grupo ocupa a posição da sua passagem mais bem ranqueada; dentro do grupo a ordem é a do documento.
+def mesclar_passagens(passagens: List[dict]) -> List[dict]:
+    grupos: List[dict] = []
+    for posicao, passagem in enumerate(passagens):
+        metadata = passagem.get('metadata', {})
+        fonte = metadata.get('source')
+        inicio, fim = _paginas(metadata)
+        alvo = None
+        if fonte is not None and inicio is not None:
+            for grupo in grupos:
+                if grupo['source'] == fonte and inicio <= grupo['page_end'] and fim >= grupo['page_start']:
+                    alvo = grupo
+                    break
+        if alvo is None:
+            grupos.append({'source': fonte, 'page_start': inicio, 'page_end': fim, 'rank': posicao, 'members': [passagem]})
+        else:
+            alvo['members'].append(passagem)
+            alvo['page_start'] = min(alvo['page_start'], inicio)
+            alvo['page_end'] = max(alvo['page_end'], fim)
+
+    mescladas = []
+    for grupo in sorted(grupos, key=lambda item: item['rank']):
+        membros = grupo['members']
+        if len(membros) == 1:
+            mescladas.append(membros[0])
+            continue
+        membros = sorted(membros, key=lambda item: (_paginas(item['metadata']), item['id']))
+        texto = membros[0]['text']
+        for membro in membros[1:]:
+            texto = juntar_textos(texto, membro['text'])
+        metadata = dict(membros[0]['metadata'])
+        metadata.update(page_start=grupo['page_start'], page_end=grupo['page_end'],
+                        merged_ids=[membro['id'] for membro in membros])
+        fontes = []
+        for membro in membros:
+            for citacao in membro['metadata'].get('sources', []):
+                if citacao not in fontes:
+                    fontes.append(citacao)
+        if fontes:
+            metadata['sources'] = fontes
+        secoes = list(dict.fromkeys(m['metadata'].get('secao') for m in membros if m['metadata'].get('secao')))
+        if secoes:
+            metadata['secao'] = "; ".join(secoes)
+        mescladas.append({'id': membros[0]['id'], 'text': texto, 'metadata': metadata,
+                          'score': max(m.get('score') or 0.0 for m in membros)})
+    return mescladas
+
+# Função para formatar uma passagem como entrada do bloco de referências do prompt
+def formatar_passagem(passagem: dict) -> str:
+    metadata = passagem.get('metadata', {})
+    if 'json_path' in metadata:
+        localizacao = f"Registro: {metadata['json_path']}"
+    else:
+        inicio, fim = _paginas(metadata)
+        paginas = ", ".join(str(citacao.get('page')) for citacao in metadata.get('sources', []) if citacao.get('page') is not None)
+        if not paginas and inicio is not None:
+            paginas = str(inicio) if inicio == fim else f"{inicio}-{fim}"
+        localizacao = f"Seção: {metadata.get('secao', 'Seção Desconhecida')}\nPágina: {paginas or 'Página Desconhecida'}"
+    return f"Fonte: {metadata.get('source', 'Fonte Desconhecida')}\n{localizacao}\nTexto: {passagem['text']}\n\n"
+
+# Função para montar o bloco de referências dentro do orçamento de tokens.
+# Percorre as passagens (já mescladas) em ordem de ranking e inclui cada uma que ainda couber;
+# retorna o texto, as passagens incluídas e as descartadas.
+def empacotar_contexto(passagens: List[dict], orcamento_tokens: int,
+                       contar_tokens: Callable[[str], int] = contar_tokens_prompt,
+                       formatar: Callable[[dict], str] = formatar_passagem) -> Tuple[str, List[dict], List[dict]]:
+    partes, incluidas, descartadas = [], [], []
+    usados = 0
+    for passagem in mesclar_passagens(passagens):
+        bloco = formatar(passagem)
+        custo = contar_tokens(bloco)
+        if usados + custo <= orcamento_tokens:
+            partes.append(bloco)
+            incluidas.append(passagem)
+            usados += custo
+        else:
+            descartadas.append(passagem)
+    return "".join(partes), incluidas, descartadas
+
+# Função para descrever o que ficou de fora do contexto
+def resumir_descartadas(descartadas: List[dict], orcamento_tokens: Optional[int] = None) -> str:
+    if not descartadas:
+        return ""
+    limite = f" (orçamento de {orcamento_tokens} tokens)" if orcamento_tokens is not None else ""
+    return f"{len(descartadas)} passagens de referência não couberam no contexto{limite}."
@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+# Definição de constantes
+COUNTERS_DB = 'counters.db'
+GLOBAL_SCOPE = 'global'
+
+# Contadores abertos neste processo
+_CONTADORES = {}
+_CONTADORES_LOCK = threading.Lock()
+
+# Função para montar o escopo do contador de uma sessão
+def escopo_sessao(session_id: str) -> str:
+    return f"session:{session_id}"
+
+# Contadores persistentes (SQLite, modo WAL): cada escopo é uma linha, incrementada com um
+# upsert atômico; a leitura é uma busca pela chave primária, independente do tamanho dos logs.
+class Counters:
+    def __init__(self, path: str = COUNTERS_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS counters (scope TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+
+    # Soma os incrementos de vários escopos numa única transação
+    def increment_many(self, incrementos: Dict[str, int]):
+        if not incrementos:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO counters (scope, value) VALUES (?, ?) "
+                "ON CONFLICT (scope) DO UPDATE SET value = value + excluded.value",
+                list(incrementos.items()),
+            )
+            self._conn.commit()
+
+    def increment(self, scope: str, quantidade: int = 1):
+        self.increment_many({scope: quantidade})
+
+    def get(self, scope: str) -> Optional[int]:
+        with self._lock:
+            linha = self._conn.execute("SELECT value FROM counters WHERE scope = ?", (scope,)).fetchone()
+        return linha[0] if linha else None
+
+    # Cria o escopo com um valor inicial se ainda não existir (usado para importar contagens antigas)
+    def initialize(self, scope: str, valor: int) -> int:
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO counters (scope, value) VALUES (?, ?)", (scope, valor))
+            self._conn.commit()
+            return self._conn.execute("SELECT value FROM counters WHERE scope = ?", (scope,)).fetchone()[0]
+
+    def set(self, scope: str, valor: int):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO counters (scope, value) VALUES (?, ?) ON CONFLICT (scope) DO UPDATE SET value = excluded.value",
+                (scope, valor),
+            )
+            self._conn.commit()
+
+    # Remove escopos (a próxima leitura os recria a partir dos logs com initialize)
+    def discard(self, scopes):
+        with self._lock:
+            self._conn.executemany("DELETE FROM counters WHERE scope = ?", [(scope,) for scope in scopes])
+            self._conn.commit()
+
+# Função para obter os contadores compartilhados do processo
+def get_counters(path: str = COUNTERS_DB) -> Counters:
+    with _CONTADORES_LOCK:
+        contadores = _CONTADORES.get(path)
+        if contadores is None:
+            contadores = Counters(path)
+            _CONTADORES[path] = contadores
+        return contadores
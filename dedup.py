@@ -0,0 +1,133 @@
+import re
+import zlib
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Definição de constantes
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+SHINGLE_WORDS = 5
+DEDUP_THRESHOLD = 0.7
+_PRIMO = (1 << 31) - 1
+_PALAVRA = re.compile(r'\w+', re.UNICODE)
+
+# Função para gerar os shingles (sequências de palavras) de um texto normalizado
+def shingles(texto: str, tamanho: int = SHINGLE_WORDS) -> np.ndarray:
+    texto = unicodedata.normalize('NFKD', texto.lower()).encode('ascii', 'ignore').decode('ascii')
+    palavras = _PALAVRA.findall(texto)
+    if len(palavras) < tamanho:
+        grupos = [" ".join(palavras)] if palavras else []
+    else:
+        grupos = [" ".join(palavras[i:i + tamanho]) for i in range(len(palavras) - tamanho + 1)]
+    # crc32 é estável entre processos (ao contrário de hash())
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) % _PRIMO for g in set(grupos)), dtype=np.int64)
+
+# Assinaturas MinHash com permutações (a * x + b) mod p, vetorizadas em numpy
+class MinHasher:
+    def __init__(self, permutacoes: int = MINHASH_PERMUTATIONS, seed: int = 42):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIMO, size=permutacoes, dtype=np.int64)[:, None]
+        self.b = rng.integers(0, _PRIMO, size=permutacoes, dtype=np.int64)[:, None]
+        self.permutacoes = permutacoes
+
+    def assinatura(self, texto: str) -> Optional[np.ndarray]:
+        valores = shingles(texto)
+        if len(valores) == 0:
+            return None
+        return ((self.a * valores[None, :] + self.b) % _PRIMO).min(axis=1)
+
+# Função para estimar a similaridade de Jaccard a partir de duas assinaturas
+def similaridade(assinatura_a: np.ndarray, assinatura_b: np.ndarray) -> float:
+    return float(np.mean(assinatura_a == assinatura_b))
+
+# Deduplicador incremental com LSH: chunks quase idênticos são colapsados num único chunk
+# canônico, que acumula as citações de todas as fontes em metadata['sources'].
+class Deduplicador:
+    def __init__(self, limiar: float = DEDUP_THRESHOLD, bandas: int = LSH_BANDS, hasher: Optional[MinHasher] = None):
+        self.hasher = hasher or MinHasher()
+        self.limiar = limiar
+        self.bandas = bandas
+        self.linhas = self.hasher.permutacoes // bandas
+        self.buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(bandas)]
+        self.assinaturas: Dict[str, np.ndarray] = {}
+        self.canonicos: Dict[str, dict] = {}
+        self.relatorio = {'chunks': 0, 'unique': 0, 'duplicates': 0, 'characters': 0, 'characters_removed': 0}
+
+    def _chaves(self, assinatura: np.ndarray):
+        for banda in range(self.bandas):
+            yield banda, assinatura[banda * self.linhas:(banda + 1) * self.linhas].tobytes()
+
+    def encontrar(self, assinatura: np.ndarray) -> Optional[str]:
+        candidatos = set()
+        for banda, chave in self._chaves(assinatura):
+            candidatos.update(self.buckets[banda].get(chave, ()))
+        melhor, melhor_sim = None, self.limiar
+        for chunk_id in candidatos:
+            sim = similaridade(assinatura, self.assinaturas[chunk_id])
+            if sim >= melhor_sim:
+                melhor, melhor_sim = chunk_id, sim
+        return melhor
+
+    # Retorna o id do chunk canônico se o chunk for duplicado; caso contrário o registra e retorna None
+    def adicionar(self, chunk: dict) -> Optional[str]:
+        self.relatorio['chunks'] += 1
+        self.relatorio['characters'] += len(chunk['text'])
+        metadata = chunk.setdefault('metadata', {})
+        citacoes = metadata.get('sources') or [
+            {k: v for k, v in metadata.items() if k in ('source', 'page', 'json_path', 'row_start')}
+        ]
+        assinatura = self.hasher.assinatura(chunk['text'])
+        existente = self.encontrar(assinatura) if assinatura is not None else None
+        if existente is not None:
+            fontes = self.canonicos[existente]['metadata']['sources']
+            for citacao in citacoes:
+                if citacao not in fontes:
+                    fontes.append(citacao)
+            self.relatorio['duplicates'] += 1
+            self.relatorio['characters_removed'] += len(chunk['text'])
+            return existente
+        metadata['sources'] = list(citacoes)
+        self.canonicos[chunk['id']] = chunk
+        if assinatura is not None:
+            self.assinaturas[chunk['id']] = assinatura
+            for banda, chave in self._chaves(assinatura):
+                self.buckets[banda].setdefault(chave, []).append(chunk['id'])
+        self.relatorio['unique'] += 1
+        return None
+
+    def remover(self, chunk_id: str):
+        assinatura = self.assinaturas.pop(chunk_id, None)
+        self.canonicos.pop(chunk_id, None)
+        if assinatura is None:
+            return
+        for banda, chave in self._chaves(assinatura):
+            ids = self.buckets[banda].get(chave, [])
+            if chunk_id in ids:
+                ids.remove(chunk_id)
+
+# Função para deduplicar uma lista de chunks durante a ingestão
+def deduplicar_chunks(chunks: List[dict], deduplicador: Optional[Deduplicador] = None) -> Tuple[List[dict], dict]:
+    deduplicador = deduplicador or Deduplicador()
+    unicos = [chunk for chunk in chunks if deduplicador.adicionar(chunk) is None]
+    return unicos, dict(deduplicador.relatorio)
+
+# Função para deduplicar passagens recuperadas antes de montar o contexto do prompt
+def deduplicar_passagens(passagens: List[dict], limiar: float = DEDUP_THRESHOLD) -> List[dict]:
+    deduplicador = Deduplicador(limiar)
+    unicas = []
+    for passagem in passagens:
+        # Cópias: as citações acumuladas aqui não devem alterar os chunks do índice
+        copia = dict(passagem, metadata=dict(passagem.get('metadata', {})))
+        if deduplicador.adicionar(copia) is None:
+            unicas.append(copia)
+    return unicas
+
+# Função para descrever o relatório de deduplicação
+def formatar_relatorio(relatorio: dict) -> str:
+    if not relatorio.get('chunks'):
+        return "Nenhum chunk processado."
+    percentual = 100.0 * relatorio['duplicates'] / relatorio['chunks']
+    return (f"{relatorio['duplicates']} de {relatorio['chunks']} chunks eram quase duplicados ({percentual:.1f}%); "
+            f"{relatorio['characters_removed']} de {relatorio['characters']} caracteres deixaram de ser indexados.")
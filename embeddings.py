@@ -0,0 +1,366 @@
+import os
+import abc
+import collections
+import hashlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Definição de constantes
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+EMBEDDING_DEVICE = os.getenv('EMBEDDING_DEVICE', 'cpu')
+EMBEDDING_CACHE_FILE = os.getenv('EMBEDDING_CACHE_FILE', 'embedding_cache.db')
+EMBEDDING_STORAGE_DTYPE = os.getenv('EMBEDDING_STORAGE_DTYPE', 'float16')
+EMBEDDING_DTYPES = ('float32', 'float16', 'int8')
+
+# Limites do lote adaptativo (tokens aproximados por lote e número máximo de textos)
+MIN_BATCH_TOKENS = 512
+MAX_BATCH_TOKENS = 32768
+MAX_BATCH_SIZE = 256
+TARGET_BATCH_SECONDS = 0.5
+
+# Configuração do cliente para servidores compatíveis com Ollama
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+OLLAMA_EMBEDDING_MODEL = os.getenv('OLLAMA_EMBEDDING_MODEL', 'nomic-embed-text')
+OLLAMA_BATCH_SIZE = 64
+OLLAMA_CONCURRENCY = 4
+OLLAMA_MAX_RETRIES = 3
+OLLAMA_TIMEOUT = 120
+OLLAMA_LATENCY_WINDOW = 1024   # requisições consideradas nos percentis de latência
+
+# Engines carregadas neste processo, uma por combinação de modelo e dispositivo
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+# Função para calcular o hash de um chunk (o modelo faz parte da chave)
+def hash_chunk(text: str, model_name: str = EMBEDDING_MODEL) -> str:
+    return hashlib.sha1(f"{model_name}\x00{text}".encode('utf-8')).hexdigest()
+
+# Função para estimar o número de tokens de um texto sem carregar o tokenizer
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+# Função para quantizar vetores no formato de armazenamento escolhido
+def quantize_vectors(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == 'float32':
+        return vectors, np.ones(len(vectors), dtype=np.float32)
+    if dtype == 'float16':
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    if dtype == 'int8':
+        # Escala simétrica por vetor: o maior valor absoluto vira 127
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Tipo de armazenamento de embeddings inválido: {dtype}")
+
+# Função para reconstruir vetores float32 a partir do formato quantizado
+def dequantize_vectors(codes: np.ndarray, scales: np.ndarray, dtype: str) -> np.ndarray:
+    if dtype == 'int8':
+        return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+    return np.asarray(codes, dtype=np.float32)
+
+# Cache em disco de embeddings indexado pelo hash do chunk
+class EmbeddingCache:
+    def __init__(self, path: str = EMBEDDING_CACHE_FILE, dtype: str = EMBEDDING_STORAGE_DTYPE):
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Tipo de armazenamento de embeddings inválido: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "hash TEXT PRIMARY KEY, dtype TEXT NOT NULL, dim INTEGER NOT NULL, "
+            "scale REAL NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, hashes: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            # O SQLite limita a quantidade de parâmetros por consulta
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, dtype, dim, scale, vector FROM embeddings WHERE hash IN ({placeholders})", batch
+                ).fetchall()
+                for chunk_hash, dtype, dim, scale, blob in rows:
+                    codes = np.frombuffer(blob, dtype=np.dtype(dtype)).reshape(1, dim)
+                    found[chunk_hash] = dequantize_vectors(codes, np.array([scale]), dtype)[0]
+        return found
+
+    def put_many(self, hashes: List[str], vectors: np.ndarray):
+        if not hashes:
+            return
+        codes, scales = quantize_vectors(vectors, self.dtype)
+        rows = [
+            (chunk_hash, self.dtype, codes.shape[1], float(scale), codes[i].tobytes())
+            for i, (chunk_hash, scale) in enumerate(zip(hashes, scales))
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+# Base comum às engines: cache por hash do chunk e interface compatível com LangChain. Cada
+# engine implementa _encode_uncached (os textos que não estão no cache)
+class CachedEmbeddingEngine(abc.ABC):
+    model_name = EMBEDDING_MODEL
+    dimension = 0
+    cache = None
+
+    @abc.abstractmethod
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        ...
+
+    # Gera embeddings normalizados (float32) reaproveitando o cache em disco. O lock cobre só o
+    # cache e as métricas: o cálculo dos embeddings (requisições HTTP, modelo) fica fora dele
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        hashes = [hash_chunk(text, self.model_name) for text in texts]
+        with self._lock:
+            cached = self.cache.get_many(list(set(hashes))) if self.cache is not None else {}
+            self.stats['cache_hits'] += sum(1 for chunk_hash in hashes if chunk_hash in cached)
+
+        missing = {}
+        for text, chunk_hash in zip(texts, hashes):
+            if chunk_hash not in cached and chunk_hash not in missing:
+                missing[chunk_hash] = text
+        if missing:
+            new_vectors = self._encode_uncached(list(missing.values()))
+            if self.cache is not None:
+                with self._lock:
+                    self.cache.put_many(list(missing.keys()), new_vectors)
+                # Lê de volta do formato armazenado para que cache e memória sejam idênticos
+                codes, scales = quantize_vectors(new_vectors, self.cache.dtype)
+                new_vectors = dequantize_vectors(codes, scales, self.cache.dtype)
+            cached.update(zip(missing.keys(), new_vectors))
+
+        return np.stack([cached[chunk_hash] for chunk_hash in hashes]).astype(np.float32)
+
+    # Interface compatível com LangChain (Chroma.from_texts, retrievers)
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+# Serviço de embeddings local (sentence-transformers em CPU) com lotes adaptativos
+class LocalEmbeddingEngine(CachedEmbeddingEngine):
+    def __init__(self, model_name: str = EMBEDDING_MODEL, device: str = EMBEDDING_DEVICE,
+                 cache: Optional[EmbeddingCache] = None, max_batch_size: int = MAX_BATCH_SIZE):
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.device = device
+        self.model = SentenceTransformer(model_name, device=device)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.batch_tokens = 4096
+        self._lock = threading.Lock()
+        # O modelo (e o orçamento adaptativo dos lotes) atende uma chamada por vez
+        self._model_lock = threading.Lock()
+        self.stats = {'embedded': 0, 'cache_hits': 0, 'batches': 0, 'seconds': 0.0}
+
+    # Agrupa os textos (ordenados por tamanho para reduzir padding) respeitando o orçamento de tokens
+    def _batches(self, texts: List[str], order: List[int]):
+        batch, batch_tokens = [], 0
+        for index in order:
+            tokens = estimate_tokens(texts[index])
+            if batch and (batch_tokens + tokens > self.batch_tokens or len(batch) >= self.max_batch_size):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(index)
+            batch_tokens += tokens
+            if len(batch) == 1 and batch_tokens >= self.batch_tokens:
+                yield batch
+                batch, batch_tokens = [], 0
+        if batch:
+            yield batch
+
+    # Ajusta o orçamento do próximo lote para manter cada lote perto do tempo alvo
+    def _adapt(self, elapsed: float):
+        if elapsed <= 0:
+            return
+        factor = min(2.0, max(0.5, TARGET_BATCH_SECONDS / elapsed))
+        self.batch_tokens = int(min(MAX_BATCH_TOKENS, max(MIN_BATCH_TOKENS, self.batch_tokens * factor)))
+
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        with self._model_lock:
+            return self._encode_model(texts)
+
+    def _encode_model(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for batch in self._batches(texts, order):
+            start_time = time.time()
+            encoded = self.model.encode(
+                [texts[i] for i in batch],
+                batch_size=len(batch),
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            elapsed = time.time() - start_time
+            vectors[batch] = encoded
+            self._adapt(elapsed)
+            self.stats['batches'] += 1
+            self.stats['seconds'] += elapsed
+        self.stats['embedded'] += len(texts)
+        return vectors
+
+# Cliente em lotes e concorrente para servidores de embeddings compatíveis com Ollama
+class OllamaEmbeddingClient(CachedEmbeddingEngine):
+    def __init__(self, model_name: str = OLLAMA_EMBEDDING_MODEL, base_url: str = OLLAMA_BASE_URL,
+                 cache: Optional[EmbeddingCache] = None, batch_size: int = OLLAMA_BATCH_SIZE,
+                 concurrency: int = OLLAMA_CONCURRENCY, max_retries: int = OLLAMA_MAX_RETRIES,
+                 timeout: float = OLLAMA_TIMEOUT):
+        self.model_name = model_name
+        self.base_url = base_url.rstrip('/')
+        self.cache = cache
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.dimension = 0
+        # Servidores antigos só expõem /api/embeddings (um texto por requisição)
+        self.legacy_api = False
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ollama-embed')
+        self.stats = {
+            'embedded': 0, 'cache_hits': 0, 'batches': 0, 'requests': 0,
+            'retries': 0, 'failures': 0, 'seconds': 0.0,
+            # Janela das últimas requisições para os percentis de latência (memória limitada)
+            'request_seconds': collections.deque(maxlen=OLLAMA_LATENCY_WINDOW),
+        }
+
+    # Cada thread do pool mantém sua própria sessão HTTP com conexões keep-alive
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def _post(self, path: str, payload: dict) -> dict:
+        start_time = time.time()
+        response = self._session().post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        with self._metrics_lock:
+            self.stats['requests'] += 1
+            self.stats['request_seconds'].append(time.time() - start_time)
+        response.raise_for_status()
+        return response.json()
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if not self.legacy_api:
+            try:
+                return self._post('/api/embed', {'model': self.model_name, 'input': texts})['embeddings']
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                if response is None or response.status_code != 404:
+                    raise
+                self.legacy_api = True
+        return [self._post('/api/embeddings', {'model': self.model_name, 'prompt': text})['embedding'] for text in texts]
+
+    # Envia um lote com novas tentativas e espera exponencial entre elas
+    def _embed_batch_with_retry(self, texts: List[str]) -> List[List[float]]:
+        backoff_time = 0.5
+        for attempt in range(self.max_retries + 1):
+            try:
+                vectors = self._embed_batch(texts)
+                if len(vectors) != len(texts):
+                    raise ValueError(f"Servidor retornou {len(vectors)} embeddings para {len(texts)} textos.")
+                return vectors
+            except Exception:
+                if attempt == self.max_retries:
+                    with self._metrics_lock:
+                        self.stats['failures'] += 1
+                    raise
+                with self._metrics_lock:
+                    self.stats['retries'] += 1
+                time.sleep(backoff_time)
+                backoff_time = min(backoff_time * 2, 8)
+
+    def _encode_uncached(self, texts: List[str]) -> np.ndarray:
+        start_time = time.time()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        # Os lotes são enviados em paralelo; map preserva a ordem dos resultados
+        results = list(self._executor.map(self._embed_batch_with_retry, batches))
+        vectors = np.asarray([vector for batch in results for vector in batch], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = vectors / norms
+        self.dimension = vectors.shape[1]
+        with self._metrics_lock:
+            self.stats['batches'] += len(batches)
+            self.stats['embedded'] += len(texts)
+            self.stats['seconds'] += time.time() - start_time
+        return vectors
+
+    # Métricas de vazão e latência acumuladas desde a criação do cliente
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            latencies = sorted(self.stats['request_seconds'])
+        seconds = self.stats['seconds']
+        return {
+            'embedded': self.stats['embedded'],
+            'cache_hits': self.stats['cache_hits'],
+            'batches': self.stats['batches'],
+            'requests': self.stats['requests'],
+            'retries': self.stats['retries'],
+            'failures': self.stats['failures'],
+            'chunks_per_second': self.stats['embedded'] / seconds if seconds else 0.0,
+            'p50_request_seconds': latencies[len(latencies) // 2] if latencies else 0.0,
+            'p95_request_seconds': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+# Função para obter a engine compartilhada do processo (o modelo é carregado uma única vez)
+def get_embedding_engine(model_name: str = EMBEDDING_MODEL, device: str = EMBEDDING_DEVICE,
+                         cache_path: Optional[str] = EMBEDDING_CACHE_FILE,
+                         storage_dtype: str = EMBEDDING_STORAGE_DTYPE) -> LocalEmbeddingEngine:
+    key = (model_name, device, cache_path, storage_dtype)
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(key)
+        if engine is None:
+            cache = EmbeddingCache(cache_path, storage_dtype) if cache_path else None
+            engine = LocalEmbeddingEngine(model_name, device, cache)
+            _ENGINES[key] = engine
+        return engine
+
+# Função para obter o cliente Ollama compartilhado do processo
+def get_ollama_embedding_client(model_name: str = OLLAMA_EMBEDDING_MODEL, base_url: str = OLLAMA_BASE_URL,
+                                cache_path: Optional[str] = EMBEDDING_CACHE_FILE,
+                                storage_dtype: str = EMBEDDING_STORAGE_DTYPE) -> OllamaEmbeddingClient:
+    key = ('ollama', model_name, base_url, cache_path, storage_dtype)
+    with _ENGINES_LOCK:
+        client = _ENGINES.get(key)
+        if client is None:
+            cache = EmbeddingCache(cache_path, storage_dtype) if cache_path else None
+            client = OllamaEmbeddingClient(model_name, base_url, cache)
+            _ENGINES[key] = client
+        return client
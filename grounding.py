@@ -0,0 +1,123 @@
+import re
+from typing import List, Optional
+
+import numpy as np
+
+from retrieval import remover_acentos, tokenizar
+
+# Definição de constantes
+CLAIM_MIN_WORDS = 6
+CLAIM_EVIDENCE_K = 3
+SUPPORT_THRESHOLD = 0.6       # similaridade a partir da qual a afirmação é considerada sustentada
+RELATED_THRESHOLD = 0.45      # abaixo disso a melhor passagem nem trata do mesmo assunto
+LEXICAL_SUPPORT_THRESHOLD = 0.6
+
+PADRAO_SENTENCA = re.compile(r'(?<=[.!?;])\s+(?=[A-ZÁÉÍÓÚÂÊÔÃÕÇ0-9"“(])')
+PADRAO_MARCADOR = re.compile(r'^\s*(?:[#>*\-•]+|\d+[.)])\s*')
+PADRAO_NUMERO = re.compile(r'\d+(?:[.,]\d+)*')
+NEGACOES = {'nao', 'nunca', 'jamais', 'nenhum', 'nenhuma', 'nem', 'sem'}
+
+# Função para dividir uma resposta (markdown) em afirmações verificáveis
+def dividir_afirmacoes(texto: str, min_palavras: int = CLAIM_MIN_WORDS) -> List[str]:
+    afirmacoes = []
+    for linha in texto.splitlines():
+        linha = PADRAO_MARCADOR.sub('', linha).replace('**', '').strip()
+        # Títulos e rótulos ("Conclusão:", "1. Introdução") não são afirmações
+        if not linha or linha.endswith(':'):
+            continue
+        for sentenca in PADRAO_SENTENCA.split(linha):
+            sentenca = sentenca.strip()
+            if len(sentenca.split()) >= min_palavras and not sentenca.endswith('?'):
+                afirmacoes.append(sentenca)
+    return list(dict.fromkeys(afirmacoes))
+
+def _numeros(texto: str) -> set:
+    return {numero.rstrip('.,') for numero in PADRAO_NUMERO.findall(texto)}
+
+def _negada(texto: str) -> bool:
+    return bool(NEGACOES & set(re.findall(r'\w+', remover_acentos(texto.lower()))))
+
+# Função para medir a cobertura lexical da afirmação pela passagem (usada sem embeddings)
+def cobertura_lexical(afirmacao: str, passagem: str) -> float:
+    termos = set(tokenizar(afirmacao))
+    if not termos:
+        return 0.0
+    return len(termos & set(tokenizar(passagem))) / len(termos)
+
+# Função para detectar, sem LLM, sinais de contradição entre uma afirmação e a frase da passagem que
+# mais se parece com ela: números que não aparecem na passagem ou negação invertida
+def sinais_contradicao(afirmacao: str, passagem: str) -> List[str]:
+    frases = [frase for frase in re.split(r'(?<=[.!?;])\s+|\n+', passagem) if frase.strip()] or [passagem]
+    frase = max(frases, key=lambda item: cobertura_lexical(afirmacao, item))
+    sinais = []
+    numeros_afirmacao, numeros_frase = _numeros(afirmacao), _numeros(frase)
+    ausentes = numeros_afirmacao - _numeros(passagem)
+    if ausentes and numeros_frase:
+        sinais.append(f"números divergentes ({', '.join(sorted(ausentes))} vs {', '.join(sorted(numeros_frase))})")
+    if cobertura_lexical(afirmacao, frase) >= 0.5 and _negada(afirmacao) != _negada(frase):
+        sinais.append("negação invertida")
+    return sinais
+
+# Verifica cada afirmação contra as passagens recuperadas do índice de referências.
+# A pontuação de suporte é a maior similaridade de cosseno entre a afirmação e suas evidências
+# (ou a cobertura lexical, quando o recuperador não tem modelo de embeddings).
+def verificar_afirmacoes(afirmacoes: List[str], retriever, k: int = CLAIM_EVIDENCE_K,
+                         limiar: float = SUPPORT_THRESHOLD, limiar_relacionado: float = RELATED_THRESHOLD) -> List[dict]:
+    evidencias = [retriever.search(afirmacao, k) for afirmacao in afirmacoes]
+    embedder = getattr(retriever, 'embedder', None)
+    if embedder is not None:
+        textos = list(dict.fromkeys(p['text'] for passagens in evidencias for p in passagens))
+        posicoes = {texto: i for i, texto in enumerate(textos)}
+        # Um único lote para afirmações e passagens; o cache de embeddings evita recalcular os chunks
+        vetores = embedder.encode(afirmacoes + textos)
+        vetores_afirmacoes, vetores_passagens = vetores[:len(afirmacoes)], vetores[len(afirmacoes):]
+    else:
+        limiar, limiar_relacionado = LEXICAL_SUPPORT_THRESHOLD, LEXICAL_SUPPORT_THRESHOLD / 2
+
+    resultados = []
+    for i, (afirmacao, passagens) in enumerate(zip(afirmacoes, evidencias)):
+        melhor, melhor_score = None, 0.0
+        for passagem in passagens:
+            if embedder is not None:
+                score = float(np.dot(vetores_afirmacoes[i], vetores_passagens[posicoes[passagem['text']]]))
+            else:
+                score = cobertura_lexical(afirmacao, passagem['text'])
+            if melhor is None or score > melhor_score:
+                melhor, melhor_score = passagem, score
+        sinais = sinais_contradicao(afirmacao, melhor['text']) if melhor is not None and melhor_score >= limiar_relacionado else []
+        if sinais:
+            status = 'contradicted'
+        elif melhor_score >= limiar:
+            status = 'supported'
+        else:
+            status = 'unsupported'
+        resultados.append({'claim': afirmacao, 'status': status, 'score': melhor_score, 'evidence': melhor, 'signals': sinais})
+    return resultados
+
+# Função para resumir a verificação local em markdown
+def formatar_verificacao(resultados: List[dict]) -> str:
+    if not resultados:
+        return "Nenhuma afirmação verificável encontrada na resposta."
+    contagem = {status: sum(1 for r in resultados if r['status'] == status) for status in ('supported', 'unsupported', 'contradicted')}
+    linhas = [
+        f"**Verificação nas referências:** {contagem['supported']} sustentadas, "
+        f"{contagem['unsupported']} sem suporte e {contagem['contradicted']} possivelmente contraditórias "
+        f"de {len(resultados)} afirmações.",
+    ]
+    rotulos = {'supported': 'Sustentada', 'unsupported': 'Sem suporte', 'contradicted': 'Possível contradição'}
+    for resultado in resultados:
+        fonte = ""
+        if resultado['evidence'] is not None:
+            metadata = resultado['evidence'].get('metadata', {})
+            local = metadata.get('json_path') or metadata.get('page_start', metadata.get('page', ''))
+            fonte = f" — {metadata.get('source', 'Fonte Desconhecida')} {local}".rstrip()
+        sinais = f" ({'; '.join(resultado['signals'])})" if resultado['signals'] else ""
+        linhas.append(f"- {rotulos[resultado['status']]} [{resultado['score']:.2f}]{sinais}: {resultado['claim']}{fonte}")
+    return "\n".join(linhas)
+
+# Função para selecionar as afirmações que precisam de comentário do LLM
+def afirmacoes_para_revisao(resultados: List[dict], limite: Optional[int] = None) -> List[dict]:
+    pendentes = [r for r in resultados if r['status'] != 'supported']
+    # Contradições primeiro, depois as de menor suporte
+    pendentes.sort(key=lambda r: (r['status'] != 'contradicted', r['score']))
+    return pendentes[:limite] if limite else pendentes
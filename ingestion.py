@@ -0,0 +1,449 @@
+import io
+import os
+import re
+import json
+import math
+import shutil
+import unicodedata
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Definição de constantes
+CSV_CHUNKSIZE = 50_000
+CSV_ROWS_PER_UNIT = 20
+COLUMN_STORE_DIR = 'column_store'
+COLUMN_STORE_BLOCK_ROWS = 1_000_000
+MAX_CATEGORIES = 65_536
+JSON_READ_SIZE = 1 << 16
+JSON_MAX_DEPTH = 4
+CONTINUACAO_NUMERO = frozenset('0123456789.eE+-')   # caracteres que ainda fazem parte de um número JSON
+
+# Operadores aceitos nos filtros do armazenamento colunar
+OPERADORES = {
+    '=': np.equal, '==': np.equal, '!=': np.not_equal,
+    '>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+}
+AGREGACOES = ('count', 'sum', 'mean', 'min', 'max')
+# Operadores de ordem, que só fazem sentido em colunas numéricas
+OPERADORES_ORDEM = ('>', '>=', '<', '<=')
+PADRAO_MILHAR_PONTO = re.compile(r'-?\d{1,3}(\.\d{3})+')
+
+# Função para gerar um nome de diretório seguro a partir do nome do arquivo
+def nome_seguro(nome: str) -> str:
+    nome = unicodedata.normalize('NFKD', nome).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', nome) or 'arquivo'
+
+# Função para interpretar um número escrito em pt-BR ou en-US ("2.020,5", "1.000", "3,5", "2,020.5").
+# Com os dois separadores, o último é o decimal; só com ponto em grupos de três dígitos, é milhar.
+# Retorna None quando o texto não é um número.
+def interpretar_numero(texto: str) -> Optional[float]:
+    texto = texto.strip().rstrip('.,')
+    if ',' in texto and '.' in texto:
+        if texto.rfind(',') > texto.rfind('.'):
+            texto = texto.replace('.', '').replace(',', '.')
+        else:
+            texto = texto.replace(',', '')
+    elif ',' in texto:
+        if texto.count(',') > 1:
+            return None
+        texto = texto.replace(',', '.')
+    elif PADRAO_MILHAR_PONTO.fullmatch(texto):
+        texto = texto.replace('.', '')
+    try:
+        return float(texto)
+    except ValueError:
+        return None
+
+# Função para normalizar texto para comparação (minúsculas, sem acentos)
+def normalizar(texto: str) -> str:
+    return unicodedata.normalize('NFKD', str(texto).lower()).encode('ascii', 'ignore').decode('ascii')
+
+# Função para ler o valor de uma condição no início do texto: entre aspas, a categoria mais longa
+# citada (permite valores com várias palavras, como "são paulo") ou uma única palavra/número
+def ler_valor_condicao(texto: str, categorias: Dict[str, str]) -> Optional[str]:
+    aspas = re.match(r'["\']([^"\']+)["\']', texto)
+    if aspas:
+        valor = aspas.group(1).strip()
+        return categorias.get(valor, valor)
+    for normalizada in sorted(categorias, key=len, reverse=True):
+        if normalizada and re.match(rf'{re.escape(normalizada)}(?!\w)', texto):
+            return categorias[normalizada]
+    palavra = re.match(r'[\w.,-]+', texto)
+    return palavra.group(0).rstrip('.,') if palavra else None
+
+# Função para formatar uma linha do CSV com os nomes das colunas
+def formatar_linha(colunas: List[str], valores) -> str:
+    return " | ".join(f"{coluna}: {valor}" for coluna, valor in zip(colunas, valores) if not pd.isna(valor))
+
+# Armazenamento colunar tipado em disco: um arquivo binário por coluna, lido via memória mapeada.
+# Colunas numéricas são reduzidas ao menor tipo que comporta os valores; textos de baixa
+# cardinalidade viram códigos inteiros com dicionário. Demais colunas textuais não são armazenadas.
+class ColumnStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.schema = {'rows': 0, 'columns': {}}
+        schema_path = os.path.join(path, 'schema.json')
+        if os.path.exists(schema_path):
+            with open(schema_path, 'r', encoding='utf-8') as file:
+                self.schema = json.load(file)
+
+    @classmethod
+    def create(cls, path: str) -> 'ColumnStore':
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return cls(path)
+
+    @property
+    def rows(self) -> int:
+        return self.schema['rows']
+
+    def _arquivo(self, coluna: str) -> str:
+        return os.path.join(self.path, f"{self.schema['columns'][coluna]['file']}.bin")
+
+    def _promover(self, coluna: str, novo_tipo: str):
+        info = self.schema['columns'][coluna]
+        if os.path.exists(self._arquivo(coluna)):
+            antigos = np.fromfile(self._arquivo(coluna), dtype=info['dtype'])
+            antigos.astype(novo_tipo).tofile(self._arquivo(coluna))
+        info['dtype'] = novo_tipo
+
+    def _tipo_numerico(self, serie: pd.Series) -> Optional[str]:
+        if pd.api.types.is_bool_dtype(serie):
+            return 'int8'
+        if pd.api.types.is_integer_dtype(serie):
+            return str(pd.to_numeric(serie, downcast='integer').dtype)
+        if pd.api.types.is_float_dtype(serie):
+            return 'float32' if serie.dropna().abs().max() < 3e38 else 'float64'
+        return None
+
+    def append(self, bloco: pd.DataFrame):
+        for posicao, coluna in enumerate(bloco.columns):
+            coluna = str(coluna)
+            serie = bloco.iloc[:, posicao]
+            info = self.schema['columns'].get(coluna)
+            tipo = self._tipo_numerico(serie)
+            if info is None:
+                kind = 'numeric' if tipo else 'category'
+                info = {'kind': kind, 'dtype': tipo or 'int32', 'file': f"c{len(self.schema['columns'])}", 'categories': []}
+                self.schema['columns'][coluna] = info
+                # Linhas anteriores (colunas que surgem depois) ficam como ausentes
+                self._ausentes(coluna, self.rows)
+            if info['kind'] == 'skipped':
+                continue
+            if info['kind'] == 'numeric':
+                if tipo is None:
+                    serie = pd.to_numeric(serie, errors='coerce')
+                    tipo = 'float64'
+                if np.result_type(info['dtype'], tipo) != np.dtype(info['dtype']):
+                    # Valores que não cabem no tipo atual promovem a coluna inteira (raro, uma vez)
+                    self._promover(coluna, str(np.result_type(info['dtype'], tipo)))
+                if np.issubdtype(np.dtype(info['dtype']), np.integer) and serie.isna().any():
+                    self._promover(coluna, 'float64')
+                valores = serie.to_numpy(dtype=info['dtype'])
+            else:
+                indices = {valor: i for i, valor in enumerate(info['categories'])}
+                codigos = np.empty(len(serie), dtype=np.int32)
+                for i, valor in enumerate(serie.astype(object)):
+                    if pd.isna(valor):
+                        codigos[i] = -1
+                        continue
+                    valor = str(valor)
+                    if valor not in indices:
+                        indices[valor] = len(info['categories'])
+                        info['categories'].append(valor)
+                    codigos[i] = indices[valor]
+                if len(info['categories']) > MAX_CATEGORIES:
+                    # Texto livre não é filtrável de forma compacta: a coluna fica só no índice textual
+                    info.update(kind='skipped', categories=[])
+                    os.remove(self._arquivo(coluna))
+                    continue
+                valores = codigos
+            with open(self._arquivo(coluna), 'ab') as file:
+                valores.tofile(file)
+        # Colunas ausentes neste bloco recebem valores ausentes
+        presentes = {str(coluna) for coluna in bloco.columns}
+        for coluna, info in self.schema['columns'].items():
+            if coluna not in presentes and info['kind'] != 'skipped':
+                self._ausentes(coluna, len(bloco))
+        self.schema['rows'] += len(bloco)
+
+    def _ausentes(self, coluna: str, quantidade: int):
+        if quantidade == 0:
+            return
+        info = self.schema['columns'][coluna]
+        if info['kind'] == 'numeric' and np.issubdtype(np.dtype(info['dtype']), np.integer):
+            self._promover(coluna, 'float64')
+        vazio = np.full(quantidade, -1 if info['kind'] == 'category' else np.nan, dtype=info['dtype'])
+        with open(self._arquivo(coluna), 'ab') as file:
+            vazio.tofile(file)
+
+    def save(self):
+        temporario = os.path.join(self.path, 'schema.json.tmp')
+        with open(temporario, 'w', encoding='utf-8') as file:
+            json.dump(self.schema, file, ensure_ascii=False)
+        os.replace(temporario, os.path.join(self.path, 'schema.json'))
+
+    def column(self, coluna: str) -> np.ndarray:
+        info = self.schema['columns'][coluna]
+        if info['kind'] == 'skipped' or self.rows == 0:
+            return np.zeros(0, dtype=info['dtype'])
+        return np.memmap(self._arquivo(coluna), dtype=info['dtype'], mode='r', shape=(self.rows,))
+
+    def _mascara(self, condicoes: List[tuple], inicio: int, fim: int) -> np.ndarray:
+        mascara = np.ones(fim - inicio, dtype=bool)
+        for coluna, operador, valor in condicoes:
+            info = self.schema['columns'][coluna]
+            dados = self.column(coluna)[inicio:fim]
+            if info['kind'] == 'category':
+                # Os códigos das categorias seguem a ordem de chegada, não uma ordem dos valores
+                if operador in OPERADORES_ORDEM:
+                    raise ValueError(f"Comparação de ordem em coluna não numérica: {coluna} {operador}")
+                if str(valor) not in info['categories']:
+                    mascara &= operador == '!='
+                    continue
+                valor = info['categories'].index(str(valor))
+            mascara &= OPERADORES[operador](dados, valor)
+        return mascara
+
+    # Filtra e agrega em blocos, mantendo a memória limitada independentemente do tamanho do arquivo
+    def aggregate(self, coluna: Optional[str], funcao: str, condicoes: Optional[List[tuple]] = None) -> float:
+        if funcao not in AGREGACOES:
+            raise ValueError(f"Agregação inválida: {funcao}")
+        condicoes = condicoes or []
+        total, soma, minimo, maximo = 0, 0.0, np.inf, -np.inf
+        for inicio in range(0, self.rows, COLUMN_STORE_BLOCK_ROWS):
+            fim = min(inicio + COLUMN_STORE_BLOCK_ROWS, self.rows)
+            mascara = self._mascara(condicoes, inicio, fim)
+            if coluna is None or funcao == 'count' and self.schema['columns'][coluna]['kind'] != 'numeric':
+                total += int(mascara.sum())
+                continue
+            valores = np.asarray(self.column(coluna)[inicio:fim][mascara], dtype=np.float64)
+            valores = valores[~np.isnan(valores)]
+            total += len(valores)
+            if len(valores):
+                soma += float(valores.sum())
+                minimo = min(minimo, float(valores.min()))
+                maximo = max(maximo, float(valores.max()))
+        if funcao == 'count':
+            return total
+        if total == 0:
+            return float('nan')
+        return {'sum': soma, 'mean': soma / total, 'min': minimo, 'max': maximo}[funcao]
+
+    # Resumo compacto do esquema (tipos e faixas) para orientar o modelo sem enviar as linhas
+    def describe(self) -> str:
+        linhas = [f"{self.rows} linhas"]
+        for coluna, info in self.schema['columns'].items():
+            if info['kind'] == 'numeric':
+                linhas.append(f"- {coluna} ({info['dtype']}): min {self.aggregate(coluna, 'min')}, "
+                              f"max {self.aggregate(coluna, 'max')}, média {self.aggregate(coluna, 'mean')}")
+            elif info['kind'] == 'category':
+                linhas.append(f"- {coluna} (categoria, {len(info['categories'])} valores)")
+        return "\n".join(linhas)
+
+# Palavras que indicam a agregação pedida numa pergunta
+PALAVRAS_AGREGACAO = [
+    (re.compile(r'\b(media|médio|medio)\b'), 'mean'),
+    (re.compile(r'\b(soma|total|somatorio)\b'), 'sum'),
+    (re.compile(r'\b(maximo|maior|max)\b'), 'max'),
+    (re.compile(r'\b(minimo|menor|min)\b'), 'min'),
+    (re.compile(r'\b(quantos|quantas|contagem|numero de)\b'), 'count'),
+]
+
+# Função para responder perguntas numéricas simples com filtros no armazenamento colunar.
+# Reconhece a agregação (média, soma, máximo, mínimo, contagem), a coluna citada e condições
+# no formato "coluna >= valor" (valores de categoria podem ter várias palavras ou vir entre aspas).
+# Retorna None quando a pergunta não pode ser resolvida assim (valor não numérico numa coluna
+# numérica, comparação de ordem ou valor desconhecido numa coluna de categorias, nenhuma linha
+# selecionada pelos filtros).
+def responder_consulta_numerica(pergunta: str, store: ColumnStore) -> Optional[str]:
+    texto = normalizar(pergunta)
+    funcao = next((nome for padrao, nome in PALAVRAS_AGREGACAO if padrao.search(texto)), None)
+    if funcao is None:
+        return None
+
+    colunas = {normalizar(coluna): coluna for coluna, info in store.schema['columns'].items() if info['kind'] != 'skipped'}
+    condicoes, citadas = [], []
+    for normalizada, coluna in sorted(colunas.items(), key=lambda item: -len(item[0])):
+        info = store.schema['columns'][coluna]
+        for match in re.finditer(rf'\b{re.escape(normalizada)}\s*(>=|<=|!=|=|>|<|:)\s*', texto):
+            operador = '=' if match.group(1) == ':' else match.group(1)
+            if info['kind'] == 'numeric':
+                valor = interpretar_numero(ler_valor_condicao(texto[match.end():], {}) or '')
+                if valor is None:
+                    return None
+            elif operador in OPERADORES_ORDEM:
+                return None
+            else:
+                # Categorias comparadas sem acentos e maiúsculas; o filtro usa a grafia original
+                categorias = {}
+                for categoria in info['categories']:
+                    categorias.setdefault(normalizar(categoria), categoria)
+                valor = ler_valor_condicao(texto[match.end():], categorias)
+                if valor not in info['categories']:
+                    return None
+            condicoes.append((coluna, operador, valor))
+        if re.search(rf'\b{re.escape(normalizada)}\b', texto):
+            citadas.append(coluna)
+
+    filtradas = {coluna for coluna, _, _ in condicoes}
+    alvo = next((c for c in citadas if c not in filtradas and store.schema['columns'][c]['kind'] == 'numeric'), None)
+    if alvo is None and funcao != 'count':
+        return None
+    resultado = store.aggregate(alvo, funcao, condicoes)
+    # Nenhuma linha selecionada: melhor deixar a pergunta para o modelo do que responder 0 ou nan
+    if (funcao == 'count' and condicoes and resultado == 0) or (isinstance(resultado, float) and math.isnan(resultado)):
+        return None
+    filtro = " e ".join(f"{coluna} {operador} {valor}" for coluna, operador, valor in condicoes) or "todas as linhas"
+    return f"{funcao}({alvo or '*'}) onde {filtro} = {resultado}"
+
+# Função para ler um CSV em blocos e gerar unidades recuperáveis (grupos de linhas ou grupos por coluna).
+# Se column_store for informado, os blocos também alimentam o armazenamento colunar.
+def iterar_unidades_csv(file, fonte: str, chunksize: int = CSV_CHUNKSIZE, linhas_por_unidade: int = CSV_ROWS_PER_UNIT,
+                        agrupar_por: Optional[str] = None, column_store: Optional[ColumnStore] = None) -> Iterator[dict]:
+    linha_inicial = 0
+    for bloco in pd.read_csv(file, chunksize=chunksize):
+        if column_store is not None:
+            column_store.append(bloco)
+        colunas = [str(coluna) for coluna in bloco.columns]
+        cabecalho = "Colunas: " + ", ".join(colunas)
+        if agrupar_por:
+            # Grupos que atravessam blocos geram mais de uma unidade, cada uma com suas linhas
+            for chave, grupo in bloco.groupby(agrupar_por, sort=False, dropna=False):
+                for inicio in range(0, len(grupo), linhas_por_unidade):
+                    parte = grupo.iloc[inicio:inicio + linhas_por_unidade]
+                    linhas = [formatar_linha(colunas, valores) for valores in parte.itertuples(index=False)]
+                    primeira = linha_inicial + int(parte.index[0] - bloco.index[0])
+                    yield {
+                        'id': f"{fonte}#g{chave}-{primeira}",
+                        'text': f"{cabecalho}\n{agrupar_por} = {chave}\n" + "\n".join(linhas),
+                        'metadata': {'source': fonte, 'group': str(chave), 'row_start': primeira, 'rows': len(parte)},
+                    }
+        else:
+            for inicio in range(0, len(bloco), linhas_por_unidade):
+                parte = bloco.iloc[inicio:inicio + linhas_por_unidade]
+                linhas = [formatar_linha(colunas, valores) for valores in parte.itertuples(index=False)]
+                primeira = linha_inicial + inicio
+                yield {
+                    'id': f"{fonte}#r{primeira}",
+                    'text': f"{cabecalho}\n" + "\n".join(linhas),
+                    'metadata': {'source': fonte, 'row_start': primeira, 'row_end': primeira + len(parte) - 1},
+                }
+        linha_inicial += len(bloco)
+    if column_store is not None:
+        column_store.save()
+
+# Função para abrir (recriando) o armazenamento colunar de um arquivo CSV. Cada sessão tem a sua
+# pasta e o arquivo é identificado pelo nome e pelo hash do conteúdo: uploads diferentes com o
+# mesmo nome, na mesma sessão ou em outra, não compartilham nem sobrescrevem colunas.
+def criar_column_store(fonte: str, sessao: str, hash_conteudo: str, base: str = COLUMN_STORE_DIR) -> ColumnStore:
+    return ColumnStore.create(os.path.join(base, nome_seguro(sessao), f"{nome_seguro(fonte)}-{hash_conteudo[:16]}"))
+
+# Leitor incremental de JSON: percorre arrays (e o objeto raiz) item a item, decodificando
+# cada registro isoladamente com raw_decode sobre um buffer que só guarda o trecho pendente.
+class LeitorJSONIncremental:
+    def __init__(self, file, tamanho_leitura: int = JSON_READ_SIZE):
+        if isinstance(file, (io.TextIOBase,)):
+            self.file = file
+        else:
+            # utf-8-sig: arquivos salvos no Windows costumam começar com BOM
+            self.file = io.TextIOWrapper(file, encoding='utf-8-sig')
+        self.tamanho_leitura = tamanho_leitura
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _carregar(self, tamanho: int) -> bool:
+        if self.eof:
+            return False
+        dados = self.file.read(tamanho)
+        if not dados:
+            self.eof = True
+            return False
+        # Descarta o que já foi consumido para que o buffer não cresça com o documento
+        self.buffer = self.buffer[self.pos:] + dados
+        self.pos = 0
+        return True
+
+    def _espiar(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._carregar(self.tamanho_leitura):
+                return ""
+
+    def _consumir(self, esperado: str):
+        if self._espiar() != esperado:
+            raise json.JSONDecodeError(f"Esperado '{esperado}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def _ler_valor(self):
+        tamanho = self.tamanho_leitura
+        while True:
+            self._espiar()
+            try:
+                valor, fim = self.decoder.raw_decode(self.buffer, self.pos)
+                # Um número cortado pelo bloco ("1." ou "2e") é decodificado só até o corte: se o
+                # número chega ao fim do buffer ou é seguido de um caractere que o continuaria, lê mais
+                numero = isinstance(valor, (int, float)) and not isinstance(valor, bool)
+                if self.eof or (fim < len(self.buffer) and not (numero and self.buffer[fim] in CONTINUACAO_NUMERO)):
+                    self.pos = fim
+                    return valor
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Registro incompleto: lê blocos cada vez maiores para não reprocessar de forma quadrática
+            self._carregar(tamanho)
+            tamanho *= 2
+
+    def _percorrer(self, caminho: str, profundidade: int):
+        inicio = self._espiar()
+        if inicio == '[' and profundidade < JSON_MAX_DEPTH:
+            self._consumir('[')
+            indice = 0
+            while self._espiar() != ']':
+                if indice:
+                    self._consumir(',')
+                yield from self._percorrer(f"{caminho}[{indice}]", profundidade + 1)
+                indice += 1
+            self._consumir(']')
+        elif inicio == '{' and profundidade == 0:
+            # Só o objeto raiz é aberto: seus valores são registros ou coleções de registros
+            self._consumir('{')
+            primeiro = True
+            while self._espiar() != '}':
+                if not primeiro:
+                    self._consumir(',')
+                primeiro = False
+                self._espiar()
+                chave = self._ler_valor()
+                self._consumir(':')
+                yield from self._percorrer(f"{caminho}.{chave}", profundidade + 1)
+            self._consumir('}')
+        elif inicio == "":
+            return
+        else:
+            yield caminho, self._ler_valor()
+
+    def __iter__(self):
+        return self._percorrer("$", 0)
+
+# Função para gerar uma unidade recuperável por registro JSON, com o caminho JSON nos metadados
+def iterar_unidades_json(file, fonte: str) -> Iterator[dict]:
+    for caminho, valor in LeitorJSONIncremental(file):
+        if valor is None:
+            continue
+        texto = valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False)
+        if not texto.strip():
+            continue
+        yield {
+            'id': f"{fonte}#{caminho}",
+            'text': texto,
+            'metadata': {'source': fonte, 'json_path': caminho},
+        }
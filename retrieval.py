@@ -0,0 +1,504 @@
+import os
+import json
+import math
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Definição de constantes
+RERANKER_MODEL = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+RRF_K = 60
+QUERY_CACHE_SIZE = 256
+
+# Modo do índice vetorial: 'flat' (exato), 'ivfpq' (listas invertidas + quantização por produto)
+# ou 'mmap' (segmentos em disco mapeados em memória e compartilhados entre os processos que
+# abrem a mesma pasta)
+VECTOR_INDEX_MODE = os.getenv('VECTOR_INDEX_MODE', 'flat')
+IVFPQ_DEFAULTS = {
+    'nlist': 1024,      # número de listas invertidas (centróides)
+    'm': 16,            # subquantizadores do PQ (a dimensão deve ser divisível por m)
+    'nbits': 8,         # bits por código de subquantizador
+    'nprobe': 16,       # listas visitadas por consulta: maior = mais recall, menos QPS
+    'train_size': 0,    # vetores usados no treino (0 = 64 por lista, no mínimo 39 * 2 ** nbits)
+}
+# Parâmetros aceitos por cada modo do índice vetorial
+VECTOR_INDEX_PARAMS = {
+    'flat': {'dtype'},
+    'ivfpq': set(IVFPQ_DEFAULTS),
+    'mmap': {'path', 'dtype'},
+}
+
+# Orçamento de latência (segundos) de cada estágio da busca híbrida
+DEFAULT_BUDGETS = {
+    'sparse': 0.05,
+    'dense': 0.1,
+    'rerank': 0.8,
+}
+
+# Palavras funcionais do português ignoradas pelo índice esparso
+STOPWORDS_PT = set("""
+a ao aos as à às com como da das de do dos e é em entre era essa esse esta este eu foi for há isso
+isto já la lhe mais mas me mesmo meu minha muito na nas nem no nos o os ou para pela pelas pelo pelos
+por qual quando que quem se sem ser seu seus sua suas são só também te tem ter um uma umas uns você
+""".split())
+
+# Tokens preservam números compostos (8.666/93, 6.023, 2,5) e termos com hífen
+TOKEN_PATTERN = re.compile(r"\d+(?:[./,-]\d+)*|\w+(?:-\w+)*", re.UNICODE)
+
+# Rerankers carregados neste processo
+_RERANKERS = {}
+_RERANKERS_LOCK = threading.Lock()
+
+# Função para remover acentos (busca insensível a acentuação)
+def remover_acentos(texto: str) -> str:
+    normalizado = unicodedata.normalize('NFKD', texto)
+    return ''.join(c for c in normalizado if not unicodedata.combining(c))
+
+# Função para tokenizar textos em português para o índice esparso
+def tokenizar(texto: str) -> List[str]:
+    tokens = []
+    for token in TOKEN_PATTERN.findall(remover_acentos(texto.lower())):
+        if token in STOPWORDS_PT:
+            continue
+        tokens.append(token)
+        # Números compostos também são indexados por partes ("8.666/93" -> "8.666", "93")
+        if not token.isalnum() and token[0].isdigit():
+            tokens.extend(parte for parte in re.split(r"[/,-]", token) if parte and parte != token)
+    return tokens
+
+# Índice invertido BM25 com inclusão e remoção incrementais
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_terms: Dict[str, Counter] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, chunk_id: str, texto: str):
+        if chunk_id in self.doc_lengths:
+            self.remove(chunk_id)
+        termos = Counter(tokenizar(texto))
+        self.doc_terms[chunk_id] = termos
+        self.doc_lengths[chunk_id] = sum(termos.values())
+        self.total_length += self.doc_lengths[chunk_id]
+        for termo, frequencia in termos.items():
+            self.postings.setdefault(termo, {})[chunk_id] = frequencia
+
+    def remove(self, chunk_id: str):
+        termos = self.doc_terms.pop(chunk_id, None)
+        if termos is None:
+            return
+        self.total_length -= self.doc_lengths.pop(chunk_id)
+        for termo in termos:
+            lista = self.postings.get(termo)
+            if lista is not None:
+                lista.pop(chunk_id, None)
+                if not lista:
+                    del self.postings[termo]
+
+    def search(self, consulta: str, k: int = 10) -> List[tuple]:
+        if not self.doc_lengths:
+            return []
+        n_docs = len(self.doc_lengths)
+        media = self.total_length / n_docs or 1.0
+        scores: Dict[str, float] = {}
+        for termo in set(tokenizar(consulta)):
+            lista = self.postings.get(termo)
+            if not lista:
+                continue
+            idf = math.log(1 + (n_docs - len(lista) + 0.5) / (len(lista) + 0.5))
+            for chunk_id, frequencia in lista.items():
+                norma = self.k1 * (1 - self.b + self.b * self.doc_lengths[chunk_id] / media)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequencia * (self.k1 + 1) / (frequencia + norma)
+        melhores = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return melhores[:k]
+
+# Índice vetorial exato (produto interno sobre vetores normalizados)
+class VectorIndex:
+    def __init__(self, dimension: int, dtype: str = 'float32'):
+        self.dimension = dimension
+        self.dtype = np.float16 if dtype == 'float16' else np.float32
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.matrix = np.zeros((0, dimension), dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids: List[str], vectors: np.ndarray):
+        self.remove([chunk_id for chunk_id in ids if chunk_id in self.positions])
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(-1, self.dimension)
+        for chunk_id in ids:
+            self.positions[chunk_id] = len(self.ids)
+            self.ids.append(chunk_id)
+        self.matrix = np.vstack([self.matrix, vectors])
+
+    def remove(self, ids: List[str]):
+        remover = {self.positions[chunk_id] for chunk_id in ids if chunk_id in self.positions}
+        if not remover:
+            return
+        manter = [i for i in range(len(self.ids)) if i not in remover]
+        self.matrix = self.matrix[manter]
+        self.ids = [self.ids[i] for i in manter]
+        self.positions = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+
+    def search(self, vetor: np.ndarray, k: int = 10) -> List[tuple]:
+        if not self.ids:
+            return []
+        scores = self.matrix.astype(np.float32, copy=False) @ np.asarray(vetor, dtype=np.float32)
+        k = min(k, len(self.ids))
+        melhores = np.argpartition(-scores, k - 1)[:k]
+        melhores = melhores[np.argsort(-scores[melhores])]
+        return [(self.ids[i], float(scores[i])) for i in melhores]
+
+    def memory_bytes(self) -> int:
+        return self.matrix.nbytes
+
+    def save(self, path: str):
+        np.save(f"{path}.npy", self.matrix)
+        with open(f"{path}.ids.json", 'w', encoding='utf-8') as file:
+            json.dump({'mode': 'flat', 'ids': self.ids}, file)
+
+    @classmethod
+    def load(cls, path: str) -> 'VectorIndex':
+        matrix = np.load(f"{path}.npy")
+        with open(f"{path}.ids.json", 'r', encoding='utf-8') as file:
+            ids = json.load(file)['ids']
+        index = cls(matrix.shape[1], 'float16' if matrix.dtype == np.float16 else 'float32')
+        index.matrix = matrix
+        index.ids = ids
+        index.positions = {chunk_id: i for i, chunk_id in enumerate(ids)}
+        return index
+
+# Índice IVF-PQ (faiss) para bibliotecas com milhões de chunks. Até acumular vetores suficientes
+# para o treino, os vetores ficam num buffer consultado de forma exata; depois o índice é treinado
+# com uma amostra e recebe inclusões incrementais.
+class IVFPQIndex:
+    def __init__(self, dimension: int, **params):
+        import faiss
+
+        self.faiss = faiss
+        self.dimension = dimension
+        self.params = dict(IVFPQ_DEFAULTS, **params)
+        if dimension % self.params['m']:
+            raise ValueError(f"A dimensão {dimension} deve ser divisível por m={self.params['m']}.")
+        # O k-means do PQ pede ao menos 39 pontos por centróide (2 ** nbits)
+        self.train_size = self.params['train_size'] or max(64 * self.params['nlist'], 39 * 2 ** self.params['nbits'])
+        quantizer = faiss.IndexFlatIP(dimension)
+        self.index = faiss.IndexIVFPQ(quantizer, dimension, self.params['nlist'], self.params['m'],
+                                      self.params['nbits'], faiss.METRIC_INNER_PRODUCT)
+        self.index.nprobe = self.params['nprobe']
+        self.quantizer = quantizer
+        self.ids: Dict[int, str] = {}
+        self.numeros: Dict[str, int] = {}
+        self.proximo = 0
+        self.pendentes = VectorIndex(dimension)
+
+    def __len__(self) -> int:
+        return self.index.ntotal + len(self.pendentes)
+
+    @property
+    def trained(self) -> bool:
+        return self.index.is_trained
+
+    def set_nprobe(self, nprobe: int):
+        self.params['nprobe'] = nprobe
+        self.index.nprobe = nprobe
+
+    def _numerar(self, ids: List[str]) -> np.ndarray:
+        numeros = []
+        for chunk_id in ids:
+            self.numeros[chunk_id] = self.proximo
+            self.ids[self.proximo] = chunk_id
+            numeros.append(self.proximo)
+            self.proximo += 1
+        return np.asarray(numeros, dtype=np.int64)
+
+    def train(self, amostra: np.ndarray):
+        self.index.train(np.ascontiguousarray(amostra, dtype=np.float32))
+        # Move o buffer exato para o índice treinado
+        if len(self.pendentes):
+            ids, vetores = self.pendentes.ids, self.pendentes.matrix
+            self.pendentes = VectorIndex(self.dimension)
+            self.index.add_with_ids(np.ascontiguousarray(vetores, dtype=np.float32), self._numerar(ids))
+
+    def add(self, ids: List[str], vectors: np.ndarray):
+        self.remove([chunk_id for chunk_id in ids if chunk_id in self.numeros])
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        if self.trained:
+            self.index.add_with_ids(vectors, self._numerar(ids))
+            return
+        self.pendentes.add(ids, vectors)
+        if len(self.pendentes) >= self.train_size:
+            rng = np.random.default_rng(0)
+            amostra = self.pendentes.matrix[rng.choice(len(self.pendentes), self.train_size, replace=False)]
+            self.train(amostra)
+
+    def remove(self, ids: List[str]):
+        self.pendentes.remove(ids)
+        numeros = [self.numeros.pop(chunk_id) for chunk_id in ids if chunk_id in self.numeros]
+        for numero in numeros:
+            del self.ids[numero]
+        if numeros:
+            self.index.remove_ids(np.asarray(numeros, dtype=np.int64))
+
+    def search(self, vetor: np.ndarray, k: int = 10) -> List[tuple]:
+        resultados = self.pendentes.search(vetor, k)
+        if self.index.ntotal:
+            scores, numeros = self.index.search(np.asarray(vetor, dtype=np.float32).reshape(1, -1), k)
+            resultados += [(self.ids[n], float(s)) for s, n in zip(scores[0], numeros[0]) if n >= 0]
+        return sorted(resultados, key=lambda item: item[1], reverse=True)[:k]
+
+    def memory_bytes(self) -> int:
+        return int(self.faiss.serialize_index(self.index).nbytes) + self.pendentes.memory_bytes()
+
+    def save(self, path: str):
+        self.faiss.write_index(self.index, f"{path}.faiss")
+        self.pendentes.save(f"{path}.pending")
+        with open(f"{path}.ids.json", 'w', encoding='utf-8') as file:
+            json.dump({'mode': 'ivfpq', 'params': self.params, 'next': self.proximo,
+                       'ids': {str(n): chunk_id for n, chunk_id in self.ids.items()}}, file)
+
+    @classmethod
+    def load(cls, path: str) -> 'IVFPQIndex':
+        import faiss
+
+        with open(f"{path}.ids.json", 'r', encoding='utf-8') as file:
+            dados = json.load(file)
+        faiss_index = faiss.read_index(f"{path}.faiss")
+        index = cls(faiss_index.d, **dados['params'])
+        index.index = faiss_index
+        index.index.nprobe = index.params['nprobe']
+        index.ids = {int(n): chunk_id for n, chunk_id in dados['ids'].items()}
+        index.numeros = {chunk_id: n for n, chunk_id in index.ids.items()}
+        index.proximo = dados['next']
+        index.pendentes = VectorIndex.load(f"{path}.pending")
+        return index
+
+# Função para criar o índice vetorial no modo configurado. Parâmetros de outro modo são ignorados
+# (os mesmos index_params servem para qualquer VECTOR_INDEX_MODE); nomes desconhecidos são erro.
+def criar_indice_vetorial(dimension: int, mode: str = VECTOR_INDEX_MODE, **params):
+    if mode not in VECTOR_INDEX_PARAMS:
+        raise ValueError(f"Modo de índice vetorial inválido: {mode}")
+    desconhecidos = set(params) - set().union(*VECTOR_INDEX_PARAMS.values())
+    if desconhecidos:
+        raise ValueError(f"Parâmetros de índice vetorial desconhecidos: {', '.join(sorted(desconhecidos))}")
+    params = {nome: valor for nome, valor in params.items() if nome in VECTOR_INDEX_PARAMS[mode]}
+    if mode == 'ivfpq':
+        return IVFPQIndex(dimension, **params)
+    if mode == 'flat':
+        return VectorIndex(dimension, **params)
+    if mode == 'mmap':
+        from vector_store import SharedVectorStore
+
+        return SharedVectorStore(dimension=dimension, **params)
+
+# Função para carregar um índice vetorial salvo (o modo é lido do próprio arquivo)
+def carregar_indice_vetorial(path: str):
+    with open(f"{path}.ids.json", 'r', encoding='utf-8') as file:
+        mode = json.load(file)['mode']
+    return IVFPQIndex.load(path) if mode == 'ivfpq' else VectorIndex.load(path)
+
+# Reranker cross-encoder em CPU com cache de pontuações por (consulta, chunk)
+class CrossEncoderReranker:
+    def __init__(self, model_name: str = RERANKER_MODEL, device: str = 'cpu', batch_size: int = 8):
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device=device)
+        self.batch_size = batch_size
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_size = 4096
+
+    # Pontua os candidatos em pequenos lotes até esgotar o orçamento de tempo
+    def score(self, consulta: str, candidatos: List[tuple], prazo: float) -> Dict[str, float]:
+        pontuacoes = {}
+        pendentes = []
+        for chunk_id, texto in candidatos:
+            chave = (consulta, chunk_id)
+            if chave in self.cache:
+                pontuacoes[chunk_id] = self.cache[chave]
+            else:
+                pendentes.append((chunk_id, texto))
+        for inicio in range(0, len(pendentes), self.batch_size):
+            if time.time() >= prazo:
+                break
+            lote = pendentes[inicio:inicio + self.batch_size]
+            valores = self.model.predict([(consulta, texto) for _, texto in lote], show_progress_bar=False)
+            for (chunk_id, _), valor in zip(lote, valores):
+                pontuacoes[chunk_id] = float(valor)
+                self.cache[(consulta, chunk_id)] = float(valor)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return pontuacoes
+
+# Função para obter o reranker compartilhado do processo
+def get_reranker(model_name: str = RERANKER_MODEL) -> CrossEncoderReranker:
+    with _RERANKERS_LOCK:
+        reranker = _RERANKERS.get(model_name)
+        if reranker is None:
+            reranker = CrossEncoderReranker(model_name)
+            _RERANKERS[model_name] = reranker
+        return reranker
+
+# Função para fundir rankings com Reciprocal Rank Fusion
+def fundir_rankings(rankings: List[List[tuple]], k: int = RRF_K) -> List[tuple]:
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for posicao, (chunk_id, _) in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + posicao + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+# Recuperador híbrido: índice esparso BM25 + índice vetorial, fusão RRF e reranking opcional.
+# Os chunks são dicionários {'id', 'text', 'metadata'}.
+class HybridRetriever:
+    def __init__(self, embedder=None, reranker: Optional[CrossEncoderReranker] = None,
+                 budgets: Optional[dict] = None, candidates: int = 50, rerank_top: int = 20,
+                 index_mode: str = VECTOR_INDEX_MODE, index_params: Optional[dict] = None):
+        self.embedder = embedder
+        self.index_mode = index_mode
+        self.index_params = dict(index_params or {})
+        self.reranker = reranker
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.candidates = candidates
+        self.rerank_top = rerank_top
+        self.chunks: Dict[str, dict] = {}
+        self.sparse = BM25Index()
+        self.dense = None
+        # O armazenamento compartilhado já pode conter vetores publicados por outro processo. Sem
+        # uma pasta própria (index_params['path'], ver vector_store.caminho_armazenamento), cada
+        # recuperador usa uma pasta temporária, para não misturar documentos de outras sessões
+        if index_mode == 'mmap':
+            self.index_params.setdefault('path', tempfile.mkdtemp(prefix='embedding_store_'))
+            self.dense = criar_indice_vetorial(None, index_mode, **self.index_params)
+        self.version = 0
+        self.last_timings: dict = {}
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def add_chunks(self, chunks: List[dict]):
+        self.replace_chunks([], chunks)
+
+    # Remove e inclui chunks numa única seção exclusiva: as consultas veem o estado anterior
+    # ou o novo, nunca um documento pela metade
+    def replace_chunks(self, ids_removidos: List[str], chunks: List[dict]):
+        if not chunks and not ids_removidos:
+            return
+        # Os embeddings são calculados fora do lock; só a aplicação nos índices é exclusiva
+        vetores = None
+        if chunks and self.embedder is not None:
+            vetores = self.embedder.encode([chunk['text'] for chunk in chunks])
+        with self._lock:
+            novos = {chunk['id'] for chunk in chunks}
+            self.remove_chunks([chunk_id for chunk_id in ids_removidos if chunk_id not in novos])
+            for chunk in chunks:
+                self.chunks[chunk['id']] = chunk
+                self.sparse.add(chunk['id'], chunk['text'])
+            if vetores is not None:
+                if self.dense is None:
+                    self.dense = criar_indice_vetorial(vetores.shape[1], self.index_mode, **self.index_params)
+                ids = [chunk['id'] for chunk in chunks]
+                if hasattr(self.dense, 'payload'):
+                    self.dense.add(ids, vetores, [{'text': c['text'], 'metadata': c.get('metadata', {})} for c in chunks])
+                else:
+                    self.dense.add(ids, vetores)
+            self._invalidate()
+
+    def remove_chunks(self, ids: List[str]):
+        with self._lock:
+            for chunk_id in ids:
+                self.chunks.pop(chunk_id, None)
+                self.sparse.remove(chunk_id)
+            if self.dense is not None:
+                self.dense.remove(ids)
+            self._invalidate()
+
+    # Chunks indexados por outro processo só existem no payload do armazenamento compartilhado
+    def _chunk(self, chunk_id: str) -> Optional[dict]:
+        if chunk_id in self.chunks:
+            return self.chunks[chunk_id]
+        if hasattr(self.dense, 'payload'):
+            return self.dense.payload(chunk_id)
+        return None
+
+    def _invalidate(self):
+        self.version += 1
+        self._cache.clear()
+
+    def search(self, consulta: str, k: int = 8) -> List[dict]:
+        with self._lock:
+            # Segmentos publicados por outros processos invalidam o cache de consultas
+            if hasattr(self.dense, 'refresh') and self.dense.refresh():
+                self._invalidate()
+            chave = (consulta, k, self.version)
+            if chave in self._cache:
+                self._cache.move_to_end(chave)
+                return self._cache[chave]
+
+            timings = {}
+            inicio = time.time()
+            esparso = self.sparse.search(consulta, self.candidates)
+            timings['sparse'] = time.time() - inicio
+
+            rankings = [esparso]
+            denso = []
+            if self.dense is not None and len(self.dense):
+                inicio = time.time()
+                denso = self.dense.search(self.embedder.encode([consulta])[0], self.candidates)
+                timings['dense'] = time.time() - inicio
+                rankings.append(denso)
+
+            fundidos = fundir_rankings(rankings)
+            estourou = any(timings[etapa] > self.budgets[etapa] for etapa in timings)
+
+            # O reranking é opcional: é pulado se os estágios anteriores já estouraram o orçamento
+            if self.reranker is not None and fundidos and not estourou:
+                inicio = time.time()
+                topo = fundidos[:self.rerank_top]
+                pontuacoes = self.reranker.score(
+                    consulta, [(chunk_id, self._chunk(chunk_id)['text']) for chunk_id, _ in topo if self._chunk(chunk_id)],
+                    inicio + self.budgets['rerank'],
+                )
+                # Candidatos não pontuados dentro do prazo mantêm a ordem da fusão, após os pontuados
+                reordenados = sorted(
+                    (item for item in topo if item[0] in pontuacoes),
+                    key=lambda item: pontuacoes[item[0]], reverse=True,
+                )
+                reordenados += [item for item in topo if item[0] not in pontuacoes]
+                fundidos = reordenados + fundidos[self.rerank_top:]
+                timings['rerank'] = time.time() - inicio
+
+            esparso_scores = dict(esparso)
+            denso_scores = dict(denso)
+            resultados = []
+            for chunk_id, score in fundidos[:k]:
+                chunk = self._chunk(chunk_id)
+                if chunk is None:
+                    continue
+                resultados.append({
+                    'id': chunk_id,
+                    'text': chunk['text'],
+                    'metadata': chunk.get('metadata', {}),
+                    'score': score,
+                    'sparse_score': esparso_scores.get(chunk_id),
+                    'dense_score': denso_scores.get(chunk_id),
+                })
+
+            self.last_timings = timings
+            self._cache[chave] = resultados
+            while len(self._cache) > QUERY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return resultados
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import pdfplumber
 import json
 import re
@@ -6,9 +7,29 @@ import pandas as pd
 import streamlit as st
 from typing import Tuple
 import time
+import logging
 import matplotlib.pyplot as plt
 import seaborn as sns
 from groq import Groq
+from embeddings import get_embedding_engine
+from retrieval import VECTOR_INDEX_MODE, HybridRetriever, get_reranker
+from vector_store import caminho_armazenamento
+from chunking import chunk_por_secoes, identificar_secoes
+from ingestion import iterar_unidades_json
+from section_index import get_section_index
+from dedup import deduplicar_chunks, deduplicar_passagens, formatar_relatorio
+from watcher import get_reference_watcher
+from context_packer import empacotar_contexto, orcamento_referencias, resumir_descartadas
+from grounding import afirmacoes_para_revisao, dividir_afirmacoes, formatar_verificacao, verificar_afirmacoes
+from usage_log import get_usage_log, get_usage_reader
+from counters import COUNTERS_DB, GLOBAL_SCOPE, escopo_sessao, get_counters
+from usage_rollups import USAGE_ROLLUP_DB, compactar_se_necessario, get_usage_rollups
+from chat_store import REFERENCE_RESPONSE, get_chat_store, hash_entrada
+from async_writer import WRITER_MAX_SPILLS, WRITER_SPILL_DIR, get_async_writer
+from agent_catalog import get_agent_catalog
+from blob_store import BLOB_STORE_DB, expandir_campos, get_blob_store, guardar_campos
+from analytics_export import blob_refs_exportados, exportar, exportar_se_necessario, pyarrow_disponivel
+from session_storage import SESSION_HISTORY_LIMIT, get_session_storage, normalizar_id_sessao
 
 # Configurações da página do Streamlit
 st.set_page_config(
@@ -17,10 +38,38 @@ st.set_page_config(
     layout="wide",
 )
 
+logger = logging.getLogger(__name__)
+
 # Definição de constantes
 FILEPATH = "agents.json"
-CHAT_HISTORY_FILE = 'chat_history.json'
-API_USAGE_FILE = 'api_usage.json'
+CHAT_HISTORY_FILE = 'chat_history.db'
+LEGACY_CHAT_HISTORY_FILE = 'chat_history.json'
+API_USAGE_FILE = 'api_usage.jsonl'
+LEGACY_API_USAGE_FILE = 'api_usage.json'
+API_USAGE_ROLLUPS_FILE = USAGE_ROLLUP_DB
+COUNTERS_FILE = COUNTERS_DB
+BLOB_STORE_FILE = BLOB_STORE_DB
+# Campos de texto guardados no repositório de blobs (os registros ficam só com a referência)
+CAMPOS_TEXTO_USO = ('user_input', 'user_prompt', 'api_response', 'agent_description')
+HISTORY_SEARCH_RESULTS = 10
+# Período do gráfico de tendência de uso (agregados por hora)
+USAGE_TREND_DAYS = 30
+# Arquivos de referência gravados na pasta da sessão (sessoes/<id>/)
+REFERENCES_CSV = 'references.csv'
+REFERENCES_JSON = 'references.json'
+# Índice de seções das referências enviadas, na pasta da sessão
+SESSION_SECTION_INDEX = 'section_index'
+
+# Configuração da recuperação de referências (busca híbrida BM25 + vetorial)
+# Candidatos recuperados; o empacotador inclui os que couberem no orçamento de tokens do prompt
+REFERENCES_CANDIDATES = 24
+# Marcador substituído pelo bloco de referências depois de medir o restante do prompt
+MARCADOR_REFERENCIAS = "\x00REFERENCIAS\x00"
+# Máximo de afirmações sem suporte enviadas ao LLM na avaliação
+MAX_CLAIMS_REVIEW = 12
+USE_RERANKER = os.getenv('USE_RERANKER', '0') == '1'
+# Pasta de referências observada em segundo plano (ativada quando REFERENCES_DIR é definida)
+WATCH_REFERENCES = 'REFERENCES_DIR' in os.environ
 
 MODEL_MAX_TOKENS = {
     'mixtral-8x7b-32768': 32768,
@@ -69,13 +118,13 @@ def handle_rate_limit(error_message: str, action: str):
 
 def load_agent_options() -> list:
     agent_options = ['Escolher um especialista...']
-    if os.path.exists(FILEPATH):
-        with open(FILEPATH, 'r') as file:
-            try:
-                agents = json.load(file)
-                agent_options.extend([agent["agente"] for agent in agents if "agente" in agent])
-            except json.JSONDecodeError:
-                st.error("Erro ao ler o arquivo de Agentes. Por favor, verifique o formato.")
+    # O catálogo só relê o arquivo quando ele muda
+    catalogo = get_agent_catalog(FILEPATH)
+    agent_options.extend(catalogo.names())
+    if catalogo.erro:
+        st.error("Erro ao ler o arquivo de Agentes. Por favor, verifique o formato.")
+    # Especialistas criados há pouco e ainda na fila do gravador
+    agent_options.extend(agent["agente"] for agent in obter_gravador().pendentes('agents'))
     return agent_options
 
 def extrair_texto_pdf(file):
@@ -95,22 +144,6 @@ def text_to_dataframe(texto_paginas):
         dados['Text'].append(entrada['text'])
     return pd.DataFrame(dados)
 
-def identificar_secoes(texto, secao_inicial):
-    secoes = {}
-    secao_atual = secao_inicial
-    secoes[secao_atual] = ""
-
-    paragrafos = texto.split('\n')
-    for paragrafo in paragrafos:
-        match = re.match(r'Parte \d+\.', paragrafo) or re.match(r'Capítulo \d+: .*', paragrafo) or re.match(r'\d+\.\d+ .*', paragrafo)
-        if match:
-            secao_atual = match.group()
-            secoes[secao_atual] = ""
-        else:
-            secoes[secao_atual] += paragrafo + "\n"
-
-    return secoes
-
 def salvar_como_json(dados, caminho_saida):
     with open(caminho_saida, 'w', encoding='utf-8') as file:
         json.dump(dados, file, ensure_ascii=False, indent=4)
@@ -132,10 +165,8 @@ def upload_and_extract_references(uploaded_file):
     references = {}
     try:
         if uploaded_file.name.endswith('.json'):
-            references = json.load(uploaded_file)
-            with open("references.json", 'w') as file:
-                json.dump(references, file, indent=4)
-            return "references.json"
+            # Copia o arquivo como está; os registros são lidos de forma incremental na indexação
+            return obter_armazenamento_sessao().gravar(REFERENCES_JSON, uploaded_file)
         elif uploaded_file.name.endswith('.pdf'):
             texto_paginas = extrair_texto_pdf(uploaded_file)
             if not texto_paginas:
@@ -143,7 +174,7 @@ def upload_and_extract_references(uploaded_file):
                 return pd.DataFrame()
             df = text_to_dataframe(texto_paginas)
             if not df.empty:
-                df.to_csv("references.csv", index=False)
+                obter_armazenamento_sessao().gravar(REFERENCES_CSV, df.to_csv(index=False).encode('utf-8'))
                 return df
             else:
                 st.error("Nenhum texto extraído do PDF.")
@@ -152,10 +183,198 @@ def upload_and_extract_references(uploaded_file):
         st.error(f"Erro ao carregar e extrair referências: {e}")
         return pd.DataFrame()
 
+def carregar_embedder():
+    try:
+        return get_embedding_engine()
+    except Exception as e:
+        st.warning(f"Embeddings locais indisponíveis ({e}). Usando apenas a busca esparsa.")
+        return None
+
+def carregar_reranker():
+    if not USE_RERANKER:
+        return None
+    try:
+        return get_reranker()
+    except Exception as e:
+        st.warning(f"Reranker indisponível ({e}).")
+        return None
+
+# Função para montar os parâmetros do índice vetorial: no modo 'mmap', cada sessão e cada conteúdo
+# têm a sua pasta de armazenamento
+def parametros_indice(hash_conteudo: str, sessao: str = None) -> dict:
+    if VECTOR_INDEX_MODE != 'mmap':
+        return {}
+    return {'path': caminho_armazenamento(sessao or obter_id_sessao(), hash_conteudo)}
+
+def construir_recuperador_referencias(references_df: pd.DataFrame, fonte: str = "references.csv") -> HybridRetriever:
+    texto_paginas = [
+        {'page': int(row['Page']), 'text': row['Text']}
+        for _, row in references_df.iterrows()
+        if isinstance(row.get('Text'), str)
+    ]
+    chunks = chunk_por_secoes(texto_paginas, fonte)
+    # O sumário persistente permite responder "Capítulo 3" ou "seção 2.4" sem busca vetorial. Cada
+    # sessão tem o seu índice e o documento é identificado pelo hash do conteúdo, não pelo nome.
+    st.session_state.references_source = obter_indice_secoes().registrar(fonte, chunks)
+    retriever = HybridRetriever(embedder=carregar_embedder(), reranker=carregar_reranker(),
+                                index_params=parametros_indice(st.session_state.references_source))
+    chunks, relatorio = deduplicar_chunks(chunks)
+    st.session_state.dedup_report = formatar_relatorio(relatorio)
+    retriever.add_chunks(chunks)
+    return retriever
+
+def construir_recuperador_json(caminho: str, fonte: str) -> HybridRetriever:
+    st.session_state.references_source = None
+    conteudo = hashlib.sha1()
+    with open(caminho, 'rb') as file:
+        for bloco in iter(lambda: file.read(1 << 20), b''):
+            conteudo.update(bloco)
+    retriever = HybridRetriever(embedder=carregar_embedder(), index_params=parametros_indice(conteudo.hexdigest()[:16]))
+    lote = []
+    with open(caminho, 'rb') as file:
+        for unidade in iterar_unidades_json(file, fonte):
+            lote.append(unidade)
+            if len(lote) >= 1000:
+                retriever.add_chunks(lote)
+                lote = []
+    retriever.add_chunks(lote)
+    return retriever
+
+# Função para obter o observador da pasta de referências compartilhada (um por processo)
+def obter_observador_referencias():
+    if not WATCH_REFERENCES:
+        return None
+    # A biblioteca observada é a mesma para todas as sessões: pasta comum, identificada pelo caminho
+    pasta = hashlib.sha1(os.path.abspath(os.environ['REFERENCES_DIR']).encode('utf-8')).hexdigest()[:16]
+    return get_reference_watcher(lambda: HybridRetriever(embedder=carregar_embedder(), reranker=carregar_reranker(),
+                                                         index_params=parametros_indice(pasta, 'referencias')))
+
+def obter_recuperador_referencias(references_df: pd.DataFrame) -> HybridRetriever:
+    if st.session_state.get('references_retriever') is None and references_df is not None and not references_df.empty:
+        st.session_state.references_retriever = construir_recuperador_referencias(references_df)
+    retriever = st.session_state.get('references_retriever')
+    # Sem upload nesta sessão, a busca usa a biblioteca da pasta observada
+    if retriever is None:
+        observador = obter_observador_referencias()
+        if observador is not None:
+            retriever = observador.retriever
+    return retriever
+
+def obter_indice_secoes():
+    return get_section_index(obter_armazenamento_sessao().caminho(SESSION_SECTION_INDEX))
+
+def recuperar_passagens_referencias(consulta: str, references_df: pd.DataFrame, k: int = REFERENCES_CANDIDATES) -> list:
+    # O recuperador é construído antes da consulta ao sumário: é ele que registra o documento
+    # no índice de seções, inclusive na primeira pergunta depois de recarregar a página
+    retriever = obter_recuperador_referencias(references_df)
+    passagens = []
+    chave = st.session_state.get('references_source')
+    if chave:
+        passagens = obter_indice_secoes().buscar(consulta, chave)
+    if not passagens:
+        if retriever is None:
+            return []
+        passagens = retriever.search(consulta, k)
+    return deduplicar_passagens(passagens)
+
+# Função para substituir o marcador de referências do prompt pelas passagens que cabem na janela do modelo
+def inserir_referencias(prompt: str, passagens: list, model_name: str) -> str:
+    orcamento = orcamento_referencias(prompt.replace(MARCADOR_REFERENCIAS, ""), get_max_tokens(model_name))
+    references_context, _, descartadas = empacotar_contexto(passagens, orcamento)
+    st.session_state.references_dropped = resumir_descartadas(descartadas, orcamento)
+    return prompt.replace(MARCADOR_REFERENCIAS, references_context)
+
 def get_max_tokens(model_name: str) -> int:
     return MODEL_MAX_TOKENS.get(model_name, 4096)
 
-def log_api_usage(action: str, interaction_number: int, tokens_used: int, time_taken: float, user_input: str, user_prompt: str, api_response: str, agent_used: str, agent_description: str):
+# Função para obter o identificador da sessão. O parâmetro ?usuario= na URL mantém o mesmo
+# espaço (histórico, uso e referências) entre recarregamentos da página; sem ele cada sessão
+# do navegador recebe um identificador próprio.
+def obter_id_sessao() -> str:
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = normalizar_id_sessao(st.query_params.get('usuario'))
+    return st.session_state.session_id
+
+def obter_armazenamento_sessao():
+    return get_session_storage(obter_id_sessao())
+
+# Funções de gravação em lote, executadas pela thread do gravador (sem acesso ao st)
+def gravar_uso_api(entradas):
+    log = get_usage_log(API_USAGE_FILE, LEGACY_API_USAGE_FILE)
+    rollups = get_usage_rollups(API_USAGE_ROLLUPS_FILE)
+    contadores = get_counters(COUNTERS_FILE)
+    # Contadores criados antes da gravação do lote, com as chamadas que já estavam registradas
+    for escopo, sessao in [(GLOBAL_SCOPE, None)] + [(escopo_sessao(s), s) for s in {e.get('session_id') for e in entradas}]:
+        if contadores.get(escopo) is None:
+            contadores.initialize(escopo, rollups.total_chamadas(sessao) + len(get_usage_reader(API_USAGE_FILE).read(sessao)))
+    # Única etapa que o gravador repete se falhar: o lote vai para o log numa só escrita.
+    # Depois dela nenhuma falha é propagada, para que uma nova tentativa não grave o lote de novo.
+    log.append_many(guardar_campos(entradas, CAMPOS_TEXTO_USO, get_blob_store(BLOB_STORE_FILE)))
+    escopos = set()
+    try:
+        incrementos = {}
+        for entrada in entradas:
+            escopo = escopo_sessao(entrada.get('session_id'))
+            escopos.update((escopo, GLOBAL_SCOPE))
+            if 'log_reset' in entrada:
+                contadores.increment_many(incrementos)
+                incrementos = {}
+                contadores.set(escopo, 0)
+                rollups.apagar_sessao(entrada['session_id'])
+            else:
+                incrementos[escopo] = incrementos.get(escopo, 0) + 1
+                incrementos[GLOBAL_SCOPE] = incrementos.get(GLOBAL_SCOPE, 0) + 1
+        contadores.increment_many(incrementos)
+    except Exception:
+        # Contadores possivelmente incompletos: são descartados e recontados a partir do log
+        # (que já contém o lote) na próxima gravação
+        logger.exception("Falha ao atualizar os contadores de %d chamadas", len(entradas))
+        try:
+            contadores.discard(escopos)
+        except Exception:
+            logger.exception("Falha ao descartar os contadores %s", sorted(escopos))
+    # Exportação colunar para análise, antes de a compactação remover entradas brutas do log
+    try:
+        if pyarrow_disponivel():
+            exportar_se_necessario(API_USAGE_FILE, obter_historico(), rollups, get_blob_store(BLOB_STORE_FILE))
+    except Exception:
+        logger.exception("Falha na exportação para análise; nova tentativa no próximo intervalo")
+    # Entradas mais antigas que a retenção viram agregados por minuto/hora e saem do log
+    # (e os textos que só as entradas removidas referenciavam saem do repositório de blobs; os
+    # citados pelo histórico ou pelas tabelas exportadas para análise continuam)
+    try:
+        compactar_se_necessario(log, rollups, blobs=get_blob_store(BLOB_STORE_FILE),
+                                outras_referencias=lambda: obter_historico().blob_refs() | blob_refs_exportados())
+    except Exception:
+        logger.exception("Falha na compactação do log de uso; nova tentativa no próximo intervalo")
+
+def gravar_historico(entradas):
+    store = obter_historico()
+    lote = []
+    for entrada in entradas:
+        if entrada.get('clear'):
+            store.save_many(lote)
+            lote = []
+            store.clear(entrada['session_id'])
+        else:
+            lote.append(entrada)
+    store.save_many(lote)
+
+def gravar_especialistas(novos):
+    get_agent_catalog(FILEPATH).add(novos)
+
+def obter_gravador():
+    # O log e o histórico são abertos antes do gravador: no encerramento (atexit, ordem inversa)
+    # o gravador é esvaziado antes de eles serem fechados
+    get_usage_log(API_USAGE_FILE, LEGACY_API_USAGE_FILE)
+    obter_historico()
+    gravador = get_async_writer()
+    gravador.register('api_usage', gravar_uso_api)
+    gravador.register('chat_history', gravar_historico)
+    gravador.register('agents', gravar_especialistas)
+    return gravador
+
+def log_api_usage(action: str, interaction_number: int, tokens_used: int, time_taken: float, user_input: str, user_prompt: str, api_response: str, agent_used: str, agent_description: str, model_name: str = "", api_key: str = ""):
     entry = {
         'action': action,
         'interaction_number': interaction_number,
@@ -165,63 +384,82 @@ def log_api_usage(action: str, interaction_number: int, tokens_used: int, time_t
         'user_prompt': user_prompt,
         'api_response': api_response,
         'agent_used': agent_used,
-        'agent_description': agent_description
+        'agent_description': agent_description,
+        'session_id': obter_id_sessao(),
+        'model': model_name,
+        # Só o final da chave identifica a chave nos agregados
+        'api_key': f"...{api_key[-4:]}" if api_key else ""
     }
-    if os.path.exists(API_USAGE_FILE):
-        with open(API_USAGE_FILE, 'r+') as file:
-            api_usage = json.load(file)
-            api_usage.append(entry)
-            file.seek(0)
-            json.dump(api_usage, file, indent=4)
-    else:
-        with open(API_USAGE_FILE, 'w') as file:
-            json.dump([entry], file, indent=4)
+    entry['timestamp'] = time.time()
+    # Só enfileira: o gravador em segundo plano acrescenta as linhas ao log em lotes
+    obter_gravador().submit('api_usage', entry)
+
+# Histórico do chat (SQLite): os textos grandes vão para o repositório de blobs e todos os
+# textos entram no índice de busca
+def obter_historico(chat_history_file=CHAT_HISTORY_FILE):
+    return get_chat_store(chat_history_file, LEGACY_CHAT_HISTORY_FILE, SESSION_HISTORY_LIMIT, get_blob_store(BLOB_STORE_FILE))
+
+def buscar_historico(consulta, limit=HISTORY_SEARCH_RESULTS):
+    return obter_historico().search(consulta, obter_id_sessao(), limit)
 
-def save_chat_history(user_input, user_prompt, expert_response, chat_history_file=CHAT_HISTORY_FILE):
+def save_chat_history(user_input, user_prompt, expert_response):
     chat_entry = {
         'user_input': user_input,
         'user_prompt': user_prompt,
-        'expert_response': expert_response
+        'expert_response': expert_response,
+        'session_id': obter_id_sessao(),
+        'timestamp': time.time()
     }
-    if os.path.exists(chat_history_file):
-        with open(chat_history_file, 'r+') as file:
-            try:
-                chat_history = json.load(file)
-            except json.JSONDecodeError:
-                chat_history = []
-            chat_history.append(chat_entry)
-            file.seek(0)
-            json.dump(chat_history, file, indent=4)
-    else:
-        with open(chat_history_file, 'w') as file:
-            json.dump([chat_entry], file, indent=4)
-
-def load_chat_history(chat_history_file=CHAT_HISTORY_FILE):
-    if os.path.exists(chat_history_file):
-        with open(chat_history_file, 'r') as file:
-            try:
-                chat_history = json.load(file)
-            except json.JSONDecodeError:
-                chat_history = []
-        return chat_history
-    return []
-
-def clear_chat_history(chat_history_file=CHAT_HISTORY_FILE):
-    if os.path.exists(chat_history_file):
-        os.remove(chat_history_file)
+    obter_gravador().submit('chat_history', chat_entry)
+
+# Aplica à lista lida do disco os registros da sessão ainda na fila do gravador
+def aplicar_pendentes(entradas, destino, marcador):
+    sessao = obter_id_sessao()
+    pendentes = [item for item in obter_gravador().pendentes(destino) if item.get('session_id') == sessao]
+    if not pendentes:
+        return entradas
+    entradas = list(entradas)
+    for item in pendentes:
+        if marcador in item:
+            entradas = []
+        else:
+            entradas.append(item)
+    return entradas
+
+def load_chat_history(limit, chat_history_file=CHAT_HISTORY_FILE):
+    # Consulta indexada das últimas interações: o custo não cresce com o tamanho do histórico
+    chat_history = obter_historico(chat_history_file).last(limit, obter_id_sessao())
+    return aplicar_pendentes(chat_history, 'chat_history', 'clear')[-limit:]
+
+def clear_chat_history():
+    # Enfileirado junto com as gravações, para ser aplicado depois das que já estão na fila
+    obter_gravador().submit('chat_history', {'clear': True, 'session_id': obter_id_sessao()})
+
+# Chamadas da sessão: as já agregadas mais as ainda no log bruto
+def contar_chamadas_api(api_usage) -> int:
+    return get_usage_rollups(API_USAGE_ROLLUPS_FILE).total_chamadas(obter_id_sessao()) + len(api_usage)
+
+# Número de chamadas da sessão pelo contador persistente (uma busca por chave), somando as
+# chamadas ainda na fila do gravador; sem ler o log de uso
+def contar_interacoes() -> int:
+    sessao = obter_id_sessao()
+    valor = get_counters(COUNTERS_FILE).get(escopo_sessao(sessao))
+    if valor is None:
+        valor = contar_chamadas_api(get_usage_reader(API_USAGE_FILE).read(sessao))
+    for item in obter_gravador().pendentes('api_usage'):
+        if item.get('session_id') == sessao:
+            valor = 0 if 'log_reset' in item else valor + 1
+    return valor
 
 def load_api_usage():
-    if os.path.exists(API_USAGE_FILE):
-        with open(API_USAGE_FILE, 'r') as file:
-            try:
-                api_usage = json.load(file)
-            except json.JSONDecodeError:
-                api_usage = []
-        return api_usage
-    return []
+    # Garante a migração do api_usage.json antigo antes da primeira leitura
+    get_usage_log(API_USAGE_FILE, LEGACY_API_USAGE_FILE)
+    # O leitor só interpreta as linhas gravadas desde a última execução do script
+    return aplicar_pendentes(get_usage_reader(API_USAGE_FILE).read(obter_id_sessao()), 'api_usage', 'log_reset')
 
 def plot_api_usage(api_usage):
-    df = pd.DataFrame(api_usage)
+    # Os textos só são lidos do repositório para a tabela exibida
+    df = pd.DataFrame(expandir_campos(api_usage, CAMPOS_TEXTO_USO, get_blob_store(BLOB_STORE_FILE)))
 
     if 'action' not in df.columns:
         st.error("A coluna 'action' não foi encontrada no dataframe de uso da API.")
@@ -253,9 +491,27 @@ def plot_api_usage(api_usage):
     st.sidebar.markdown("### Uso da API - DataFrame")
     st.sidebar.dataframe(df)
 
+# Tendência de uso por hora: agregados do período (consulta limitada pelo período, não pelo log)
+# somados às entradas ainda no log bruto
+def plot_tendencia_uso(api_usage):
+    agregados = pd.DataFrame(get_usage_rollups(API_USAGE_ROLLUPS_FILE).consultar('hour', obter_id_sessao(), time.time() - USAGE_TREND_DAYS * 86400))
+    recentes = pd.DataFrame(api_usage)
+    partes = []
+    if not agregados.empty:
+        partes.append(agregados[['bucket', 'tokens', 'calls']])
+    if not recentes.empty and {'timestamp', 'tokens_used'} <= set(recentes.columns):
+        recentes = recentes.assign(bucket=(recentes['timestamp'] // 3600 * 3600).astype(int), calls=1)
+        partes.append(recentes.rename(columns={'tokens_used': 'tokens'})[['bucket', 'tokens', 'calls']])
+    if not partes:
+        return
+    serie = pd.concat(partes).groupby('bucket')[['tokens', 'calls']].sum()
+    serie.index = pd.to_datetime(serie.index, unit='s')
+    st.sidebar.markdown("### Tendência de Uso (por hora)")
+    st.sidebar.line_chart(serie)
+
 def reset_api_usage():
-    if os.path.exists(API_USAGE_FILE):
-        os.remove(API_USAGE_FILE)
+    # Só descarta o uso desta sessão; o das demais continua no log
+    obter_gravador().submit('api_usage', {'log_reset': time.time(), 'session_id': obter_id_sessao()})
     st.success("Os dados de uso da API foram resetados.")
 
 def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str, temperature: float, agent_selection: str, chat_history: list, interaction_number: int, references_df: pd.DataFrame = None) -> Tuple[str, str]:
@@ -263,7 +519,8 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
     expert_title = ""
     expert_description = ""
     try:
-        client = Groq(api_key=get_next_api_key('fetch'))
+        chave_api = get_next_api_key('fetch')
+        client = Groq(api_key=chave_api)
 
         def get_completion(prompt: str) -> str:
             start_time = time.time()
@@ -286,7 +543,7 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
                     tokens_used = completion.usage.total_tokens
                     time_taken = end_time - start_time
                     api_response = completion.choices[0].message.content if completion.choices else ""
-                    log_api_usage('fetch', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, expert_description)
+                    log_api_usage('fetch', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, expert_description, model_name, chave_api)
                     return api_response
                 except Exception as e:
                     if "503" in str(e):
@@ -343,30 +600,24 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
             else:
                 st.error("Erro ao extrair título e descrição do especialista.")
         else:
-            if os.path.exists(FILEPATH):
-                with open(FILEPATH, 'r') as file:
-                    agents = json.load(file)
-                    agent_found = next((agent for agent in agents if agent["agente"] == agent_selection), None)
-                    if agent_found:
-                        expert_title = agent_found["agente"]
-                        expert_description = agent_found["descricao"]
-                    else:
-                        raise ValueError("Especialista selecionado não encontrado no arquivo.")
-            else:
+            catalogo = get_agent_catalog(FILEPATH)
+            agent_found = catalogo.get(agent_selection)
+            if agent_found is None:
+                agent_found = next((agent for agent in obter_gravador().pendentes('agents') if agent["agente"] == agent_selection), None)
+            if agent_found:
+                expert_title = agent_found["agente"]
+                expert_description = agent_found["descricao"]
+            elif not catalogo.exists():
                 raise FileNotFoundError(f"Arquivo {FILEPATH} não encontrado.")
+            else:
+                raise ValueError("Especialista selecionado não encontrado no arquivo.")
 
         history_context = ""
         for entry in chat_history:
             history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
 
-        references_context = ""
-        if references_df is not None:
-            for index, row in references_df.iterrows():
-                titulo = row.get('titulo', 'Título Desconhecido')
-                autor = row.get('autor', 'Autor Desconhecido')
-                ano = row.get('ano', 'Ano Desconhecido')
-                paginas = row.get('Page', 'Página Desconhecida')
-                references_context += f"Título: {titulo}\nAutor: {autor}\nAno: {ano}\nPáginas: {paginas}\n\n"
+        passagens_referencias = recuperar_passagens_referencias(f"{user_input}\n{user_prompt}", references_df)
+        references_context = MARCADOR_REFERENCIAS
 
         phase_two_prompt = (
                 f"{expert_title}, 请完整、详细并且必须用葡萄牙语回答以下请求：{user_input} 和 {user_prompt}。"
@@ -409,6 +660,7 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
                 f"seed: [自动生成]\n"
                 f"seed: [gerado automaticamente]\n"
         )
+        phase_two_prompt = inserir_referencias(phase_two_prompt, passagens_referencias, model_name)
         phase_two_response = get_completion(phase_two_prompt)
 
     except Exception as e:
@@ -417,9 +669,10 @@ def fetch_assistant_response(user_input: str, user_prompt: str, model_name: str,
 
     return expert_title, phase_two_response
 
-def refine_response(expert_title: str, phase_two_response: str, user_input: str, user_prompt: str, model_name: str, temperature: float, references_context: str, chat_history: list, interaction_number: int) -> str:
+def refine_response(expert_title: str, phase_two_response: str, user_input: str, user_prompt: str, model_name: str, temperature: float, passagens_referencias: list, chat_history: list, interaction_number: int) -> str:
     try:
-        client = Groq(api_key=get_next_api_key('refine'))
+        chave_api = get_next_api_key('refine')
+        client = Groq(api_key=chave_api)
 
         def get_completion(prompt: str) -> str:
             start_time = time.time()
@@ -442,7 +695,7 @@ def refine_response(expert_title: str, phase_two_response: str, user_input: str,
                     tokens_used = completion.usage.total_tokens
                     time_taken = end_time - start_time
                     api_response = completion.choices[0].message.content if completion.choices else ""
-                    log_api_usage('refine', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, "")
+                    log_api_usage('refine', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, "", model_name, chave_api)
                     return api_response
                 except Exception as e:
                     if "503" in str(e):
@@ -457,6 +710,7 @@ def refine_response(expert_title: str, phase_two_response: str, user_input: str,
         for entry in chat_history:
             history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
 
+        references_context = MARCADOR_REFERENCIAS if passagens_referencias else ""
         refine_prompt = (
             f"{expert_title}, 请完善以下回答：{phase_two_response}。原始请求：{user_input} 和 {user_prompt}。"
             f"\n\n聊天记录：{history_context}"
@@ -477,7 +731,7 @@ def refine_response(expert_title: str, phase_two_response: str, user_input: str,
             f"seed: [gerado automaticamente]\n"
         )
 
-        if not references_context:
+        if not passagens_referencias:
             refine_prompt += (
                 f"\n\nDevido à ausência de referências fornecidas, certifique-se de fornecer uma resposta detalhada, precisa e obrigatoriamente em português:, mesmo sem o uso de fontes externas."
                 f"{expert_title}, 请完善以下回答：{phase_two_response}。原始请求：{user_input} 和 {user_prompt}。"
@@ -498,6 +752,7 @@ def refine_response(expert_title: str, phase_two_response: str, user_input: str,
                 f"seed: [自动生成]\n"
             )
 
+        refine_prompt = inserir_referencias(refine_prompt, passagens_referencias, model_name)
         refined_response = get_completion(refine_prompt)
         return refined_response
 
@@ -507,7 +762,8 @@ def refine_response(expert_title: str, phase_two_response: str, user_input: str,
 
 def evaluate_response_with_rag(user_input: str, user_prompt: str, expert_title: str, expert_description: str, assistant_response: str, model_name: str, temperature: float, chat_history: list, interaction_number: int) -> str:
     try:
-        client = Groq(api_key=get_next_api_key('evaluate'))
+        chave_api = get_next_api_key('evaluate')
+        client = Groq(api_key=chave_api)
 
         def get_completion(prompt: str) -> str:
             start_time = time.time()
@@ -530,7 +786,7 @@ def evaluate_response_with_rag(user_input: str, user_prompt: str, expert_title:
                     tokens_used = completion.usage.total_tokens
                     time_taken = end_time - start_time
                     api_response = completion.choices[0].message.content if completion.choices else ""
-                    log_api_usage('evaluate', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, expert_description)
+                    log_api_usage('evaluate', interaction_number, tokens_used, time_taken, user_input, user_prompt, api_response, expert_title, expert_description, model_name, chave_api)
                     return api_response
                 except Exception as e:
                     if "503" in str(e):
@@ -541,33 +797,41 @@ def evaluate_response_with_rag(user_input: str, user_prompt: str, expert_title:
                     st.warning(f"Limite de taxa atingido. Aguardando {backoff_time} segundos...")
                     time.sleep(backoff_time)
 
-        history_context = ""
-        for entry in chat_history:
-            history_context += f"\nUsuário: {entry['user_input']}\nEspecialista: {entry['expert_response']}\n"
+        # Verificação local: cada afirmação da resposta é confrontada com as referências indexadas
+        afirmacoes = dividir_afirmacoes(assistant_response)
+        retriever = obter_recuperador_referencias(st.session_state.get('references_df'))
+        if retriever is None or not len(retriever):
+            st.warning("Nenhuma referência indexada: as afirmações não puderam ser verificadas nas fontes.")
+            resultados = [{'claim': afirmacao, 'status': 'unsupported', 'score': 0.0, 'evidence': None, 'signals': []} for afirmacao in afirmacoes]
+        else:
+            resultados = verificar_afirmacoes(afirmacoes, retriever)
+        relatorio = formatar_verificacao(resultados)
+
+        # Só as afirmações sem suporte ou possivelmente contraditórias vão para o LLM
+        pendentes = afirmacoes_para_revisao(resultados, MAX_CLAIMS_REVIEW)
+        if not pendentes:
+            return relatorio
+
+        afirmacoes_context = ""
+        for numero, resultado in enumerate(pendentes, 1):
+            sinais = f" ({'; '.join(resultado['signals'])})" if resultado['signals'] else ""
+            afirmacoes_context += f"{numero}. [{resultado['status']}{sinais}] {resultado['claim']}\n"
+        evidencias = list({r['evidence']['id']: r['evidence'] for r in pendentes if r['evidence'] is not None}.values())
+        references_context = MARCADOR_REFERENCIAS if evidencias else "无"
 
         rag_prompt = (
-            f"\n\nCertifique-se de fornecer uma resposta detalhada, precisa e obrigatoriamente em português:, mesmo sem o uso de fontes externas."
-            f"{expert_title}, 请评估以下回答：{assistant_response}。原始请求：{user_input} 和 {user_prompt}。"
-            f"\n\n聊天记录：{history_context}"
-            f"\n\n详细描述提供的回答中的可能改进点，并且必须用葡萄牙语：\n"
-            f"\n回答评估和改进说明：\n"
-            f"请使用以下分析和方法评估提供的回答：\n"
-            f"1. SWOT 分析：识别回答中的优势、劣势、机会和威胁。\n"
-            f"2. Q-统计分析：评估回答中所提供信息的统计质量。\n"
-            f"3. Q-指数分析：检查提供数据的相关性和指数适用性。\n"
-            f"4. PESTER 分析：考虑回答中涉及的政治、经济、社会、技术、生态和监管因素。\n"
-            f"5. 连贯性：评估回答的连贯性，检查文本部分之间的流畅性和连接性。\n"
-            f"6. 逻辑性：检查回答的逻辑一致性，确保信息结构合理，整体连贯。\n"
-            f"7. 流畅性：分析文本的流畅性，确保阅读过程轻松愉快。\n"
-            f"8. 差距分析：识别回答中可以进一步发展或澄清的差距或领域。\n"
-            f"\n根据这些分析提供详细的改进建议，确保最终回答全面、准确且结构良好。\n"
-            f"\n---\n"
-            f"\ngen_id: [自动生成]\n"
-            f"seed: [自动生成]\n"
+            f"{expert_title}, 请评估以下回答中未被参考资料支持或可能与参考资料矛盾的陈述。原始请求：{user_input} 和 {user_prompt}。"
+            f"\n\n待核查的陈述：\n{afirmacoes_context}"
+            f"\n\n参考资料：\n{references_context}"
+            f"\n\n评估说明：\n"
+            f"对每一条陈述，请指出它是被参考资料支持、与参考资料矛盾，还是无法根据参考资料核实，并说明理由。"
+            f"对矛盾或无法核实的陈述，请给出更正或改进建议。不要评论回答的其他部分。\n"
+            f"必须用葡萄牙语回答。\n"
         )
+        rag_prompt = inserir_referencias(rag_prompt, evidencias, model_name)
 
         rag_response = get_completion(rag_prompt)
-        return rag_response
+        return f"{relatorio}\n\n{rag_response}"
 
     except Exception as e:
         st.error(f"Ocorreu um erro durante a avaliação com RAG: {e}")
@@ -578,18 +842,7 @@ def save_expert(expert_title: str, expert_description: str):
         "agente": expert_title,
         "descricao": expert_description
     }
-    if os.path.exists(FILEPATH):
-        with open(FILEPATH, 'r+') as file:
-            try:
-                agents = json.load(file)
-            except json.JSONDecodeError:
-                agents = []
-            agents.append(new_expert)
-            file.seek(0)
-            json.dump(agents, file, indent=4)
-    else:
-        with open(FILEPATH, 'w') as file:
-            json.dump([new_expert], file, indent=4)
+    obter_gravador().submit('agents', new_expert)
 
 # Interface Principal com Streamlit
 
@@ -624,7 +877,7 @@ with col1:
     agent_selection = st.selectbox("Escolha um Especialista", options=agent_options, index=0, key="selecao_agente")
     model_name = st.selectbox("Escolha um Modelo", list(MODEL_MAX_TOKENS.keys()), index=0, key="nome_modelo")
     temperature = st.slider("Nível de Criatividade", min_value=0.0, max_value=1.0, value=0.0, step=0.01, key="temperatura")
-    interaction_number = len(load_api_usage()) + 1
+    interaction_number = contar_interacoes() + 1
 
     fetch_clicked = st.button("Buscar Resposta")
     refine_clicked = st.button("Refinar Resposta")
@@ -636,7 +889,7 @@ with col1:
 with col2:
     container_saida = st.container()
 
-    chat_history = load_chat_history()[-memory_selection:]
+    chat_history = load_chat_history(memory_selection)
 
     if fetch_clicked:
         if references_file:
@@ -644,25 +897,27 @@ with col2:
             if isinstance(df, pd.DataFrame):
                 st.write("### Dados Extraídos do PDF")
                 st.dataframe(df)
-                st.session_state.references_path = "references.csv"
+                st.session_state.references_path = obter_armazenamento_sessao().caminho(REFERENCES_CSV)
                 st.session_state.references_df = df
+                st.session_state.references_retriever = construir_recuperador_referencias(df, references_file.name)
+                st.info(f"Deduplicação: {st.session_state.dedup_report}")
+            elif isinstance(df, str):
+                st.session_state.references_df = pd.DataFrame()
+                st.session_state.references_retriever = construir_recuperador_json(df, references_file.name)
 
         st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente = fetch_assistant_response(user_input, user_prompt, model_name, temperature, agent_selection, chat_history, interaction_number, st.session_state.get('references_df'))
         st.session_state.resposta_original = st.session_state.resposta_assistente
         st.session_state.resposta_refinada = ""
+        if st.session_state.get('references_dropped'):
+            st.info(st.session_state.references_dropped)
         save_chat_history(user_input, user_prompt, st.session_state.resposta_assistente)
 
     if refine_clicked:
         if st.session_state.resposta_assistente:
-            references_context = ""
-            if not st.session_state.references_df.empty:
-                for index, row in st.session_state.references_df.iterrows():
-                    titulo = row.get('titulo', row['Text'][:50] + '...')
-                    autor = row.get('autor', 'Autor Desconhecido')
-                    ano = row.get('ano', 'Ano Desconhecido')
-                    paginas = row.get('Page', 'Página Desconhecida')
-                    references_context += f"Título: {titulo}\nAutor: {autor}\nAno: {ano}\nPágina: {paginas}\n\n"
-            st.session_state.resposta_refinada = refine_response(st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente, user_input, user_prompt, model_name, temperature, references_context, chat_history, interaction_number)
+            passagens_referencias = recuperar_passagens_referencias(f"{user_input}\n{user_prompt}", st.session_state.references_df)
+            st.session_state.resposta_refinada = refine_response(st.session_state.descricao_especialista_ideal, st.session_state.resposta_assistente, user_input, user_prompt, model_name, temperature, passagens_referencias, chat_history, interaction_number)
+            if st.session_state.get('references_dropped'):
+                st.info(st.session_state.references_dropped)
             save_chat_history(user_input, user_prompt, st.session_state.resposta_refinada)
         else:
             st.warning("Por favor, busque uma resposta antes de refinar.")
@@ -696,7 +951,10 @@ with col2:
 
 if refresh_clicked:
     clear_chat_history()
+    obter_armazenamento_sessao().limpar()
+    sessao = obter_id_sessao()
     st.session_state.clear()
+    st.session_state.session_id = sessao
     st.rerun()
 
 st.sidebar.image("logo.png", width=200)
@@ -740,42 +998,86 @@ with st.sidebar.expander("Insights do Código"):
 api_usage = load_api_usage()
 if api_usage:
     plot_api_usage(api_usage)
+plot_tendencia_uso(api_usage)
 
 if st.sidebar.button("Resetar Gráficos"):
     reset_api_usage()
 
+with st.sidebar.expander("Buscar no Histórico"):
+    consulta_historico = st.text_input("Palavras-chave", key="busca_historico")
+    if consulta_historico:
+        resultados_busca = buscar_historico(consulta_historico)
+        if not resultados_busca:
+            st.write("Nenhuma interação encontrada.")
+        for resultado in resultados_busca:
+            st.markdown(f"**{time.strftime('%d/%m/%Y %H:%M', time.localtime(resultado['timestamp']))}** — {resultado['user_input'][:80]}")
+            st.caption(resultado['snippet'])
+
+with st.sidebar.expander("Gravação em Segundo Plano"):
+    metricas_gravador = obter_gravador().metrics()
+    st.write(f"Fila: {metricas_gravador['queue_depth']} / {metricas_gravador['max_queue']}")
+    st.write(f"Registros gravados: {metricas_gravador['written']} em {metricas_gravador['batches']} lotes")
+    st.write(f"Latência de gravação (ms): p50 {metricas_gravador['flush_ms_p50']:.1f}, p95 {metricas_gravador['flush_ms_p95']:.1f}")
+    if metricas_gravador['errors']:
+        st.warning(f"{metricas_gravador['errors']} falhas de gravação. Última: {metricas_gravador['last_error']}")
+    if metricas_gravador['spilled']:
+        st.warning(f"{metricas_gravador['spilled']} registros guardados para nova tentativa na próxima execução.")
+    if metricas_gravador['dead_lettered']:
+        st.error(f"{metricas_gravador['dead_lettered']} registros descartados após {WRITER_MAX_SPILLS} reenvios (ver {WRITER_SPILL_DIR}).")
+
+with st.sidebar.expander("Exportar para Análise"):
+    if not pyarrow_disponivel():
+        st.write("Instale o pyarrow para exportar o uso e o histórico em Parquet.")
+    elif st.button("Exportar agora"):
+        obter_gravador().flush()
+        resultado_exportacao = exportar(API_USAGE_FILE, obter_historico(), get_usage_rollups(API_USAGE_ROLLUPS_FILE), get_blob_store(BLOB_STORE_FILE))
+        st.write(f"Uso: {resultado_exportacao['usage_rows']} registros novos; histórico: {resultado_exportacao['history_rows']}; agregados por hora: {resultado_exportacao['rollup_rows']}")
+
+observador_referencias = obter_observador_referencias()
+if observador_referencias is not None:
+    status_observador = observador_referencias.status()
+    with st.sidebar.expander("Biblioteca de Referências"):
+        st.write(f"Pasta: {status_observador['path']}")
+        st.write(f"Arquivos indexados: {status_observador['files']} ({status_observador['chunks']} chunks)")
+        st.write("Este processo varre a pasta." if status_observador['leader'] else "Índice lido do processo que varre a pasta.")
+        if status_observador['last_scan']:
+            st.write(f"Última varredura: {time.strftime('%H:%M:%S', time.localtime(status_observador['last_scan']))}")
+        for fonte, erro in status_observador['errors'].items():
+            st.warning(f"{fonte}: {erro}")
+
 def carregar_referencias():
-    if os.path.exists('references.csv'):
-        return pd.read_csv('references.csv')
+    caminho = obter_armazenamento_sessao().caminho(REFERENCES_CSV)
+    if os.path.exists(caminho):
+        return pd.read_csv(caminho)
     else:
         return pd.DataFrame()
 
+# Registra cada página de referência uma única vez no histórico: as entradas são identificadas pelo
+# hash do conteúdo e gravadas numa só transação, que ignora as já existentes
 def referencias_para_historico(df_referencias, chat_history_file=CHAT_HISTORY_FILE):
-    if not df_referencias.empty:
-        for _, row in df_referencias.iterrows():
-            titulo = row.get('titulo', row['Text'][:50] + '...')
-            autor = row.get('autor', 'Autor Desconhecido')
-            ano = row.get('ano', 'Ano Desconhecido')
-            paginas = row.get('Page', 'Página Desconhecida')
-            
-            chat_entry = {
-                'user_input': f"Título: {titulo}",
-                'user_prompt': f"Autor: {autor}\nAno: {ano}\nPágina: {paginas}\nTexto: {row['Text']}",
-                'expert_response': 'Informação adicionada ao histórico de chat como referência.'
-            }
-            
-            if os.path.exists(chat_history_file):
-                with open(chat_history_file, 'r+') as file:
-                    try:
-                        chat_history = json.load(file)
-                    except json.JSONDecodeError:
-                        chat_history = []
-                    chat_history.append(chat_entry)
-                    file.seek(0)
-                    json.dump(chat_history, file, indent=4)
-            else:
-                with open(chat_history_file, 'w') as file:
-                    json.dump([chat_entry], file, indent=4)
-
-df_referencias = carregar_referencias()
-referencias_para_historico(df_referencias)
+    if df_referencias.empty:
+        return 0
+    entradas = []
+    for _, row in df_referencias.iterrows():
+        titulo = row.get('titulo', row['Text'][:50] + '...')
+        autor = row.get('autor', 'Autor Desconhecido')
+        ano = row.get('ano', 'Ano Desconhecido')
+        paginas = row.get('Page', 'Página Desconhecida')
+
+        entrada = {
+            'user_input': f"Título: {titulo}",
+            'user_prompt': f"Autor: {autor}\nAno: {ano}\nPágina: {paginas}\nTexto: {row['Text']}",
+            'expert_response': REFERENCE_RESPONSE
+        }
+        entrada['content_hash'] = hash_entrada(entrada['user_input'], entrada['user_prompt'], entrada['expert_response'])
+        entradas.append(entrada)
+    return obter_historico(chat_history_file).save_many(entradas, obter_id_sessao())
+
+# Só relê o references.csv quando ele muda desde a última sincronização desta sessão
+caminho_referencias = obter_armazenamento_sessao().caminho(REFERENCES_CSV)
+if os.path.exists(caminho_referencias):
+    estado_referencias = os.stat(caminho_referencias)
+    assinatura_referencias = (estado_referencias.st_mtime_ns, estado_referencias.st_size)
+    if st.session_state.get('references_synced') != assinatura_referencias:
+        referencias_para_historico(carregar_referencias())
+        st.session_state.references_synced = assinatura_referencias
@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from ingestion import nome_seguro
+
+# Definição de constantes
+SECTION_INDEX_DIR = 'section_index'
+SECTION_INDEX_CACHE_SIZE = 8      # documentos mantidos em memória por índice (os demais são lidos do disco)
+SECTION_INDEX_MAX_OPEN = 64       # índices (sessões) mantidos abertos por processo
+
+# Referências a seções dentro de perguntas: "Capítulo 3", "cap. 3", "Parte 2", "seção 2.4", "item 2.4",
+# "§ 2.4" ou "2.4" no início de uma linha. Um número solto no meio da frase ("3.5 kg") não é seção.
+PADRAO_REF_CAPITULO = re.compile(r'\bcap(?:itulo|\.)?\s*(\d+)\b')
+PADRAO_REF_PARTE = re.compile(r'\bparte\s+(\d+)\b')
+PADRAO_REF_SUBSECAO = re.compile(r'(?:\b(?:subsecao|secao|item|topico)\s*|^\s*)(\d+\.\d+)(?!\.?\d)', re.MULTILINE)
+
+# Índices carregados neste processo (os usados há mais tempo saem primeiro)
+_INDICES: OrderedDict = OrderedDict()
+_INDICES_LOCK = threading.Lock()
+
+def _normalizar(texto: str) -> str:
+    return unicodedata.normalize('NFKD', texto.lower()).encode('ascii', 'ignore').decode('ascii')
+
+# Função para converter um título reconhecido por identificar_secoes no identificador da seção
+def id_secao(titulo: Optional[str]) -> Optional[str]:
+    if not titulo:
+        return None
+    titulo = _normalizar(titulo)
+    match = re.match(r'parte (\d+)', titulo)
+    if match:
+        return f"parte {match.group(1)}"
+    match = re.match(r'capitulo (\d+)', titulo)
+    if match:
+        return f"capitulo {match.group(1)}"
+    match = re.match(r'(\d+\.\d+)', titulo)
+    if match:
+        return match.group(1)
+    return None
+
+# Função para extrair da pergunta os identificadores de seção citados
+def secoes_citadas(pergunta: str) -> List[str]:
+    # O '§' não sobrevive à normalização para ASCII
+    texto = _normalizar(pergunta.replace('§', ' secao '))
+    ids = [f"capitulo {numero}" for numero in PADRAO_REF_CAPITULO.findall(texto)]
+    ids += [f"parte {numero}" for numero in PADRAO_REF_PARTE.findall(texto)]
+    ids += PADRAO_REF_SUBSECAO.findall(texto)
+    return list(dict.fromkeys(ids))
+
+# Função para montar a chave de um documento no índice: nome do arquivo + hash do conteúdo dos
+# chunks, para que arquivos diferentes com o mesmo nome não se sobrescrevam
+def chave_documento(fonte: str, chunks: List[dict]) -> str:
+    conteudo = hashlib.sha1()
+    for chunk in chunks:
+        conteudo.update(chunk['text'].encode('utf-8'))
+        conteudo.update(b'\x1f')
+    return f"{nome_seguro(fonte)}-{conteudo.hexdigest()[:16]}"
+
+# Índice de sumário persistente por documento: seção -> páginas -> chunks.
+# Cada documento fica num arquivo JSON próprio, gravado de forma atômica e carregado sob demanda.
+# Os documentos são identificados pela chave retornada por registrar (nome + hash do conteúdo);
+# cada sessão usa um índice na sua própria pasta. Só os documentos usados mais recentemente ficam
+# em memória (cache LRU de tamanho_cache documentos).
+class SectionIndex:
+    def __init__(self, path: str = SECTION_INDEX_DIR, tamanho_cache: int = SECTION_INDEX_CACHE_SIZE):
+        self.path = path
+        self.tamanho_cache = tamanho_cache
+        self.documentos: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _arquivo(self, chave: str) -> str:
+        return os.path.join(self.path, f"{nome_seguro(chave)}.json")
+
+    # Registra os chunks de um documento (gerados por chunk_por_secoes), persiste o índice e
+    # retorna a chave do documento
+    def registrar(self, fonte: str, chunks: List[dict]) -> str:
+        chave = chave_documento(fonte, chunks)
+        secoes: Dict[str, dict] = {}
+        for chunk in chunks:
+            metadata = chunk['metadata']
+            for tipo in ('parte', 'capitulo', 'secao'):
+                sid = id_secao(metadata.get(tipo))
+                if sid is None:
+                    continue
+                secao = secoes.setdefault(sid, {
+                    'title': metadata.get(tipo),
+                    'page_start': metadata['page_start'],
+                    'page_end': metadata['page_end'],
+                    'chunk_ids': [],
+                })
+                secao['page_start'] = min(secao['page_start'], metadata['page_start'])
+                secao['page_end'] = max(secao['page_end'], metadata['page_end'])
+                if not secao['chunk_ids'] or secao['chunk_ids'][-1] != chunk['id']:
+                    secao['chunk_ids'].append(chunk['id'])
+        documento = {
+            'document': fonte,
+            'sections': secoes,
+            'chunks': {chunk['id']: {'text': chunk['text'], 'metadata': chunk['metadata']} for chunk in chunks},
+        }
+        temporario = self._arquivo(chave) + '.tmp'
+        with open(temporario, 'w', encoding='utf-8') as file:
+            json.dump(documento, file, ensure_ascii=False)
+        os.replace(temporario, self._arquivo(chave))
+        with self._lock:
+            self._guardar(chave, documento)
+        return chave
+
+    # Guarda um documento no cache, descartando os usados há mais tempo; requer o lock
+    def _guardar(self, chave: str, documento: dict):
+        self.documentos[chave] = documento
+        self.documentos.move_to_end(chave)
+        while len(self.documentos) > self.tamanho_cache:
+            self.documentos.popitem(last=False)
+
+    def documento(self, chave: str) -> Optional[dict]:
+        with self._lock:
+            if chave in self.documentos:
+                self.documentos.move_to_end(chave)
+                return self.documentos[chave]
+            if not os.path.exists(self._arquivo(chave)):
+                return None
+            with open(self._arquivo(chave), 'r', encoding='utf-8') as file:
+                documento = json.load(file)
+            self._guardar(chave, documento)
+            return documento
+
+    def secao(self, chave: str, sid: str) -> Optional[dict]:
+        documento = self.documento(chave)
+        if documento is None:
+            return None
+        return documento['sections'].get(sid)
+
+    # Retorna os chunks das seções citadas na pergunta, na ordem do documento, sem busca vetorial
+    def buscar(self, pergunta: str, chave: str) -> List[dict]:
+        documento = self.documento(chave)
+        if documento is None:
+            return []
+        chunks, vistos = [], set()
+        for sid in secoes_citadas(pergunta):
+            secao = documento['sections'].get(sid)
+            if secao is None:
+                continue
+            for chunk_id in secao['chunk_ids']:
+                if chunk_id not in vistos:
+                    vistos.add(chunk_id)
+                    chunk = documento['chunks'][chunk_id]
+                    chunks.append({'id': chunk_id, 'text': chunk['text'], 'metadata': chunk['metadata']})
+        return chunks
+
+# Função para obter o índice de seções compartilhado do processo
+def get_section_index(path: str = SECTION_INDEX_DIR) -> SectionIndex:
+    with _INDICES_LOCK:
+        indice = _INDICES.get(path)
+        if indice is None:
+            indice = SectionIndex(path)
+            _INDICES[path] = indice
+            while len(_INDICES) > SECTION_INDEX_MAX_OPEN:
+                _INDICES.popitem(last=False)
+        _INDICES.move_to_end(path)
+        return indice
@@ -0,0 +1,91 @@
+import os
+import re
+import shutil
+import threading
+import uuid
+from typing import Optional
+
+# Definição de constantes
+SESSIONS_DIR = os.getenv('SESSIONS_DIR', 'sessoes')
+# Cotas por sessão/usuário (0 = sem limite)
+SESSION_QUOTA_BYTES = int(os.getenv('SESSION_QUOTA_BYTES', str(200 * 2 ** 20)))
+SESSION_HISTORY_LIMIT = int(os.getenv('SESSION_HISTORY_LIMIT', '2000'))
+
+PADRAO_ID_INVALIDO = re.compile(r'[^A-Za-z0-9_-]')
+
+# Áreas de sessão abertas neste processo
+_SESSOES = {}
+_SESSOES_LOCK = threading.Lock()
+
+class QuotaExcedida(Exception):
+    pass
+
+# Função para transformar um identificador de usuário/sessão num nome de pasta seguro
+def normalizar_id_sessao(session_id: Optional[str]) -> str:
+    normalizado = PADRAO_ID_INVALIDO.sub('_', (session_id or '').strip())[:64]
+    return normalizado or uuid.uuid4().hex
+
+# Área de arquivos de uma sessão (sessoes/<id>/). Cada gravação vai para um arquivo temporário
+# e é publicada com os.replace, então leitores nunca veem um arquivo pela metade; o total
+# gravado pela sessão é limitado por quota_bytes.
+class SessionStorage:
+    def __init__(self, session_id: str, base: str = SESSIONS_DIR, quota_bytes: int = SESSION_QUOTA_BYTES):
+        self.session_id = normalizar_id_sessao(session_id)
+        self.path = os.path.join(base, self.session_id)
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def caminho(self, nome: str) -> str:
+        return os.path.join(self.path, os.path.basename(nome))
+
+    def uso_bytes(self, ignorar: Optional[str] = None) -> int:
+        total = 0
+        for nome in os.listdir(self.path):
+            if nome == ignorar or nome.endswith('.tmp'):
+                continue
+            try:
+                total += os.path.getsize(os.path.join(self.path, nome))
+            except FileNotFoundError:
+                continue
+        return total
+
+    # Grava bytes ou o conteúdo de um arquivo aberto; o arquivo substituído não conta na cota
+    def gravar(self, nome: str, conteudo) -> str:
+        destino = self.caminho(nome)
+        with self._lock:
+            temporario = f"{destino}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(temporario, 'wb') as file:
+                    if isinstance(conteudo, (bytes, bytearray)):
+                        file.write(conteudo)
+                    else:
+                        shutil.copyfileobj(conteudo, file)
+                tamanho = os.path.getsize(temporario)
+                if self.quota_bytes and self.uso_bytes(ignorar=os.path.basename(destino)) + tamanho > self.quota_bytes:
+                    raise QuotaExcedida(
+                        f"Cota de armazenamento da sessão excedida ({self.quota_bytes / 2 ** 20:.1f} MB)."
+                    )
+                os.replace(temporario, destino)
+            finally:
+                if os.path.exists(temporario):
+                    os.remove(temporario)
+        return destino
+
+    def existe(self, nome: str) -> bool:
+        return os.path.exists(self.caminho(nome))
+
+    def limpar(self):
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+
+# Função para obter a área de arquivos compartilhada de uma sessão
+def get_session_storage(session_id: str, base: str = SESSIONS_DIR) -> SessionStorage:
+    chave = (base, normalizar_id_sessao(session_id))
+    with _SESSOES_LOCK:
+        armazenamento = _SESSOES.get(chave)
+        if armazenamento is None:
+            armazenamento = SessionStorage(chave[1], base)
+            _SESSOES[chave] = armazenamento
+        return armazenamento
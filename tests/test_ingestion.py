@@ -0,0 +1,33 @@
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from ingestion import LeitorJSONIncremental, criar_column_store, responder_consulta_numerica
+
+# Números cortados pelo bloco de leitura ("1." | "5", "2e" | "3") não podem ser lidos pela metade
+def test_numeros_em_qualquer_tamanho_de_bloco():
+    dados = b'[1.5, 2e3, 7, -0.25, 1E-2, 3e+1, 10, {"a": 12.75}, "x", true, null]'
+    esperado = json.loads(dados)
+    for tamanho in range(1, len(dados) + 2):
+        valores = [valor for _, valor in LeitorJSONIncremental(io.BytesIO(dados), tamanho_leitura=tamanho)]
+        assert valores == esperado, tamanho
+
+def test_caminhos_do_objeto_raiz_em_qualquer_tamanho_de_bloco():
+    dados = '\ufeff{"itens": [1.5, 2e3], "total": 7}'.encode('utf-8')
+    for tamanho in range(1, len(dados) + 2):
+        registros = list(LeitorJSONIncremental(io.BytesIO(dados), tamanho_leitura=tamanho))
+        assert registros == [('$.itens[0]', 1.5), ('$.itens[1]', 2000.0), ('$.total', 7)], tamanho
+
+# Categorias com acentos e várias palavras, com ou sem aspas; filtros sem linhas não geram resposta
+def test_consulta_numerica_com_categorias(tmp_path):
+    store = criar_column_store('a.csv', 's', 'h', base=str(tmp_path))
+    store.append(pd.DataFrame({'cidade': ['São Paulo', 'Belém', 'Belém'], 'valor': [1.0, 2.0, 4.0]}))
+    assert responder_consulta_numerica('média de valor onde cidade: São Paulo', store).endswith('= 1.0')
+    assert responder_consulta_numerica('soma de valor com cidade = "belem"', store).endswith('= 6.0')
+    assert responder_consulta_numerica('quantos com cidade = Manaus', store) is None
+    assert responder_consulta_numerica('média de valor onde valor > 100', store) is None
@@ -0,0 +1,256 @@
+import os
+import json
+import atexit
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+# Definição de constantes
+API_USAGE_LOG = 'api_usage.jsonl'
+FSYNC_BATCH = 32          # linhas gravadas entre dois fsync
+FSYNC_INTERVAL = 1.0      # segundos máximos sem fsync com linhas pendentes
+
+# Logs e leitores abertos neste processo
+_LOGS = {}
+_LEITORES = {}
+_LOGS_LOCK = threading.Lock()
+
+# Trava exclusiva do arquivo entre processos (fcntl no Linux/macOS, msvcrt no Windows)
+@contextmanager
+def travar_arquivo(file):
+    try:
+        import fcntl
+
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    except ImportError:
+        import msvcrt
+
+        # No Windows a trava cobre um byte fixo no início do arquivo, usado só como semáforo
+        posicao = file.tell()
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            file.seek(posicao)
+            yield
+        finally:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            file.seek(0, os.SEEK_END)
+
+# Tenta travar o arquivo sem esperar (para eleger um único processo para uma tarefa). A trava dura
+# enquanto o arquivo ficar aberto e é liberada pelo sistema se o processo terminar.
+def tentar_travar_arquivo(file) -> bool:
+    try:
+        import fcntl
+
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+    except ImportError:
+        import msvcrt
+
+        file.seek(0)
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+# Log de uso append-only em JSON Lines. Cada chamada grava uma única linha no fim do arquivo
+# (custo constante, independente do tamanho do histórico); o fsync é feito em lotes.
+class UsageLog:
+    def __init__(self, path: str = API_USAGE_LOG, fsync_batch: int = FSYNC_BATCH, fsync_interval: float = FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.pendentes = 0
+        self.ultimo_fsync = time.time()
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+
+    # Trava o arquivo atual do log. Se a compactação (de outro processo) substituiu o arquivo,
+    # reabre o caminho antes de gravar, para não escrever num arquivo já desvinculado.
+    @contextmanager
+    def _travar_atual(self):
+        while True:
+            with travar_arquivo(self._file):
+                try:
+                    atual = os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino
+                except FileNotFoundError:
+                    atual = False
+                if atual:
+                    yield
+                    return
+            self._file.close()
+            self._file = open(self.path, 'ab')
+
+    def append(self, entry: dict):
+        self.append_many([entry])
+
+    # Grava um lote de entradas com uma única trava e uma única escrita
+    def append_many(self, entries: List[dict]):
+        if not entries:
+            return
+        agora = time.time()
+        for entry in entries:
+            entry.setdefault('timestamp', agora)
+        dados = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries).encode('utf-8')
+        with self._lock:
+            with self._travar_atual():
+                self._file.write(dados)
+                self._file.flush()
+            self.pendentes += len(entries)
+            if self.pendentes >= self.fsync_batch or time.time() - self.ultimo_fsync >= self.fsync_interval:
+                self._sincronizar()
+
+    def _sincronizar(self):
+        os.fsync(self._file.fileno())
+        self.pendentes = 0
+        self.ultimo_fsync = time.time()
+
+    def flush(self):
+        with self._lock:
+            if self.pendentes:
+                self._sincronizar()
+
+    # Reset de uma sessão: acrescenta uma marca que faz os leitores descartarem as entradas
+    # anteriores dessa sessão, sem apagar as das outras
+    def reset_session(self, session_id: str):
+        self.append({'log_reset': time.time(), 'session_id': session_id})
+        self.flush()
+
+    # Reescreve o log com as entradas que processar(entradas) devolver. Novas gravações esperam a
+    # trava; o arquivo novo é publicado com os.replace e os leitores recomeçam pelo novo inode.
+    def compact(self, processar: Callable[[List[dict]], List[dict]]) -> int:
+        with self._lock:
+            with self._travar_atual():
+                with open(self.path, 'rb') as file:
+                    linhas = file.read().splitlines()
+                entradas = []
+                for linha in linhas:
+                    try:
+                        entradas.append(json.loads(linha))
+                    except json.JSONDecodeError:
+                        continue
+                mantidas = processar(entradas)
+                temporario = self.path + '.tmp'
+                with open(temporario, 'wb') as file:
+                    file.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in mantidas).encode('utf-8'))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temporario, self.path)
+            self._file.close()
+            self._file = open(self.path, 'ab')
+            self.pendentes = 0
+            return len(entradas) - len(mantidas)
+
+    def reset(self):
+        with self._lock:
+            with self._travar_atual():
+                self._file.truncate(0)
+                # Marca de reset: permite aos leitores perceberem o truncamento mesmo após novas gravações
+                self._file.write((json.dumps({'log_reset': time.time()}) + "\n").encode('utf-8'))
+                self._file.flush()
+            self._sincronizar()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+# Leitor incremental: guarda o deslocamento já lido e, a cada chamada, só interpreta as linhas novas.
+# Uma linha final incompleta (gravação em andamento) fica para a próxima leitura.
+class UsageLogReader:
+    def __init__(self, path: str = API_USAGE_LOG):
+        self.path = path
+        self.offset = 0
+        self.inode = None
+        self.inicio = b""
+        self.entries: List[dict] = []
+        self.por_sessao: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+
+    def _resultado(self, session_id: Optional[str]) -> List[dict]:
+        return self.entries if session_id is None else self.por_sessao.get(session_id, [])
+
+    # Retorna todas as entradas ou só as de uma sessão (índice mantido a cada leitura incremental)
+    def read(self, session_id: Optional[str] = None) -> List[dict]:
+        with self._lock:
+            try:
+                estado = os.stat(self.path)
+            except FileNotFoundError:
+                self.offset, self.entries, self.por_sessao = 0, [], {}
+                return self._resultado(session_id)
+            if estado.st_size == self.offset and estado.st_ino == self.inode:
+                return self._resultado(session_id)
+            with open(self.path, 'rb') as file:
+                # Arquivo truncado (reset) ou substituído: recomeça do início. Os primeiros bytes
+                # detectam um reset seguido de novas gravações que já passaram do deslocamento antigo.
+                if estado.st_size < self.offset or estado.st_ino != self.inode or file.read(len(self.inicio)) != self.inicio:
+                    self.offset, self.entries, self.por_sessao, self.inicio = 0, [], {}, b""
+                    self.inode = estado.st_ino
+                file.seek(self.offset)
+                dados = file.read(estado.st_size - self.offset)
+                if self.offset == 0:
+                    self.inicio = dados[:256]
+            completo = dados.rfind(b"\n") + 1
+            for linha in dados[:completo].splitlines():
+                if linha.strip():
+                    try:
+                        entrada = json.loads(linha)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'log_reset' not in entrada:
+                        self.entries.append(entrada)
+                        self.por_sessao.setdefault(entrada.get('session_id'), []).append(entrada)
+                    elif 'session_id' in entrada:
+                        sessao = entrada['session_id']
+                        self.por_sessao.pop(sessao, None)
+                        self.entries = [item for item in self.entries if item.get('session_id') != sessao]
+            self.offset += completo
+            if self.offset == 0:
+                self.inicio = b""
+            return self._resultado(session_id)
+
+# Função para importar uma única vez o antigo api_usage.json (array JSON) para o log em JSON Lines
+def migrar_log_legado(caminho_legado: str, log: UsageLog) -> int:
+    if not os.path.exists(caminho_legado):
+        return 0
+    try:
+        with open(caminho_legado, 'r') as file:
+            entradas = json.load(file)
+    except (json.JSONDecodeError, OSError):
+        entradas = []
+    for entrada in entradas:
+        log.append(entrada)
+    log.flush()
+    os.replace(caminho_legado, caminho_legado + '.migrated')
+    return len(entradas)
+
+# Função para obter o log de uso compartilhado do processo
+def get_usage_log(path: str = API_USAGE_LOG, legado: Optional[str] = None) -> UsageLog:
+    with _LOGS_LOCK:
+        log = _LOGS.get(path)
+        if log is None:
+            log = UsageLog(path)
+            # Linhas ainda sem fsync são sincronizadas quando o processo termina
+            atexit.register(log.close)
+            if legado:
+                migrar_log_legado(legado, log)
+            _LOGS[path] = log
+        return log
+
+# Função para obter o leitor incremental compartilhado do processo
+def get_usage_reader(path: str = API_USAGE_LOG) -> UsageLogReader:
+    with _LOGS_LOCK:
+        leitor = _LEITORES.get(path)
+        if leitor is None:
+            leitor = UsageLogReader(path)
+            _LEITORES[path] = leitor
+        return leitor
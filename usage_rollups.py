@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+
+from blob_store import referencias_campos
+
+# Definição de constantes
+USAGE_ROLLUP_DB = 'api_usage_rollups.db'
+# Entradas brutas (com prompts e respostas) mantidas no log; as mais antigas viram agregados
+USAGE_RETENTION_DAYS = float(os.getenv('USAGE_RETENTION_DAYS', '7'))
+# Agregados por minuto mantidos; os por hora são mantidos indefinidamente
+ROLLUP_MINUTE_RETENTION_DAYS = float(os.getenv('ROLLUP_MINUTE_RETENTION_DAYS', '30'))
+USAGE_COMPACT_INTERVAL = float(os.getenv('USAGE_COMPACT_INTERVAL', '3600'))
+# Limites superiores (segundos) das faixas do histograma de latência; a última faixa é aberta
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 40, 80)
+GRANULARIDADES = {'minute': 60, 'hour': 3600}
+
+COLUNAS_HISTOGRAMA = [f"lat_{i}" for i in range(len(LATENCY_BUCKETS) + 1)]
+
+# Agregados abertos neste processo
+_AGREGADOS = {}
+_AGREGADOS_LOCK = threading.Lock()
+_ULTIMA_COMPACTACAO = {}
+
+# Função para achar a faixa do histograma de latência de uma chamada
+def faixa_latencia(segundos: float) -> int:
+    for i, limite in enumerate(LATENCY_BUCKETS):
+        if segundos <= limite:
+            return i
+    return len(LATENCY_BUCKETS)
+
+# Agregados de uso por minuto e por hora (SQLite, modo WAL). Cada linha soma chamadas, tokens e
+# tempo de uma combinação sessão/ação/modelo/chave num intervalo, com o histograma de latência
+# em colunas; os painéis consultam um número de linhas que depende do período, não do log.
+class UsageRollups:
+    def __init__(self, path: str = USAGE_ROLLUP_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        histograma = ", ".join(f"{coluna} INTEGER NOT NULL DEFAULT 0" for coluna in COLUNAS_HISTOGRAMA)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage_rollups ("
+            "granularity TEXT NOT NULL, bucket INTEGER NOT NULL, session_id TEXT NOT NULL, action TEXT NOT NULL, "
+            "model TEXT NOT NULL, api_key TEXT NOT NULL, calls INTEGER NOT NULL, tokens INTEGER NOT NULL, "
+            f"time_total REAL NOT NULL, {histograma}, "
+            "PRIMARY KEY (granularity, session_id, bucket, action, model, api_key))"
+        )
+        # Marca d'água da compactação: entradas até este timestamp já foram agregadas
+        self._conn.execute("CREATE TABLE IF NOT EXISTS usage_compaction (id INTEGER PRIMARY KEY CHECK (id = 0), watermark REAL NOT NULL)")
+        self._conn.commit()
+
+    def watermark(self) -> float:
+        with self._lock:
+            linha = self._conn.execute("SELECT watermark FROM usage_compaction WHERE id = 0").fetchone()
+        return linha[0] if linha else 0.0
+
+    # Soma as entradas aos agregados de minuto e de hora e avança a marca d'água, numa só transação
+    def adicionar(self, entradas: List[dict], watermark: float):
+        grupos = {}
+        for entrada in entradas:
+            for granularidade, segundos in GRANULARIDADES.items():
+                chave = (
+                    granularidade, int(entrada['timestamp'] // segundos * segundos), str(entrada.get('session_id') or ''),
+                    str(entrada.get('action') or ''), str(entrada.get('model') or ''), str(entrada.get('api_key') or ''),
+                )
+                grupo = grupos.setdefault(chave, [0, 0, 0.0] + [0] * len(COLUNAS_HISTOGRAMA))
+                tempo = float(entrada.get('time_taken') or 0.0)
+                grupo[0] += 1
+                grupo[1] += int(entrada.get('tokens_used') or 0)
+                grupo[2] += tempo
+                grupo[3 + faixa_latencia(tempo)] += 1
+        colunas = ", ".join(COLUNAS_HISTOGRAMA)
+        somas = ", ".join(f"{coluna} = {coluna} + excluded.{coluna}" for coluna in COLUNAS_HISTOGRAMA)
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT INTO usage_rollups (granularity, bucket, session_id, action, model, api_key, calls, tokens, time_total, {colunas}) "
+                f"VALUES ({', '.join('?' * (9 + len(COLUNAS_HISTOGRAMA)))}) "
+                "ON CONFLICT (granularity, session_id, bucket, action, model, api_key) DO UPDATE SET "
+                f"calls = calls + excluded.calls, tokens = tokens + excluded.tokens, time_total = time_total + excluded.time_total, {somas}",
+                [chave + tuple(valores) for chave, valores in grupos.items()],
+            )
+            self._conn.execute(
+                "INSERT INTO usage_compaction (id, watermark) VALUES (0, ?) "
+                "ON CONFLICT (id) DO UPDATE SET watermark = MAX(watermark, excluded.watermark)",
+                (watermark,),
+            )
+            self._conn.commit()
+
+    # Agregados de uma granularidade a partir de um instante, com o histograma como lista
+    def consultar(self, granularidade: str = 'hour', session_id: Optional[str] = None, desde: float = 0.0) -> List[dict]:
+        consulta = (
+            f"SELECT bucket, action, model, api_key, calls, tokens, time_total, session_id, {', '.join(COLUNAS_HISTOGRAMA)} "
+            "FROM usage_rollups WHERE granularity = ? AND bucket >= ?"
+        )
+        parametros: list = [granularidade, int(desde)]
+        if session_id is not None:
+            consulta = consulta.replace("WHERE granularity = ?", "WHERE granularity = ? AND session_id = ?")
+            parametros.insert(1, session_id)
+        with self._lock:
+            linhas = self._conn.execute(consulta + " ORDER BY bucket", parametros).fetchall()
+        return [
+            {'bucket': linha[0], 'action': linha[1], 'model': linha[2], 'api_key': linha[3], 'calls': linha[4],
+             'tokens': linha[5], 'time_total': linha[6], 'session_id': linha[7], 'latency_histogram': list(linha[8:])}
+            for linha in linhas
+        ]
+
+    # Total de chamadas já agregadas (de uma sessão ou de todas)
+    def total_chamadas(self, session_id: Optional[str] = None) -> int:
+        with self._lock:
+            if session_id is None:
+                linha = self._conn.execute("SELECT SUM(calls) FROM usage_rollups WHERE granularity = 'hour'").fetchone()
+            else:
+                linha = self._conn.execute(
+                    "SELECT SUM(calls) FROM usage_rollups WHERE granularity = 'hour' AND session_id = ?", (session_id,)
+                ).fetchone()
+        return linha[0] or 0
+
+    def apagar_sessao(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM usage_rollups WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def expirar_minutos(self, antes_de: float):
+        with self._lock:
+            self._conn.execute("DELETE FROM usage_rollups WHERE granularity = 'minute' AND bucket < ?", (int(antes_de),))
+            self._conn.commit()
+
+# Função para compactar o log de uso: entradas mais antigas que a retenção são somadas aos
+# agregados e removidas do log (com os prompts e respostas); as marcas de reset de sessão que
+# saem do log apagam os agregados anteriores da sessão. Com um repositório de blobs, os textos
+# que só eram referenciados pelas entradas removidas são apagados (referências vivas: as do log
+# mantido e as de outras_referencias(), como o histórico). Retorna quantas entradas saíram do log.
+def compactar_uso(log, rollups: UsageRollups, retencao_dias: float = USAGE_RETENTION_DAYS,
+                  retencao_minutos_dias: float = ROLLUP_MINUTE_RETENTION_DAYS, agora: Optional[float] = None,
+                  blobs=None, outras_referencias: Optional[Callable[[], Iterable[str]]] = None) -> int:
+    agora = agora if agora is not None else time.time()
+    corte = agora - retencao_dias * 86400
+    watermark = rollups.watermark()
+    vivas = set()
+
+    def processar(entradas: List[dict]) -> List[dict]:
+        antigas, mantidas = [], []
+        for entrada in entradas:
+            (antigas if entrada.get('timestamp', agora) < corte else mantidas).append(entrada)
+        # Entradas até a marca d'água já foram agregadas numa compactação interrompida antes de reescrever o log
+        novas = [entrada for entrada in antigas if entrada['timestamp'] > watermark]
+        agregar = []
+        for entrada in novas:
+            if 'log_reset' not in entrada:
+                agregar.append(entrada)
+            elif 'session_id' in entrada:
+                rollups.apagar_sessao(entrada['session_id'])
+                agregar = [item for item in agregar if item.get('session_id') != entrada['session_id']]
+        if novas:
+            rollups.adicionar(agregar, max(entrada['timestamp'] for entrada in novas))
+        vivas.update(referencias_campos(mantidas))
+        return mantidas
+
+    removidas = log.compact(processar)
+    rollups.expirar_minutos(agora - retencao_minutos_dias * 86400)
+    if blobs is not None:
+        if outras_referencias is not None:
+            vivas.update(outras_referencias())
+        blobs.collect(vivas, agora=agora)
+    return removidas
+
+# Função para obter os agregados compartilhados do processo
+def get_usage_rollups(path: str = USAGE_ROLLUP_DB) -> UsageRollups:
+    with _AGREGADOS_LOCK:
+        rollups = _AGREGADOS.get(path)
+        if rollups is None:
+            rollups = UsageRollups(path)
+            _AGREGADOS[path] = rollups
+        return rollups
+
+# Função para compactar o log no máximo uma vez por intervalo (chamada pelo gravador em segundo plano)
+def compactar_se_necessario(log, rollups: UsageRollups, intervalo: float = USAGE_COMPACT_INTERVAL,
+                            agora: Optional[float] = None, blobs=None,
+                            outras_referencias: Optional[Callable[[], Iterable[str]]] = None) -> int:
+    agora = agora if agora is not None else time.time()
+    with _AGREGADOS_LOCK:
+        if agora - _ULTIMA_COMPACTACAO.get(log.path, 0.0) < intervalo:
+            return 0
+        _ULTIMA_COMPACTACAO[log.path] = agora
+    return compactar_uso(log, rollups, agora=agora, blobs=blobs, outras_referencias=outras_referencias)
@@ -0,0 +1,257 @@
+import os
+import json
+import mmap
+import time
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Definição de constantes
+EMBEDDING_STORE_DIR = os.getenv('EMBEDDING_STORE_DIR', 'embedding_store')
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = 'store.lock'
+LOCK_TIMEOUT = 30.0
+SEARCH_BLOCK_ROWS = 65536
+
+# Trava entre processos baseada em arquivo criado com O_EXCL (funciona em Linux e Windows)
+class TravaArquivo:
+    def __init__(self, path: str, timeout: float = LOCK_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def __enter__(self):
+        inicio = time.time()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode('ascii'))
+                os.close(fd)
+                return self
+            except FileExistsError:
+                # Trava abandonada por um processo que morreu durante a escrita
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.timeout:
+                        os.remove(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() - inicio > self.timeout:
+                    raise TimeoutError(f"Não foi possível obter a trava {self.path}.")
+                time.sleep(0.05)
+
+    def __exit__(self, *args):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+# Função para montar a pasta do armazenamento de um conjunto de documentos. Cada sessão e cada
+# conteúdo (hash) têm a sua pasta, para que os ids de sessões diferentes não colidam; workers que
+# indexam o mesmo conteúdo na mesma sessão compartilham a pasta
+def caminho_armazenamento(sessao: str, hash_conteudo: str, base: str = EMBEDDING_STORE_DIR) -> str:
+    return os.path.join(base, sessao, hash_conteudo)
+
+# Segmento imutável do armazenamento: vetores (.npy mapeado em memória), ids e payloads JSONL
+class _Segmento:
+    def __init__(self, path: str, nome: str):
+        self.nome = nome
+        base = os.path.join(path, nome)
+        self.matrix = np.load(f"{base}.npy", mmap_mode='r')
+        with open(f"{base}.ids.json", 'r', encoding='utf-8') as file:
+            self.ids = json.load(file)
+        self.offsets = np.load(f"{base}.offsets.npy", mmap_mode='r')
+        self._payloads = None
+        self._arquivo_payloads = f"{base}.payload.jsonl"
+
+    def payload(self, linha: int) -> Optional[dict]:
+        if self._payloads is None:
+            with open(self._arquivo_payloads, 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                self._payloads = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        inicio, fim = int(self.offsets[linha]), int(self.offsets[linha + 1])
+        if inicio == fim:
+            return None
+        return json.loads(self._payloads[inicio:fim])
+
+# Armazenamento de embeddings compartilhado entre processos. A ingestão acrescenta segmentos
+# imutáveis e publica-os trocando o manifesto de forma atômica; os leitores abrem os segmentos
+# somente leitura com np.load(mmap_mode='r'), de modo que todos os workers compartilham as
+# mesmas páginas do cache do sistema operacional em vez de manter cópias próprias da matriz.
+# Só a matriz é compartilhada: os ids dos segmentos e o mapa de posições continuam inteiros em
+# cada processo (assim como o BM25 e os chunks do HybridRetriever), então a memória por worker
+# ainda cresce com o número de chunks, só que sem o custo dos vetores.
+class SharedVectorStore:
+    def __init__(self, path: str = EMBEDDING_STORE_DIR, dimension: Optional[int] = None, dtype: str = 'float32'):
+        self.path = path
+        self.dimension = dimension
+        self.dtype = dtype
+        self.segmentos: Dict[str, _Segmento] = {}
+        self.ordem: List[str] = []
+        self.removidos: Dict[str, set] = {}
+        self.positions: Dict[str, tuple] = {}
+        self.manifest_mtime = None
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.refresh()
+
+    def _arquivo(self, nome: str) -> str:
+        return os.path.join(self.path, nome)
+
+    def _ler_manifesto(self) -> dict:
+        try:
+            with open(self._arquivo(MANIFEST_FILE), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'dimension': self.dimension, 'dtype': self.dtype, 'next': 0, 'segments': [], 'deleted': {}}
+
+    def _gravar_manifesto(self, manifesto: dict):
+        temporario = self._arquivo(MANIFEST_FILE + '.tmp')
+        with open(temporario, 'w', encoding='utf-8') as file:
+            json.dump(manifesto, file)
+        os.replace(temporario, self._arquivo(MANIFEST_FILE))
+
+    # Abre os segmentos publicados desde a última leitura; retorna True se algo mudou
+    def refresh(self) -> bool:
+        try:
+            estado = os.stat(self._arquivo(MANIFEST_FILE))
+        except FileNotFoundError:
+            return False
+        # os.replace cria um novo inode, então a assinatura muda mesmo com mtime de baixa resolução
+        mtime = (estado.st_mtime_ns, estado.st_ino, estado.st_size)
+        with self._lock:
+            if mtime == self.manifest_mtime:
+                return False
+            manifesto = self._ler_manifesto()
+            self.dimension = manifesto['dimension']
+            self.dtype = manifesto['dtype']
+            segmentos = {nome: self.segmentos.get(nome) or _Segmento(self.path, nome) for nome in manifesto['segments']}
+            self.segmentos = segmentos
+            self.ordem = list(manifesto['segments'])
+            self.removidos = {nome: set(linhas) for nome, linhas in manifesto['deleted'].items()}
+            self.positions = {}
+            for nome in self.ordem:
+                removidos = self.removidos.get(nome, set())
+                for linha, chunk_id in enumerate(self.segmentos[nome].ids):
+                    if linha not in removidos:
+                        self.positions[chunk_id] = (nome, linha)
+            self.manifest_mtime = mtime
+            return True
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def _marcar_removidos(self, manifesto: dict, ids: List[str]):
+        for chunk_id in ids:
+            posicao = self.positions.get(chunk_id)
+            if posicao is not None:
+                nome, linha = posicao
+                linhas = manifesto['deleted'].setdefault(nome, [])
+                if linha not in linhas:
+                    linhas.append(linha)
+
+    # Grava um novo segmento (ainda não publicado) e retorna o seu nome; requer a trava
+    def _escrever_segmento(self, manifesto: dict, ids: List[str], vectors: np.ndarray,
+                           payloads: Optional[List[dict]]) -> str:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if manifesto['dimension'] is None:
+            manifesto['dimension'] = vectors.shape[1]
+        nome = f"seg-{manifesto['next']:06d}"
+        manifesto['next'] += 1
+        base = self._arquivo(nome)
+
+        offsets = [0]
+        with open(f"{base}.payload.jsonl", 'wb') as file:
+            for i in range(len(ids)):
+                if payloads is not None and payloads[i] is not None:
+                    file.write(json.dumps(payloads[i], ensure_ascii=False).encode('utf-8') + b"\n")
+                offsets.append(file.tell())
+        np.save(f"{base}.offsets.npy", np.asarray(offsets, dtype=np.int64))
+        with open(f"{base}.ids.json", 'w', encoding='utf-8') as file:
+            json.dump(list(ids), file)
+        # O .npy é o último arquivo gravado; o segmento só fica visível quando entra no manifesto
+        with open(f"{base}.npy.tmp", 'wb') as file:
+            np.save(file, vectors.astype(manifesto['dtype']).reshape(-1, manifesto['dimension']))
+        os.replace(f"{base}.npy.tmp", f"{base}.npy")
+        return nome
+
+    def add(self, ids: List[str], vectors: np.ndarray, payloads: Optional[List[dict]] = None):
+        with self._lock, TravaArquivo(self._arquivo(LOCK_FILE)):
+            self.refresh()
+            manifesto = self._ler_manifesto()
+            nome = self._escrever_segmento(manifesto, ids, vectors, payloads)
+            self._marcar_removidos(manifesto, ids)
+            manifesto['segments'].append(nome)
+            self._gravar_manifesto(manifesto)
+            self.refresh()
+
+    def remove(self, ids: List[str]):
+        with self._lock, TravaArquivo(self._arquivo(LOCK_FILE)):
+            self.refresh()
+            if not any(chunk_id in self.positions for chunk_id in ids):
+                return
+            manifesto = self._ler_manifesto()
+            self._marcar_removidos(manifesto, ids)
+            self._gravar_manifesto(manifesto)
+            self.refresh()
+
+    def payload(self, chunk_id: str) -> Optional[dict]:
+        posicao = self.positions.get(chunk_id)
+        if posicao is None:
+            return None
+        return self.segmentos[posicao[0]].payload(posicao[1])
+
+    # Busca exata por blocos; em float32 o produto é feito direto sobre as páginas mapeadas,
+    # em float16 (metade do disco e do cache de páginas) cada bloco é convertido antes
+    def search(self, vetor: np.ndarray, k: int = 10) -> List[tuple]:
+        self.refresh()
+        vetor = np.asarray(vetor, dtype=np.float32)
+        melhores = []
+        with self._lock:
+            for nome in self.ordem:
+                segmento = self.segmentos[nome]
+                removidos = self.removidos.get(nome)
+                for inicio in range(0, len(segmento.ids), SEARCH_BLOCK_ROWS):
+                    scores = segmento.matrix[inicio:inicio + SEARCH_BLOCK_ROWS].astype(np.float32, copy=False) @ vetor
+                    if not len(scores):
+                        continue
+                    if removidos:
+                        for linha in removidos:
+                            if inicio <= linha < inicio + len(scores):
+                                scores[linha - inicio] = -np.inf
+                    topo = min(k, len(scores))
+                    indices = np.argpartition(-scores, topo - 1)[:topo]
+                    melhores += [(segmento.ids[inicio + i], float(scores[i])) for i in indices if scores[i] != -np.inf]
+        return sorted(melhores, key=lambda item: item[1], reverse=True)[:k]
+
+    # Bytes em disco dos vetores (residentes apenas no cache de páginas compartilhado)
+    def memory_bytes(self) -> int:
+        return sum(segmento.matrix.nbytes for segmento in self.segmentos.values())
+
+    # Reescreve todos os segmentos num único segmento sem as linhas removidas
+    def compact(self):
+        with self._lock, TravaArquivo(self._arquivo(LOCK_FILE)):
+            self.refresh()
+            antigos = list(self.ordem)
+            if len(antigos) < 2 and not self.removidos:
+                return
+            ids = list(self.positions)
+            if ids:
+                vetores = np.vstack([self.segmentos[nome].matrix[linha:linha + 1] for nome, linha in self.positions.values()])
+            else:
+                vetores = np.zeros((0, self.dimension), dtype=np.float32)
+            payloads = [self.payload(chunk_id) for chunk_id in ids]
+            manifesto = self._ler_manifesto()
+            nome = self._escrever_segmento(manifesto, ids, vetores, payloads)
+            manifesto['segments'] = [nome]
+            manifesto['deleted'] = {}
+            self._gravar_manifesto(manifesto)
+            self.refresh()
+        # Em Windows, segmentos ainda mapeados por outros processos não podem ser apagados agora
+        for nome in antigos:
+            for sufixo in ('.npy', '.ids.json', '.offsets.npy', '.payload.jsonl'):
+                try:
+                    os.remove(self._arquivo(nome + sufixo))
+                except OSError:
+                    pass
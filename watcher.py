@@ -0,0 +1,345 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from chunking import chunk_por_secoes
+from dedup import Deduplicador
+from ingestion import iterar_unidades_csv, iterar_unidades_json
+from usage_log import tentar_travar_arquivo
+
+# Definição de constantes
+REFERENCES_DIR = os.getenv('REFERENCES_DIR', 'referencias')
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', '10'))
+WATCH_EXTENSIONS = ('.pdf', '.csv', '.json')
+# Estado persistente do observador (arquivo -> mtime/tamanho/hash/chunks) e chunks extraídos de cada
+# arquivo: um reinício não reextrai a pasta, e os processos que não observam leem daqui
+WATCH_STATE_DIR = os.getenv('WATCH_STATE_DIR', 'referencias_indice')
+
+# Observadores em execução neste processo
+_OBSERVADORES = {}
+_OBSERVADORES_LOCK = threading.Lock()
+
+# Função para calcular o hash do conteúdo de um arquivo em blocos
+def hash_arquivo(caminho: str, tamanho_bloco: int = 1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(caminho, 'rb') as file:
+        for bloco in iter(lambda: file.read(tamanho_bloco), b''):
+            sha1.update(bloco)
+    return sha1.hexdigest()
+
+# Função para extrair as páginas de texto de um PDF
+def extrair_paginas_pdf(caminho: str) -> List[dict]:
+    import pdfplumber
+
+    texto_paginas = []
+    with pdfplumber.open(caminho) as pdf:
+        for num_pagina, pagina in enumerate(pdf.pages):
+            texto_pagina = pagina.extract_text()
+            if texto_pagina:
+                texto_paginas.append({'page': num_pagina + 1, 'text': texto_pagina})
+    return texto_paginas
+
+# Função para extrair os chunks de um arquivo de referência (PDF, CSV ou JSON). A deduplicação é
+# feita pelo observador, contra os chunks já indexados de todos os arquivos
+def extrair_chunks_arquivo(caminho: str, fonte: str) -> List[dict]:
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao == '.pdf':
+        chunks = chunk_por_secoes(extrair_paginas_pdf(caminho), fonte)
+    elif extensao == '.csv':
+        with open(caminho, 'rb') as file:
+            chunks = list(iterar_unidades_csv(file, fonte))
+    elif extensao == '.json':
+        with open(caminho, 'rb') as file:
+            chunks = list(iterar_unidades_json(file, fonte))
+    else:
+        return []
+    return chunks
+
+# Observador de uma pasta de referências. A cada varredura compara (mtime, tamanho) de cada
+# arquivo com o estado anterior e confirma mudanças pelo hash do conteúdo; só os arquivos
+# incluídos, alterados ou removidos são reextraídos, e cada troca no recuperador é atômica.
+# Chunks quase idênticos a chunks já indexados de outro arquivo não são indexados de novo (só a
+# citação é acrescentada ao chunk canônico); quando o arquivo do chunk canônico muda ou sai, os
+# arquivos que tiveram chunks descartados por causa dele são reaplicados.
+# O estado e os chunks extraídos (antes da deduplicação) ficam em state_dir. Só um processo (o que obtém a trava de
+# state_dir) varre e extrai; os demais, e o próprio processo ao reiniciar, carregam os chunks
+# gravados no recuperador. Se o processo observador terminar, outro assume na varredura seguinte.
+class ReferenceWatcher:
+    def __init__(self, retriever, path: str = REFERENCES_DIR, interval: float = WATCH_INTERVAL,
+                 extrator: Callable[[str, str], List[dict]] = extrair_chunks_arquivo,
+                 state_dir: str = WATCH_STATE_DIR):
+        self.retriever = retriever
+        self.path = path
+        self.state_dir = state_dir
+        self.lider = False
+        self._trava = None
+        self._assinatura_estado = None
+        self.interval = interval
+        self.extrator = extrator
+        self.estado: Dict[str, dict] = {}
+        self.deduplicador = Deduplicador()
+        # chunk canônico -> arquivos que tiveram chunks descartados como duplicados dele
+        self.absorvidos: Dict[str, Set[str]] = {}
+        self.erros: Dict[str, str] = {}
+        self.falhas: Dict[str, tuple] = {}
+        self.ultima_varredura: Optional[float] = None
+        self.ultimas_mudancas: dict = {'added': [], 'changed': [], 'removed': []}
+        self._parar = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        os.makedirs(os.path.join(state_dir, 'chunks'), exist_ok=True)
+
+    def _arquivo_estado(self) -> str:
+        return os.path.join(self.state_dir, 'state.json')
+
+    # Chunks de um arquivo ficam num JSON identificado pelo nome e pelo hash do conteúdo
+    def _arquivo_chunks(self, fonte: str, sha1: str) -> str:
+        chave = hashlib.sha1(f"{fonte}\x00{sha1}".encode('utf-8')).hexdigest()
+        return os.path.join(self.state_dir, 'chunks', f"{chave}.json")
+
+    @staticmethod
+    def _gravar_json(caminho: str, dados):
+        temporario = caminho + '.tmp'
+        with open(temporario, 'w', encoding='utf-8') as file:
+            json.dump(dados, file, ensure_ascii=False)
+        os.replace(temporario, caminho)
+
+    # Tenta ser o processo observador (trava mantida enquanto o processo estiver ativo)
+    def _assumir(self) -> bool:
+        if self.lider:
+            return True
+        trava = open(os.path.join(self.state_dir, 'watcher.lock'), 'a+b')
+        if tentar_travar_arquivo(trava):
+            self._trava, self.lider = trava, True
+        else:
+            trava.close()
+        return self.lider
+
+    def _ler_estado_persistido(self) -> Optional[Dict[str, dict]]:
+        try:
+            estado = os.stat(self._arquivo_estado())
+        except FileNotFoundError:
+            return None
+        assinatura = (estado.st_mtime_ns, estado.st_size, estado.st_ino)
+        if assinatura == self._assinatura_estado:
+            return None
+        try:
+            with open(self._arquivo_estado(), 'r', encoding='utf-8') as file:
+                persistido = json.load(file)
+        except (OSError, ValueError):
+            return None
+        self._assinatura_estado = assinatura
+        return persistido
+
+    def _ler_chunks(self, fonte: str, sha1: str) -> List[dict]:
+        with open(self._arquivo_chunks(fonte, sha1), 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    # Tira do deduplicador os chunks de um arquivo e as citações que ele deixou em chunks de outros
+    # arquivos; retorna os arquivos que precisam ser reaplicados por terem chunks absorvidos por estes
+    def _liberar(self, fonte: str, chunk_ids: Iterable[str]) -> Set[str]:
+        dependentes = set()
+        for chunk_id in chunk_ids:
+            self.deduplicador.remover(chunk_id)
+            dependentes |= self.absorvidos.pop(chunk_id, set())
+        for canonico, fontes in self.absorvidos.items():
+            if fonte in fontes:
+                fontes.discard(fonte)
+                chunk = self.deduplicador.canonicos.get(canonico)
+                if chunk is not None:
+                    citacoes = chunk['metadata']['sources']
+                    citacoes[:] = [citacao for citacao in citacoes if citacao.get('source') != fonte]
+        dependentes.discard(fonte)
+        return dependentes
+
+    # Indexa os chunks de um arquivo no lugar dos anteriores, sem os quase duplicados de chunks
+    # já indexados; retorna os arquivos a reaplicar (ver _liberar)
+    def _aplicar(self, fonte: str, chunks: List[dict], estado: dict) -> Set[str]:
+        anteriores = self.estado.get(fonte, {}).get('chunk_ids', [])
+        dependentes = self._liberar(fonte, anteriores)
+        unicos = {}
+        for chunk in chunks:
+            # Cópia: o deduplicador acumula citações nos metadados do chunk canônico
+            chunk = dict(chunk, metadata=dict(chunk.get('metadata', {})))
+            canonico = self.deduplicador.adicionar(chunk)
+            if canonico is None:
+                unicos[chunk['id']] = chunk
+            elif canonico not in unicos:
+                self.absorvidos.setdefault(canonico, set()).add(fonte)
+        self.retriever.replace_chunks(anteriores, list(unicos.values()))
+        self.estado[fonte] = dict(estado, chunk_ids=list(unicos))
+        return dependentes
+
+    def _remover(self, fonte: str) -> Set[str]:
+        chunk_ids = self.estado.pop(fonte)['chunk_ids']
+        dependentes = self._liberar(fonte, chunk_ids)
+        self.retriever.remove_chunks(chunk_ids)
+        return dependentes
+
+    # Reaplica (a partir dos chunks gravados) os arquivos que tinham chunks descartados como
+    # duplicados de chunks que saíram do índice
+    def _reaplicar(self, dependentes: Set[str]):
+        pendentes = set(dependentes)
+        while pendentes:
+            fonte = pendentes.pop()
+            item = self.estado.get(fonte)
+            if item is None:
+                continue
+            try:
+                chunks = self._ler_chunks(fonte, item['sha1'])
+            except (OSError, ValueError):
+                continue
+            pendentes |= self._aplicar(fonte, chunks, item)
+
+    # Aplica no recuperador o estado gravado (pelo observador deste ou de outro processo), lendo
+    # os chunks já extraídos em vez de extrair os arquivos de novo
+    def _sincronizar(self) -> dict:
+        mudancas = {'added': [], 'changed': [], 'removed': []}
+        persistido = self._ler_estado_persistido()
+        if persistido is None:
+            return mudancas
+        dependentes = set()
+        for fonte, item in persistido.items():
+            anterior = self.estado.get(fonte)
+            if anterior and anterior['sha1'] == item['sha1']:
+                anterior.update(mtime=item['mtime'], size=item['size'])
+                continue
+            try:
+                chunks = self._ler_chunks(fonte, item['sha1'])
+            except (OSError, ValueError):
+                # Sem os chunks gravados, o arquivo é tratado como novo e extraído pelo observador
+                continue
+            item = {chave: valor for chave, valor in item.items() if chave != 'chunk_ids'}
+            dependentes |= self._aplicar(fonte, chunks, item)
+            mudancas['changed' if anterior else 'added'].append(fonte)
+        for fonte in [fonte for fonte in self.estado if fonte not in persistido]:
+            dependentes |= self._remover(fonte)
+            mudancas['removed'].append(fonte)
+        self._reaplicar(dependentes)
+        return mudancas
+
+    # Grava o estado e apaga os chunks de arquivos que saíram do estado
+    def _persistir(self):
+        self._gravar_json(self._arquivo_estado(), self.estado)
+        self._assinatura_estado = None
+        validos = {os.path.basename(self._arquivo_chunks(fonte, item['sha1'])) for fonte, item in self.estado.items()}
+        pasta_chunks = os.path.join(self.state_dir, 'chunks')
+        for nome in os.listdir(pasta_chunks):
+            if nome.endswith('.json') and nome not in validos:
+                os.remove(os.path.join(pasta_chunks, nome))
+
+    def _listar(self) -> Dict[str, os.stat_result]:
+        arquivos = {}
+        for raiz, _, nomes in os.walk(self.path):
+            for nome in nomes:
+                if nome.lower().endswith(WATCH_EXTENSIONS):
+                    caminho = os.path.join(raiz, nome)
+                    fonte = os.path.relpath(caminho, self.path).replace(os.sep, '/')
+                    try:
+                        arquivos[fonte] = os.stat(caminho)
+                    except FileNotFoundError:
+                        continue
+        return arquivos
+
+    def _reindexar(self, fonte: str, estado: dict) -> Set[str]:
+        chunks = self.extrator(os.path.join(self.path, fonte), fonte)
+        self._gravar_json(self._arquivo_chunks(fonte, estado['sha1']), chunks)
+        return self._aplicar(fonte, chunks, estado)
+
+    # Executa uma varredura e retorna os arquivos incluídos, alterados e removidos
+    def scan(self) -> dict:
+        with self._lock:
+            mudancas = self._sincronizar()
+            if not self._assumir():
+                self.ultima_varredura = time.time()
+                if any(mudancas.values()):
+                    self.ultimas_mudancas = mudancas
+                return mudancas
+            arquivos = self._listar()
+            assinaturas_atualizadas = False
+            dependentes = set()
+            for fonte, info in arquivos.items():
+                anterior = self.estado.get(fonte)
+                assinatura = (info.st_mtime_ns, info.st_size)
+                if anterior and (anterior['mtime'], anterior['size']) == assinatura:
+                    continue
+                # Arquivo que falhou só é tentado de novo depois de mudar
+                if self.falhas.get(fonte) == assinatura:
+                    continue
+                try:
+                    conteudo = hash_arquivo(os.path.join(self.path, fonte))
+                    estado = {'mtime': info.st_mtime_ns, 'size': info.st_size, 'sha1': conteudo}
+                    if anterior and anterior['sha1'] == conteudo:
+                        # Só o mtime mudou (arquivo regravado com o mesmo conteúdo)
+                        anterior.update(mtime=info.st_mtime_ns, size=info.st_size)
+                        assinaturas_atualizadas = True
+                        continue
+                    dependentes |= self._reindexar(fonte, estado)
+                    self.erros.pop(fonte, None)
+                    self.falhas.pop(fonte, None)
+                    mudancas['changed' if anterior else 'added'].append(fonte)
+                except Exception as e:
+                    # Arquivo ainda sendo copiado ou corrompido: tenta de novo quando for modificado
+                    self.erros[fonte] = str(e)
+                    self.falhas[fonte] = assinatura
+            for fonte in [fonte for fonte in self.falhas if fonte not in arquivos]:
+                self.falhas.pop(fonte)
+                self.erros.pop(fonte, None)
+            for fonte in [fonte for fonte in self.estado if fonte not in arquivos]:
+                dependentes |= self._remover(fonte)
+                mudancas['removed'].append(fonte)
+            self._reaplicar(dependentes)
+            if any(mudancas.values()) or assinaturas_atualizadas or not os.path.exists(self._arquivo_estado()):
+                self._persistir()
+            self.ultima_varredura = time.time()
+            if any(mudancas.values()):
+                self.ultimas_mudancas = mudancas
+            return mudancas
+
+    def _executar(self):
+        while not self._parar.is_set():
+            self.scan()
+            self._parar.wait(self.interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._parar.clear()
+            self._thread = threading.Thread(target=self._executar, name='reference-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            if self._trava is not None:
+                self._trava.close()
+                self._trava, self.lider = None, False
+
+    # Sem o lock da varredura: a barra lateral não pode esperar uma reindexação longa
+    def status(self) -> dict:
+        estado = dict(self.estado)
+        return {
+            'path': self.path,
+            'files': len(estado),
+            'chunks': sum(len(item['chunk_ids']) for item in estado.values()),
+            'last_scan': self.ultima_varredura,
+            'last_changes': dict(self.ultimas_mudancas),
+            'errors': dict(self.erros),
+            'leader': self.lider,
+        }
+
+# Função para obter (e iniciar) o observador compartilhado de uma pasta de referências
+def get_reference_watcher(retriever_factory: Callable, path: str = REFERENCES_DIR,
+                          interval: float = WATCH_INTERVAL) -> ReferenceWatcher:
+    with _OBSERVADORES_LOCK:
+        observador = _OBSERVADORES.get(path)
+        if observador is None:
+            observador = ReferenceWatcher(retriever_factory(), path, interval)
+            _OBSERVADORES[path] = observador
+        observador.start()
+        return observador